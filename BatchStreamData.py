@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Run FormatStreamData over several input folders from one invocation, e.g. to
+reprocess a number of field seasons at once.  Each job is an input folder, an
+output folder and a mode (logger or temperature data).  Jobs run in a pool of
+worker processes, each job writes its usual LogFile.txt plus a BatchStatus.txt
+of the status messages into its own output folder, and a combined summary of
+all the jobs is written at the end.
+
+"""
+import os
+import sys
+import csv
+import time
+import getopt
+from concurrent.futures import ProcessPoolExecutor
+
+import FormatStreamData
+
+# Job modes and whether each means temperature (HOBO) data
+jobModes = {'logger': False, 'temperature': True}
+
+# Default number of jobs run at the same time
+defaultWorkers = 2
+
+# Status messages of each job go to this file in its output folder
+jobStatusFileName = 'BatchStatus.txt'
+
+summaryHeaders = ['Input', 'Output', 'Mode', 'Status', 'Files', 'Failed', 'DataRows', 'Seconds']
+
+# One batch job - mode is 'logger' or 'temperature'
+class BatchJob(object):
+    def __init__(self, inputFolder, outputFolder, mode, DoEOutputOption=False):
+        self.inputFolder = inputFolder
+        self.outputFolder = outputFolder
+        self.mode = mode
+        self.DoEOutputOption = DoEOutputOption
+
+# Stands in for the GUI's message queue - writes a job's status messages to its own file
+class JobStatusLog(object):
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def put(self, msg):
+        if msg != FormatStreamData.DONE_MESSAGE:
+            self.file.write(msg + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Parse a job description "input,output,mode[,eim]" - mode defaults to logger.  Raises
+# ValueError if it doesn't make sense.
+def parseJob(text, DoEOutputOption=False):
+    fields = [field.strip() for field in next(csv.reader([text]))]
+    if len(fields) < 2 or len(fields) > 4 or fields[0] == '' or fields[1] == '':
+        raise ValueError('expected input,output[,mode[,eim]]: %s' % text)
+    mode = fields[2].lower() if len(fields) > 2 and fields[2] != '' else 'logger'
+    if mode not in jobModes:
+        raise ValueError('mode must be logger or temperature: %s' % text)
+    if len(fields) > 3:
+        if fields[3].lower() not in ('eim', ''):
+            raise ValueError('fourth field can only be eim: %s' % text)
+        DoEOutputOption = DoEOutputOption or fields[3].lower() == 'eim'
+    return BatchJob(FormatStreamData.normalizedPath(fields[0]), FormatStreamData.normalizedPath(fields[1]), mode, DoEOutputOption)
+
+# Read jobs from a job file - one job per line as for parseJob, blank lines and lines
+# starting with # are ignored
+def readJobFile(path, DoEOutputOption=False):
+    jobs = []
+    with open(path) as jobFile:
+        for lineNo, line in enumerate(jobFile, 1):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            try:
+                jobs.append(parseJob(line, DoEOutputOption))
+            except ValueError as e:
+                raise ValueError('%s line %d: %s' % (path, lineNo, str(e)))
+    return jobs
+
+# Run one job in a worker process - returns a summary row (a dict keyed by summaryHeaders).  The
+# job reads its data files in that process unless options give fileWorkers, so that the number of
+# jobs run at the same time is the number of processes reading data files, not a quarter of it.
+def runJob(job, options):
+    options = dict(options, fileWorkers=options.get('fileWorkers', 0))
+    startTime = time.time()
+    summary = {'Input': job.inputFolder, 'Output': job.outputFolder, 'Mode': job.mode,
+               'Status': 'OK', 'Files': 0, 'Failed': 0, 'DataRows': 0, 'Seconds': 0}
+    statusLog = None
+    try:
+        if not os.path.isdir(job.outputFolder):
+            os.makedirs(job.outputFolder)
+        statusLog = JobStatusLog(os.path.join(job.outputFolder, jobStatusFileName))
+        ctx = FormatStreamData.RunContext(job.outputFolder, job.inputFolder, jobModes[job.mode],
+                                          job.DoEOutputOption, False, statusLog, **options)
+        if not FormatStreamData.runStreamData(ctx):
+            summary['Status'] = 'Not run'
+        elif ctx.nFilesFailed > 0:
+            summary['Status'] = 'Errors'
+        summary['Files'] = ctx.nFilesProcessed
+        summary['Failed'] = ctx.nFilesFailed
+        summary['DataRows'] = ctx.nDataRows
+    except Exception as e:
+        summary['Status'] = 'Error - %s' % str(e)
+    finally:
+        if statusLog is not None:
+            statusLog.close()
+    summary['Seconds'] = round(time.time() - startTime, 1)
+    return summary
+
+# Run all the jobs, at most nWorkers at a time, and write the combined summary CSV.
+# Returns the summary rows in job order.
+def runBatch(jobs, nWorkers=defaultWorkers, summaryPath='BatchSummary.csv', **options):
+    with ProcessPoolExecutor(max_workers=max(1, min(nWorkers, len(jobs))), mp_context=FormatStreamData.workerContext) as pool:
+        futures = [pool.submit(runJob, job, options) for job in jobs]
+        summaries = []
+        for job, future in zip(jobs, futures):
+            summary = future.result()
+            print('%s -> %s: %s' % (job.inputFolder, job.outputFolder, summary['Status']))
+            summaries.append(summary)
+
+    with open(summaryPath, 'w', newline='') as summaryFile:
+        writer = csv.DictWriter(summaryFile, fieldnames=summaryHeaders)
+        writer.writeheader()
+        writer.writerows(summaries)
+    return summaries
+
+def helpMessage():
+    print('Usage:')
+    print('BatchStreamData.py [-h] [-e] [-j <workers>] [-s <summary.csv>] [-f <jobFile>] [--job <input,output,mode>]...')
+    print('Runs FormatStreamData over several input folders at once')
+    print('Each job is input folder, output folder, mode (logger or temperature, default logger) and optionally eim')
+    print('Optional parameters:')
+    print('    -f   - read jobs from <jobFile>, one job per line, # starts a comment')
+    print('    --job=<input,output,mode> - add a job, may be given several times')
+    print('    -j   - number of jobs to run at the same time (default %d), each in a worker process of its own' % defaultWorkers)
+    print('    -s   - combined summary CSV (default BatchSummary.csv)')
+    print('    -e   - output WA Department of Ecology EIM-formatted .csv files for every job')
+    print('    -k   - QC threshold, as for FormatStreamData.py')
+    print('    --eim-max-rows=<n>, --eim-max-bytes=<n> - split EIM files into parts, as for FormatStreamData.py')
+    print('    -z, --compress=<type> - compress the output CSVs, as for FormatStreamData.py')
+    print('    --resume - carry on each job from its last checkpoint, as for FormatStreamData.py')
+    print('    --file-workers=<n> - worker processes reading each job\'s data files, as for FormatStreamData.py (default 0 = in the')
+    print('                         job\'s own process) - the batch then runs up to j * (1 + n) processes instead of j')
+    print('    -h   - print this help message')
+    sys.exit(2)
+
+def main(argv):
+    jobFiles = []
+    jobTexts = []
+    nWorkers = defaultWorkers
+    summaryPath = 'BatchSummary.csv'
+    DoEOutputOption = False
+    options = {}
+
+    try:
+        opts, args = getopt.getopt(argv, "hef:j:s:k:z", ["help", "ecology", "file=", "job=", "workers=", "summary=", "qc-threshold=",
+                                                         "eim-max-rows=", "eim-max-bytes=", "compress=", "resume",
+                                                         "file-workers="])
+    except getopt.GetoptError:
+        helpMessage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            helpMessage()
+        elif opt in ("-e", "--ecology"):
+            DoEOutputOption = True
+        elif opt in ("-f", "--file"):
+            jobFiles.append(arg)
+        elif opt == "--job":
+            jobTexts.append(arg)
+        elif opt in ("-j", "--workers"):
+            try:
+                nWorkers = int(arg)
+            except ValueError:
+                helpMessage()
+            if nWorkers < 1:
+                helpMessage()
+        elif opt in ("-s", "--summary"):
+            summaryPath = arg
+        elif opt in ("-k", "--qc-threshold"):
+            try:
+                options['qcThreshold'] = float(arg)
+            except ValueError:
+                helpMessage()
+        elif opt == "--eim-max-rows":
+            try:
+                options['eimMaxRows'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['eimMaxRows'] < 0:
+                helpMessage()
+        elif opt == "--eim-max-bytes":
+            options['eimMaxBytes'] = FormatStreamData.parseByteCount(arg)
+            if options['eimMaxBytes'] is None:
+                helpMessage()
+        elif opt == "-z":
+            options['compression'] = 'gzip'
+        elif opt == "--compress":
+            if arg not in FormatStreamData.availableCompressions():
+                print('--compress must be one of: %s' % ', '.join(FormatStreamData.availableCompressions()))
+                sys.exit(2)
+            options['compression'] = arg
+        elif opt == "--resume":
+            options['resume'] = True
+        elif opt == "--file-workers":
+            try:
+                options['fileWorkers'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['fileWorkers'] < 0:
+                helpMessage()
+
+    try:
+        jobs = []
+        for path in jobFiles:
+            jobs.extend(readJobFile(path, DoEOutputOption))
+        for text in jobTexts:
+            jobs.append(parseJob(text, DoEOutputOption))
+    except (ValueError, IOError) as e:
+        print(str(e))
+        sys.exit(2)
+    if len(jobs) == 0:
+        helpMessage()
+
+    # Two jobs writing into one output folder would overwrite each other's files
+    outputFolders = [os.path.normcase(os.path.abspath(job.outputFolder)) for job in jobs]
+    if len(set(outputFolders)) != len(outputFolders):
+        print('Each job needs its own output folder')
+        sys.exit(2)
+
+    runBatch(jobs, nWorkers, summaryPath, **options)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
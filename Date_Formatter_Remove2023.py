@@ -40,7 +40,7 @@ def collectFiles(inputFolder, outputFolder=None):
         print(filesToRead)                
     return filesToRead
 
-def change2023Dates(file, datesChange):
+def change2023Dates(file, datesChange, outputFolder):
     if verbose:
         print("in Change2023Dates")
     datafile = open(file, 'r')
@@ -48,7 +48,7 @@ def change2023Dates(file, datesChange):
     outputFileName = ntpath.basename(file)
     print("Writing file,", str(outputFileName)+"...")
     
-    outputPath = os.path.join("C:\\Users\\Evan Romasco-Kelly\\OneDrive\\Documents\\Kooskooskie Commons\\WADOE Reporting\\EIM\\DO and Temp Files", outputFileName)
+    outputPath = os.path.join(outputFolder, outputFileName)
     outfile = open(outputPath, 'w')
     writer = csv.writer(outfile, lineterminator='\n')
     
@@ -98,11 +98,11 @@ def createDateDict():
 
 def main():
     inputFolder1 = input("Input Folder Path:\n")
-#    outputFolder1 = input("Output Folder Path:\n")
+    outputFolder1 = input("Output Folder Path:\n")
     dateChangeDict = createDateDict()
     
     filesToProcess = collectFiles(inputFolder1)
     for afile in filesToProcess:
-        change2023Dates(afile, dateChangeDict)
+        change2023Dates(afile, dateChangeDict, outputFolder1)
 
 main()
\ No newline at end of file
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Compare the outputs of two FormatStreamData runs - e.g. before and after a
+change to the site mappings, or a re-export of the loggers - and list exactly
+which readings, medians and EIM rows were added, removed or changed.
+
+Each side is read once, and every value is hash-partitioned by its site,
+parameter, date and time into partition files, so a partition of both sides
+at a time is compared in memory, however big the outputs are.  The
+differences are written sorted by source, site, parameter, date and time.
+
+"""
+import os
+import re
+import sys
+import csv
+import zlib
+import getopt
+import fnmatch
+import tempfile
+import datetime
+import shutil
+from collections import Counter
+
+import FormatStreamData
+import ResampleStreamData
+
+# Sides of the comparison
+diffSides = ['old', 'new']
+
+# Bytes of output read per partition - the memory used is about 20 times this, as each row
+# holds several values.  Compressed outputs are taken to be diffCompressionRatio times their size.
+# The partition files of a side are all open at once, hence the limit on their number.
+diffPartitionBytes = 8 * 1024 * 1024
+diffCompressionRatio = 8
+maxDiffPartitions = 256
+
+# Separates the fields of a record's key
+keySeparator = '\x1f'
+
+# The summary CSV and the EIM files of each kind of run - True for temperature (HOBO) data.  EIM
+# file names end in the date of the run that wrote them (MM-DD-YYYY), then _part2... if split, and
+# runs into the same folder on other days leave theirs behind - only the newest date's are compared.
+summaryFileNames = {False: 'StreamData.CSV', True: 'TemperatureData.CSV'}
+eimFilePatterns = {False: 'hi-9829_eim_*.csv*', True: '*_temperature_eim*.csv*'}
+eimFileDate = re.compile(r'(\d\d)-(\d\d)-(\d{4})(_part\d+)?\.csv', re.IGNORECASE)
+
+# EIM columns compared, by the names they have in the logger or temperature EIM files
+eimColumnNames = {
+    'site' : ['Location_ID'],
+    'date' : ['Field_Collection_Start_Date', 'Start_Date'],
+    'time' : ['Field_Collection_Start_Time', 'Start_Time'],
+    'parameter' : ['Result_Parameter_Name', 'Parameter_Name'],
+    'value' : ['Result_Value'],
+    'units' : ['Result_Value_Units', 'Result_Unit'],
+    'qualifier' : ['Result_Data_Qualifier'],
+}
+
+diffHeaders = ['Change', 'Source', 'Site', 'Parameter', 'Date', 'Time', 'Old', 'New']
+
+
+# Each reader yields (key, value) records.  The key is source, site, parameter, date and time
+# joined by keySeparator, so it sorts as they do and takes little memory.  The value is the
+# value, then a space and the flags (units and qualifier) if there are any - the value is
+# compared as a number if it is one, the flags as text.
+
+def recordKey(source, site, parameter, date, time):
+    return keySeparator.join((source, site, parameter, date, time))
+
+# Readings from the data rows of a summary CSV
+def readSummaryReadings(csvPath):
+    dates = {}      # day number -> date text, there are only a few dates
+    rowSite = rowSeconds = None
+    for site, parameter, seconds, value in ResampleStreamData.readNormalizedRows(csvPath):
+        # The readings of a row all have the same site and time
+        if seconds != rowSeconds or site != rowSite:
+            rowSite, rowSeconds = site, seconds
+            day, seconds = divmod(int(seconds), 86400)
+            if day not in dates:
+                dates[day] = (ResampleStreamData.bucketOrigin + datetime.timedelta(days=day)).strftime('%Y-%m-%d')
+            time = '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+            start = keySeparator.join(('Reading', site, ''))
+            end = keySeparator.join(('', dates[day], time))
+        yield start + parameter + end, repr(value)
+
+# Medians from the MEDIAN VALUES section of StreamData.CSV
+def readSummaryMedians(csvPath):
+    with FormatStreamData.openOutputForReading(csvPath) as csvfile:
+        datarows = csv.reader(csvfile)
+        for row in datarows:
+            if len(row) > 0 and row[0] == 'MEDIAN VALUES':
+                next(datarows, None)        # Site,Measurement,Date,Median
+                break
+        for row in datarows:
+            if len(row) >= 4:
+                yield recordKey('Median', row[0], row[1], row[2], ''), row[3]
+
+# Rows of an EIM file, logger or temperature
+def readEIMRows(path):
+    with FormatStreamData.openOutputForReading(path) as csvfile:
+        datarows = csv.reader(csvfile)
+        header = next(datarows, [])
+        columns = {}
+        for field, names in eimColumnNames.items():
+            for name in names:
+                if name in header:
+                    columns[field] = header.index(name)
+                    break
+            else:
+                raise ValueError('%s is not an EIM file written by FormatStreamData - it has no %s column' % (path, names[0]))
+        width = max(columns.values()) + 1
+        for row in datarows:
+            if len(row) < width:
+                continue
+            value = ' '.join(field for field in (row[columns['value']], row[columns['units']], row[columns['qualifier']]) if field != '')
+            yield recordKey('EIM', row[columns['site']], row[columns['parameter']], row[columns['date']], row[columns['time']]), value
+
+# The files compared for a run: its summary CSV and the EIM files of its latest run.  output can
+# be a run's output folder or just a summary CSV.
+def outputFiles(output, doTemperature):
+    if not os.path.isdir(output):
+        return output, []
+    summaryPath = FormatStreamData.existingOutputPath(os.path.join(output, summaryFileNames[doTemperature]))
+    if summaryPath is None:
+        raise ValueError('No %s in %s' % (summaryFileNames[doTemperature], output))
+    eimNames = {}       # by run date, YYYY-MM-DD
+    for name in sorted(os.listdir(output)):
+        match = eimFileDate.search(name)
+        if match is not None and fnmatch.fnmatch(name.lower(), eimFilePatterns[doTemperature]):
+            eimNames.setdefault('%s-%s-%s' % (match.group(3), match.group(1), match.group(2)), []).append(name)
+    if len(eimNames) == 0:
+        return summaryPath, []
+    return summaryPath, [os.path.join(output, name) for name in eimNames[max(eimNames)]]
+
+# All the records of one side
+def readOutputRecords(summaryPath, eimPaths):
+    for record in readSummaryReadings(summaryPath):
+        yield record
+    for record in readSummaryMedians(summaryPath):
+        yield record
+    for path in eimPaths:
+        for record in readEIMRows(path):
+            yield record
+
+# Number of partitions for outputs of these files - enough that each holds about diffPartitionBytes
+def partitionsFor(paths):
+    totalBytes = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if os.path.splitext(path)[1].lower() in FormatStreamData.compressionSuffixes.values():
+            size *= diffCompressionRatio
+        totalBytes += size
+    return min(max(1, -(-totalBytes // diffPartitionBytes)), maxDiffPartitions)
+
+
+# The records of both sides, hash-partitioned by key so each partition of both sides can be
+# compared on its own.  With one partition the records are just kept in memory; otherwise they
+# go to a CSV per side and partition in a temporary folder.
+class DiffPartitions(object):
+    def __init__(self, nPartitions):
+        self.nPartitions = nPartitions
+        self.folder = None
+        self.records = {}       # side -> records, for a single partition
+        if nPartitions > 1:
+            self.folder = tempfile.mkdtemp(prefix='StreamDataDiff')
+
+    def partitionPath(self, side, index):
+        return os.path.join(self.folder, '%s%d.csv' % (side, index))
+
+    # Add the records of one side - one pass over them
+    def addRecords(self, side, records):
+        if self.nPartitions == 1:
+            self.records[side] = list(records)
+            return
+        files = [open(self.partitionPath(side, index), 'w', newline='') for index in range(self.nPartitions)]
+        try:
+            writers = [csv.writer(partitionFile) for partitionFile in files]
+            for key, value in records:
+                writers[zlib.crc32(key.encode('utf-8', 'replace')) % self.nPartitions].writerow((key, value))
+        finally:
+            for partitionFile in files:
+                partitionFile.close()
+
+    # The records of one side in one partition
+    def partition(self, side, index):
+        if self.nPartitions == 1:
+            for record in self.records.pop(side):
+                yield record
+            return
+        with open(self.partitionPath(side, index), newline='') as partitionFile:
+            for key, value in csv.reader(partitionFile):
+                yield key, value
+
+    def close(self):
+        self.records = {}
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+# The values of each key in records, as a dict - a key usually has one value, but can have more,
+# e.g. a reading that is in two overlapping raw data files, which are kept in a list
+def keyValues(records):
+    values = {}
+    for key, value in records:
+        previous = values.get(key)
+        if previous is None:
+            values[key] = value
+        elif isinstance(previous, list):
+            previous.append(value)
+        else:
+            values[key] = [previous, value]
+    return values
+
+# A key's values as a sorted list - numbers by value, so both sides' values line up
+def valueList(values):
+    if not isinstance(values, list):
+        return [values]
+    return sorted(values, key=valueOrder)
+
+def valueOrder(value):
+    number, _, flags = value.partition(' ')
+    try:
+        return (0, float(number), flags, '')
+    except ValueError:
+        return (1, 0.0, flags, number)
+
+# True if two values are the same - numbers only have to be within tolerance
+def sameValue(old, new, tolerance):
+    if old == new:
+        return True
+    oldNumber, _, oldFlags = old.partition(' ')
+    newNumber, _, newFlags = new.partition(' ')
+    if oldFlags != newFlags:
+        return False
+    try:
+        return abs(float(oldNumber) - float(newNumber)) <= tolerance
+    except ValueError:
+        return False
+
+# Compare one partition of the two sides - returns the differences as sorted run rows,
+# (key, [change, old values, new values])
+def comparePartition(oldRecords, newRecords, tolerance):
+    oldValues = keyValues(oldRecords)
+    newValues = keyValues(newRecords)
+
+    differences = []
+    for key, old in oldValues.items():
+        new = newValues.pop(key, None)
+        if new is None:
+            differences.append((key, ['Removed', '; '.join(valueList(old)), '']))
+            continue
+        if not isinstance(old, list) and not isinstance(new, list):
+            if not sameValue(old, new, tolerance):
+                differences.append((key, ['Changed', old, new]))
+            continue
+        old = valueList(old)
+        new = valueList(new)
+        if len(old) != len(new) or not all(sameValue(o, n, tolerance) for o, n in zip(old, new)):
+            differences.append((key, ['Changed', '; '.join(old), '; '.join(new)]))
+    # What is left of the new side isn't in the old one
+    for key, new in newValues.items():
+        differences.append((key, ['Added', '', '; '.join(valueList(new))]))
+    return differences
+
+# Compare the outputs of two runs (output folders or summary CSVs) and write the differences
+# to diffPath.  Returns a Counter of (source, change).
+def diffOutputs(oldOutput, newOutput, diffPath, doTemperature=False, tolerance=0.0, nPartitions=None):
+    oldFiles = outputFiles(oldOutput, doTemperature)
+    newFiles = outputFiles(newOutput, doTemperature)
+    if nPartitions is None:
+        nPartitions = partitionsFor([oldFiles[0]] + oldFiles[1] + [newFiles[0]] + newFiles[1])
+
+    partitions = DiffPartitions(nPartitions)
+    differences = FormatStreamData.SortedRunStore()
+    try:
+        partitions.addRecords('old', readOutputRecords(*oldFiles))
+        partitions.addRecords('new', readOutputRecords(*newFiles))
+        for index in range(nPartitions):
+            differences.addRun(comparePartition(partitions.partition('old', index), partitions.partition('new', index), tolerance))
+
+        counts = Counter()
+        with open(diffPath, 'w', newline='') as diffFile:
+            writer = csv.writer(diffFile, lineterminator='\n')
+            writer.writerow(diffHeaders)
+            for key, (change, old, new) in differences.merged():
+                source, site, parameter, date, time = key.split(keySeparator)
+                writer.writerow([change, source, site, parameter, date, time, old, new])
+                counts[(source, change)] += 1
+    finally:
+        differences.close()
+        partitions.close()
+    return counts
+
+
+def helpMessage():
+    print('Usage:')
+    print('DiffStreamData.py [-h] [-t] [-o <diff.csv>] [-d <tolerance>] [-p <partitions>] <old output> <new output>')
+    print('Lists the readings, medians and EIM rows that were added, removed or changed between two runs')
+    print('of FormatStreamData.py - each output is a run\'s output folder, or just its StreamData.CSV or TemperatureData.CSV')
+    print('Optional parameters:')
+    print('    -t   - compare temperature (HOBO) outputs - default is HI-9829 outputs')
+    print('    -o   - differences CSV (default StreamDataDiff.csv)')
+    print('    -d   - numbers that differ by no more than this are the same (default 0)')
+    print('    -p   - number of partitions to compare at a time (default from the size of the outputs)')
+    print('    -h   - print this help message')
+    sys.exit(2)
+
+
+def main(argv):
+    diffPath = 'StreamDataDiff.csv'
+    doTemperature = False
+    tolerance = 0.0
+    nPartitions = None
+
+    try:
+        opts, args = getopt.getopt(argv, "hto:d:p:", ["help", "temperature", "output=", "tolerance=", "partitions="])
+    except getopt.GetoptError:
+        helpMessage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            helpMessage()
+        elif opt in ("-t", "--temperature"):
+            doTemperature = True
+        elif opt in ("-o", "--output"):
+            diffPath = arg
+        elif opt in ("-d", "--tolerance"):
+            try:
+                tolerance = float(arg)
+            except ValueError:
+                helpMessage()
+        elif opt in ("-p", "--partitions"):
+            try:
+                nPartitions = int(arg)
+            except ValueError:
+                helpMessage()
+            if nPartitions < 1:
+                helpMessage()
+
+    if len(args) != 2 or not all(os.path.exists(output) for output in args):
+        helpMessage()
+
+    try:
+        counts = diffOutputs(args[0], args[1], diffPath, doTemperature, tolerance, nPartitions)
+    except (ValueError, IOError) as e:
+        print(str(e))
+        sys.exit(1)
+    for source in ('Reading', 'Median', 'EIM'):
+        print('%-8s %d added, %d removed, %d changed' % (source + 's:', counts[(source, 'Added')],
+                                                         counts[(source, 'Removed')], counts[(source, 'Changed')]))
+    print('Differences written to %s' % diffPath)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -14,11 +14,53 @@ from dateutil.parser import parse
 import heapq
 import getopt
 import re
-import platform
 from xlrd import open_workbook, XLRDError, xldate
 import csv
 from collections import defaultdict
+from collections import deque
+from collections import Counter
+from bisect import bisect_left, insort
 import time
+import json
+import io
+import gzip
+import queue
+import threading
+import math
+import zipfile
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import shutil
+import tempfile
+import zlib
+import hashlib
+from operator import itemgetter
+
+# zstd and lz4 output compression are only offered if their packages are installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+# Derived parameters are worked out with numpy if it is installed, in plain Python if not
+try:
+    import numpy
+except ImportError:
+    numpy = None
+# The memory limit for reading a data file (fileMemoryLimit) can only be set where there is resource
+try:
+    import resource
+except ImportError:
+    resource = None
+# .xlsx logger files can only be read if openpyxl is installed
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 
 # 
 # GLOBALS TO THIS FILE
@@ -29,29 +71,84 @@ DONE_MESSAGE = "<< DONE! >>"
 # Files to exclude from list of processed files (if present)
 filesToExclude = ['.dropbox', 'desktop.ini' ]
 
-# Dictionary of sites encountered - to look for dupes - the value is a SiteData named tuple containing
-# path name to the file and the dates for which we have data
-sites = {}
-
+# Each run keeps a dictionary of sites encountered (RunContext.sites) - to look for dupes - the value
+# is a list of SiteData named tuples containing path name to the file and the dates for which we have data
+#
 # Each item in sites has site meta data:
 # filePath - path to file containing data on this site
 # minDate - earliest date data was found for the site
 # maxDate - latest date data was found for the site
 # numRecs - number of data records for the site
-SiteData = namedtuple('SiteMetadata', 'filePath, minDate, maxDate, numRecs')
-
-# True to enable verbose logging
-verbose = False
-
-# queue for messages
-messageQueue = None
-
-# handle to output CSV files
-outputCSVSummary = None     # Data summary by site, with median values
-outputCSVDoE = None         # Output for DoE logger data
-
-# Temperature data
-outputCSVDoETemperature = None
+# days - set of the days (date ordinals) the file has data for, for the coverage report
+SiteData = namedtuple('SiteMetadata', 'filePath, minDate, maxDate, numRecs, days')
+
+# Site coverage report written next to the summary CSV - see SiteCoverage
+coverageFileName = 'SiteCoverage.CSV'
+
+# Watch mode - the output folder keeps a manifest of the data files processed so far, and their
+# sorted runs are kept in the checkpoint folder (see checkpointFolderName), saved after each batch.
+# Watch mode started again on the same input folder and kind of data carries on from them, so only
+# the files that are new since are read.  The input folder is polled every watchPollSeconds, and a
+# new file is only processed once its size and modification time have stayed the same for a poll
+# and it is at least watchSettleSeconds old, so files that are still being synced aren't picked up
+# half written.  A batch of new files still writes the summary CSV (and the logger EIM file) again
+# from all the rows, as they are sorted, but the temperature EIM files and rollups of the sites
+# none of the batch's files were for are kept from the batch before - see writeOutputs.
+manifestFileName = 'ProcessedFiles.json'
+watchPollSeconds = 30
+watchSettleSeconds = 10
+
+# QA/QC of the measurements - each value is compared with the median of the previous
+# qcWindowSize values for the same site and parameter, and flagged if it is more than
+# qcThreshold (scaled) median absolute deviations away from it.  A threshold of 0 turns
+# flagging off.  These are the defaults - each run can override them.
+qcWindowSize = 25
+qcThreshold = 3.5
+qcMinReadings = 10          # Don't flag anything until the window has this many values
+qcQualifier = 'J'           # EIM Result_Data_Qualifier for flagged values (estimate - suspect value)
+
+# The EIM upload portal won't take very large files, so EIM output can be split into part
+# files of at most eimMaxRows data rows and/or eimMaxBytes bytes each.  0 means no limit.
+# These are the defaults - each run can override them.
+eimMaxRows = 0
+eimMaxBytes = 0
+
+# Output rows are sorted by site, date and time (then source file and row, so rows with the same
+# timestamp always come out in the same order), so every run over the same data gives the same
+# files whatever order the data files are found in.  Each data file's rows are sorted as it is
+# read, making a sorted run; runs are kept in memory until they hold sortBufferRows rows, then
+# merged and spilled to a temporary file.  The outputs are written by a streaming merge of all
+# the runs, so all the rows never have to be held at once.
+sortBufferRows = 200000
+sortMergeFanIn = 64         # spill files merged at once - when there are this many they are merged into one
+
+# Checkpoints - so an interrupted run (GUI closed, machine asleep) can be picked up with --resume,
+# a full run saves its state to checkpointFolderName in the output folder every checkpointEveryFiles
+# data files or checkpointEverySeconds seconds, whichever comes first (0 turns either off).  The
+# state is the sorted runs read so far, spilled to files in that folder, plus the list of files read,
+# the per-site data, the counts and how far the log file had got.  The outputs themselves are only
+# written once all the files are read, so there is nothing else to roll back.  The checkpoint is
+# removed when the run finishes.
+checkpointFolderName = 'Checkpoint'
+checkpointStateFileName = 'Checkpoint.pickle'
+checkpointEveryFiles = 100
+checkpointEverySeconds = 300
+
+# A run can be split across machines (see SHARDS below) - each shard run writes a bundle of what
+# it read into this folder in its output folder, and MergeStreamData.py writes the outputs from the
+# bundles of all the shards
+shardBundleFolderName = 'ShardBundle'
+shardStateFileName = 'Shard.pickle'
+shardRowsFileName = 'Rows'
+shardPickleProtocol = 4         # bundles may be merged by a different version of Python
+
+# Output compression - None, or one of compressionSuffixes.  The data outputs (not the log) are
+# compressed as they are written, on a background thread; up to compressionQueueChunks chunks of
+# compressionChunkBytes are queued for it before the writer has to wait.
+outputCompression = None
+compressionSuffixes = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+compressionChunkBytes = 256 * 1024
+compressionQueueChunks = 64
 
 # Standard data headers - some are in a slightly different format and have to be massaged a bit...
 columnHeaders = [ 'Date', 'Time', 'Temp.[C]', 'pH', 'mV [pH]', 'EC[uS/cm]', 'D.O.[%]', 'D.O.[ppm]', 'Turb.FNU', 'Remarks', 'Other' ]
@@ -60,6 +157,10 @@ columnHeaders = [ 'Date', 'Time', 'Temp.[C]', 'pH', 'mV [pH]', 'EC[uS/cm]', 'D.O
 # The medians are calculated per site/per date.
 calculateMedians = [ False, False, True,      True, True,       True,        True,      True,        True,       False,      False ]
 
+# Parameters derived from the HI-9829 measurements (see deriveLogValues) - written after the
+# columns above in the summary CSV, and medians are calculated for them too
+derivedLogHeaders = [ 'Temp.[F]', 'SpC[uS/cm]' ]
+
 # List of measurements to include in the DoE Summary CSV,
 # with value to put in the "Result_Parameter_Name" column for that item
 includeInDoESummary = {
@@ -67,6 +168,7 @@ includeInDoESummary = {
     'pH' : 'pH',
     'D.O.[%]' : 'Dissolved Oxygen Percent Saturation',
     'EC[uS/cm]' : 'Electrical Conductivity',
+    'SpC[uS/cm]' : 'Specific Conductance',
     'Turb.FNU' : 'Turbitity'
 }
 
@@ -76,6 +178,7 @@ valueUnitsDoESummary = {
     'pH' : 'pH',
     'D.O.[%]' : '%',
     'EC[uS/cm]' : 'uS/cm',
+    'SpC[uS/cm]' : 'uS/cm',
     'Turb.FNU' : 'FNU'
 }
 
@@ -84,9 +187,22 @@ methodsDoESummary = { 'Temp.[C]' : 'TEMPLOGGER',
                     'pH' : 'PHMETER',
                     'D.O.[%]' : 'DO-OPTICAL',
                     'EC[uS/cm]' : 'CONDMETER',
+                    'SpC[uS/cm]' : 'CONDMETER',
                     'Turb.FNU' : 'TURBM'
 }
 
+# Parameters derived from the HOBO measurements (see deriveTemperatureValues) - written after
+# RawDataFile in the temperature summary CSV
+derivedTemperatureHeaders = [ 'Temp (DegC)', 'DO sat (%)' ]
+
+# Derived parameters are worked out as the outputs are written, derivedBatchRows rows at a time, a
+# whole column of the batch at once (with numpy if it is installed - the results are the same
+# without it).  Specific conductance is conductivity compensated to 25 deg C with the usual linear
+# coefficient; DO saturation is the DO concentration over the Benson and Krause (1984) saturation
+# concentration for fresh water at the water temperature and sea level pressure.
+derivedBatchRows = 4096
+conductivityTempCoefficient = 0.0191        # per deg C
+
 
 # Headers for the DoE Output file for loggers - this is the format of each line in that file
 outputCSVDoEHeaders = [
@@ -180,35 +296,97 @@ outputCSVDoETemperatureHeaders = [
 ]
 
 
-# Locate files to process - if doTemperature is True, doing temperature
-# files - otherwise LOG files
-def collectFiles(inputFolder, outputFolder, doTemp):
-    global verbose
+# A folder given by the user, e.g. on the command line or in a job file, in the form this OS uses.
+# Windows-style paths (2019\HOBO) also work on Linux and Mac, so job files can be shared.
+def normalizedPath(path):
+    if path == '':
+        return path
+    if os.sep == '/':
+        path = path.replace('\\', '/')
+    return os.path.normpath(os.path.expanduser(path))
 
-    filesToRead = []
-    # Regular expression to identify files we are interested in processing - for
-    # Temperature data, it is CSV's; for log files, it is .XLS files
+# Regular expression to identify files we are interested in processing - for
+# Temperature data, it is CSV's; for log files, it is .XLS files
+def logFilePatternFor(doTemp):
     if doTemp:
-        logFilePattern = re.compile('.*\.csv$')
+        return re.compile('.*\.csv$')
     else:
-        logFilePattern = re.compile('.*\.xls$')
+        return re.compile('.*\.xlsx?$')
+
+# Zip archives of data files (e.g. a field trip's LOG folders) are read as if they were folders,
+# without extracting them.  A data file in an archive has a path like
+# <folder>\Trip1.zip\LOG\file.xls, and is read straight out of the archive.
+def isArchiveName(name):
+    return name.lower().endswith('.zip')
+
+# Paths of the data files in a zip archive that match logFilePattern, from its central directory.
+# Raises zipfile.BadZipFile or OSError if the archive can't be read.
+def archiveMembers(archivePath, logFilePattern):
+    members = []
+    with zipfile.ZipFile(archivePath) as archive:
+        for info in archive.infolist():
+            nameParts = info.filename.split('/')
+            if not info.is_dir() and nameParts[-1] not in filesToExclude and re.match(logFilePattern, nameParts[-1]):
+                members.append(os.path.join(archivePath, *nameParts))
+    return members
+
+# Split the path of a data file into (archive path, name in the archive), or (path, None) if it
+# isn't in an archive
+def splitArchivePath(path):
+    for m in re.finditer(r'\.zip(?=[\\/])', path, re.IGNORECASE):
+        archivePath = path[:m.end()]
+        if os.path.isfile(archivePath):
+            return archivePath, path[m.end() + 1:].replace(os.sep, '/')
+    return path, None
+
+# Open a data file, which may be in a zip archive, for reading as binary
+def openDataFile(path):
+    archivePath, member = splitArchivePath(path)
+    if member is None:
+        return open(path, 'rb')
+    with zipfile.ZipFile(archivePath) as archive:
+        return archive.open(member)     # stays readable after the archive is closed
+
+# Open a data file, which may be in a zip archive, for reading as text
+def openDataText(path):
+    archivePath, member = splitArchivePath(path)
+    if member is None:
+        return open(path)
+    return io.TextIOWrapper(openDataFile(path))
+
+# Locate files to process - if doTemperature is True, doing temperature
+# files - otherwise LOG files.  Zip archives are searched too.
+def collectFiles(ctx, inputFolder, doTemp):
+
+    filesToRead = []
+    logFilePattern = logFilePatternFor(doTemp)
         
     for subdir, dirs, files in os.walk(inputFolder):
         for file in files:
             if file not in filesToExclude:
                 # Check if this file matches the pattern for a log file to
                 # process
-                if verbose:
-                    statusCallback("Checking "+os.path.join(subdir,file))
+                if ctx.verbose:
+                    ctx.statusCallback("Checking "+os.path.join(subdir,file))
                 m = re.match( logFilePattern, file)
                 if m:
-                    if verbose:
-                        statusCallback('Adding '+os.path.join(subdir, file))
+                    if ctx.verbose:
+                        ctx.statusCallback('Adding '+os.path.join(subdir, file))
                     filesToRead.append(os.path.join(subdir, file))
-                elif verbose:
-                        statusCallback('Skipping '+os.path.join(subdir, file))
+                elif isArchiveName(file):
+                    try:
+                        members = archiveMembers(os.path.join(subdir, file), logFilePattern)
+                    except (zipfile.BadZipFile, OSError) as e:
+                        ctx.statusCallback('Skipping archive %s: %s' % (os.path.join(subdir, file), str(e)))
+                        continue
+                    if ctx.verbose:
+                        for member in members:
+                            ctx.statusCallback('Adding '+member)
+                    filesToRead.extend(members)
+                elif ctx.verbose:
+                        ctx.statusCallback('Skipping '+os.path.join(subdir, file))
                     
-    return filesToRead
+    return sorted(filesToRead)      # so the log is in the same order every run
 
 # Thanks to https://stackoverflow.com/questions/7619319/python-xlrd-suppress-warning-messages
 class XlrdLogFileFilter(object):
@@ -229,6 +407,127 @@ class XlrdLogFileFilter(object):
                 self.f.write(data)
             self.state = 0
 
+# Logger workbooks (.xls read with xlrd, .xlsx with openpyxl) are read a row at a time through
+# these readers, so processLogFile handles both the same way.  A row is a list of (ctype, value)
+# cells using xlrd's cell types (0 empty, 1 text, 2 number, 3 date, ...).  Numbers are floats and
+# date/time cells are (year, month, day, hour, minute, second) tuples, as xldate_as_tuple gives
+# them - a time on its own has a date of (0, 0, 0).
+
+# Raised when a workbook can't be opened
+class WorkbookError(Exception):
+    pass
+
+class XlsWorkbookReader(object):
+    def __init__(self, path, xlrdLog):
+        try:
+            if splitArchivePath(path)[1] is None:
+                self.book = open_workbook(path, logfile=xlrdLog)
+            else:
+                with openDataFile(path) as dataFile:
+                    self.book = open_workbook(file_contents=dataFile.read(), logfile=xlrdLog)
+        except (XLRDError, zipfile.BadZipFile, OSError) as e:
+            raise WorkbookError(str(e))
+        self.nsheets = self.book.nsheets
+
+    # Value of one cell, None if it is outside the sheet
+    def cellValue(self, sheetIndex, rowx, colx):
+        sheet = self.book.sheet_by_index(sheetIndex)
+        if rowx >= sheet.nrows or colx >= sheet.ncols:
+            return None
+        return sheet.cell_value(rowx, colx)
+
+    def ncols(self, sheetIndex):
+        return self.book.sheet_by_index(sheetIndex).ncols
+
+    def rows(self, sheetIndex):
+        sheet = self.book.sheet_by_index(sheetIndex)
+        for rowIndex in range(sheet.nrows):
+            yield [(cell.ctype, xldate.xldate_as_tuple(cell.value, self.book.datemode) if cell.ctype == 3 else cell.value)
+                   for cell in sheet.row(rowIndex)]
+
+    def close(self):
+        self.book.release_resources()
+
+# Reads .xlsx workbooks in openpyxl's read-only mode, which streams the rows from the file
+# instead of loading the whole workbook
+class XlsxWorkbookReader(object):
+    def __init__(self, path, xlrdLog):
+        if openpyxl is None:
+            raise WorkbookError('the openpyxl package is needed to read .xlsx files')
+        self.dataFile = None
+        try:
+            if splitArchivePath(path)[1] is not None:
+                self.dataFile = openDataFile(path)
+            self.book = openpyxl.load_workbook(self.dataFile or path, read_only=True, data_only=True)
+        except Exception as e:      # openpyxl raises zipfile, XML and its own errors for bad files
+            if self.dataFile is not None:
+                self.dataFile.close()
+            raise WorkbookError(str(e))
+        self.nsheets = len(self.book.worksheets)
+
+    def cellValue(self, sheetIndex, rowx, colx):
+        for row in self.book.worksheets[sheetIndex].iter_rows(min_row=rowx + 1, max_row=rowx + 1, values_only=True):
+            if colx < len(row):
+                return row[colx]
+        return None
+
+    # Read-only sheets may not record their size - then it is the width of the header row
+    def ncols(self, sheetIndex):
+        sheet = self.book.worksheets[sheetIndex]
+        if sheet.max_column is not None:
+            return sheet.max_column
+        for row in sheet.iter_rows(max_row=1, values_only=True):
+            return len(row)
+        return 0
+
+    def rows(self, sheetIndex):
+        numColumns = self.ncols(sheetIndex)
+        for row in self.book.worksheets[sheetIndex].iter_rows(values_only=True):
+            cells = [self.normalizeCell(value) for value in row[:numColumns]]
+            cells.extend([(0, '')] * (numColumns - len(cells)))
+            yield cells
+
+    # (ctype, value) for a cell value as openpyxl gives it, matching what xlrd gives for .xls
+    def normalizeCell(self, value):
+        if value is None or value == '':
+            return (0, '')
+        elif isinstance(value, bool):
+            return (4, int(value))
+        elif isinstance(value, (int, float)):
+            return (2, float(value))
+        elif isinstance(value, datetime.datetime):
+            value = roundToSecond(value)
+            return (3, (value.year, value.month, value.day, value.hour, value.minute, value.second))
+        elif isinstance(value, datetime.date):
+            return (3, (value.year, value.month, value.day, 0, 0, 0))
+        elif isinstance(value, datetime.time):
+            seconds = int(round(value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6)) % 86400
+            return (3, (0, 0, 0, seconds // 3600, seconds // 60 % 60, seconds % 60))
+        elif isinstance(value, datetime.timedelta):
+            seconds = int(round(value.total_seconds())) % 86400
+            return (3, (0, 0, 0, seconds // 3600, seconds // 60 % 60, seconds % 60))
+        elif isinstance(value, str):
+            return (1, value)
+        return (5, value)   # error value such as #N/A
+
+    def close(self):
+        self.book.close()
+        if self.dataFile is not None:
+            self.dataFile.close()
+
+# Round a datetime to the nearest second, as xlrd does - Excel stores times as fractions of a
+# day, so 10:30:00 can come back as 10:29:59.999999
+def roundToSecond(value):
+    if value.microsecond >= 500000:
+        value += datetime.timedelta(seconds=1)
+    return value.replace(microsecond=0)
+
+# Open a logger workbook with the reader for its format
+def openLogWorkbook(path, xlrdLog):
+    if path.lower().endswith('.xlsx'):
+        return XlsxWorkbookReader(path, xlrdLog)
+    return XlsWorkbookReader(path, xlrdLog)
+
 # Class to find median of a string of values
 # from https://discuss.leetcode.com/topic/27521/short-simple-java-c-python-o-log-n-o-1/2 and
 # https://discuss.leetcode.com/topic/27689/python-o-lgn-using-two-heapq-data-sturctures
@@ -262,6 +561,108 @@ class MedianFinder(object):
             return (self.large[0] - self.small[0])/2.0
         return -float(self.small[0]) if len(self.small) > len(self.large) else float(self.large[0])
 
+# Sliding window of the most recent values of a series, kept both in arrival order (to know
+# which value to drop) and in sorted order (to find the median and median absolute deviation).
+# Adding a value is a binary search plus an insert into the sorted list, and the median absolute
+# deviation is found by a binary search over the values either side of the median, so each
+# value costs O(log w) comparisons for a window of w values.
+class RollingMedianWindow(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.arrivals = deque()
+        self.ordered = []
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def add(self, num):
+        if len(self.arrivals) == self.size:
+            oldest = self.arrivals.popleft()
+            del self.ordered[bisect_left(self.ordered, oldest)]
+        self.arrivals.append(num)
+        insort(self.ordered, num)
+
+    def median(self):
+        n = len(self.ordered)
+        if n % 2 == 1:
+            return self.ordered[n // 2]
+        return (self.ordered[n // 2 - 1] + self.ordered[n // 2]) / 2.0
+
+    # Median of |value - median| over the window.  The deviations of the values below the
+    # median and of those above it are each already sorted, so this is a k-th smallest
+    # search over two sorted lists rather than a sort.
+    def medianAbsoluteDeviation(self):
+        n = len(self.ordered)
+        med = self.median()
+        split = bisect_left(self.ordered, med)
+        if n % 2 == 1:
+            return self.kthDeviation(med, split, n // 2)
+        return (self.kthDeviation(med, split, n // 2 - 1) + self.kthDeviation(med, split, n // 2)) / 2.0
+
+    # k-th (0 based) smallest deviation from med - the values below split give one sorted
+    # list of deviations (walking down from split), the values from split up the other
+    def kthDeviation(self, med, split, k):
+        ordered = self.ordered
+        nBelow = split
+        nAbove = len(ordered) - split
+        # Binary search for how many of the k+1 smallest deviations come from below the median
+        lo = max(0, k + 1 - nAbove)
+        hi = min(k + 1, nBelow)
+        while lo < hi:
+            i = (lo + hi) // 2
+            j = k + 1 - i
+            if med - ordered[split - 1 - i] < ordered[split + j - 1] - med:
+                lo = i + 1
+            else:
+                hi = i
+        j = k + 1 - lo
+        deviation = 0.0
+        if lo > 0:
+            deviation = med - ordered[split - lo]
+        if j > 0:
+            deviation = max(deviation, ordered[split + j - 1] - med)
+        return deviation
+
+# Streaming QA/QC check - keeps a RollingMedianWindow per site/parameter and flags values
+# outside median +/- k * MAD of the window (MAD scaled by 1.4826 so k is comparable to a
+# number of standard deviations).  Values are checked against the window before being added,
+# so a spike doesn't mask itself.
+class QualityChecker(object):
+
+    def __init__(self, windowSize, threshold, minReadings):
+        self.windowSize = windowSize
+        self.threshold = threshold
+        self.minReadings = minReadings
+        self.windows = {}
+        self.nFlagged = 0
+
+    # Returns the EIM qualifier for the value - '' if it isn't flagged
+    def check(self, site, parameter, val):
+        if self.threshold <= 0:
+            return ''
+        key = (site, parameter)
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = RollingMedianWindow(self.windowSize)
+        qualifier = ''
+        if len(window) >= self.minReadings:
+            mad = window.medianAbsoluteDeviation()
+            # A MAD of 0 (flat series) gives no idea of the spread, so nothing is flagged
+            if mad > 0 and abs(val - window.median()) > self.threshold * 1.4826 * mad:
+                qualifier = qcQualifier
+                self.nFlagged += 1
+        window.add(val)
+        return qualifier
+
+# Convert a measurement read from a raw data file to a number - None for missing or
+# non-numeric values such as '-----' or ''
+def parseMeasurement(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
 # A list of values for a particular site/item by date
 # Designed to be put in a list indexed by site and item.
 # Used to calculate medians after all values have been recorded
@@ -271,14 +672,15 @@ class SiteItemMeasurements(object):
     # particular site.  The list has the values for each date.  The timestamps are als
     # a per-date list but just have the first time we encountered on that date - it is
     # for the DoE Logger summary (per Evan, first time is OK)
-    def __init__(self, site, item):
+    def __init__(self, site, item, ctx):
+        self.ctx = ctx
         self.siteName = site
         self.itemName = item
         self.medianFinders = {}
         self.timestamps = {}
+        self.qualifiers = {}        # QC qualifier per date - set if any value that day was flagged
     
-    def recordValue(self, dt, tm, val):
-        global verbose
+    def recordValue(self, dt, tm, val, qualifier=''):
         if dt not in self.medianFinders:      # first time we are seeing this date
             # A MedianFinder is an accumulator for a particular measurement on a
             # particular date - each value is recorded in the MedianFinder as it
@@ -298,15 +700,18 @@ class SiteItemMeasurements(object):
                 dt = strDatePrevious
             elif strDateNext in self.medianFinders:
                 dt = strDateNext
-            self.medianFinders[dt] = MedianFinder()
-            # Per Evan - OK to just remember the first timestamp for a day - this is needed for
-            # DoE Summary
-            self.timestamps[dt] = tm
+            else:
+                self.medianFinders[dt] = MedianFinder()
+                # Per Evan - OK to just remember the first timestamp for a day - this is needed for
+                # DoE Summary
+                self.timestamps[dt] = tm
         # Record a new value for a site we've already seen - the Median Finder accumulates
         # these to eventually find the median.
         self.medianFinders[dt].addNum(val)
-        if verbose:
-            statusCallback('recordValue: recorded %f for %s at %s' % (val, dt, tm))
+        if qualifier:
+            self.qualifiers[dt] = qualifier
+        if self.ctx.verbose:
+            self.ctx.statusCallback('recordValue: recorded %f for %s at %s' % (val, dt, tm))
     
     # Calculate the medians for each date by enumerating the
     # dates for which values have been recorded and using the
@@ -329,105 +734,323 @@ class SiteItemTempMeasurements(object):
     # particular site.  The list has the values for each date.  The timestamps are als
     # a per-date list but just have the first time we encountered on that date - it is
     # for the DoE Logger summary (per Evan, first time is OK)
-    def __init__(self, site, item):
+    def __init__(self, site, item, ctx):
+        self.ctx = ctx
         self.siteName = site
         self.itemName = item
         self.values = defaultdict(defaultdict)      # dictionary of dictionaries indexed by date and time
     
     def recordValue(self, dt, tm, val):
-        global verbose
         self.values[dt][tm] = val
-        if verbose:
-            statusCallback('recordValue: recorded %f for %s at %s' % (val, dt, tm))
+        if self.ctx.verbose:
+            self.ctx.statusCallback('recordValue: recorded %f for %s at %s' % (val, dt, tm))
 
 
 # This list consists of MedianValue objects that record values per-site, per-date for each item marked
-# above as needing a median.  
+# above as needing a median.  emitLogOutputs uses one per site as it writes the outputs.
 class MedianCollector(object):
-    # List of SiteItemMeasurements values
-    siteMeasurementValues = {}
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        # List of SiteItemMeasurements values
+        self.siteMeasurementValues = {}
     
-    def addMeasurement(self, site, dt, tm, item, val):
-        global verbose
-        if verbose:
-            statusCallback('Recording %s as %f' % (item, val))
+    def addMeasurement(self, site, dt, tm, item, val, qualifier=''):
+        if self.ctx.verbose:
+            self.ctx.statusCallback('Recording %s as %f' % (item, val))
         if site not in self.siteMeasurementValues:      # first time we are seeing this site
             self.siteMeasurementValues[site] = {}
         if item not in self.siteMeasurementValues[site]:    # first time for this measurement
             # Don't yet have a tracker for this item for this site - add it
-            self.siteMeasurementValues[site][item] = SiteItemMeasurements(site, item)
+            self.siteMeasurementValues[site][item] = SiteItemMeasurements(site, item, self.ctx)
         # Now record the value for this item on this date at this site
-        self.siteMeasurementValues[site][item].recordValue(dt, tm, val)
+        self.siteMeasurementValues[site][item].recordValue(dt, tm, val, qualifier)
 
-    # Emit the summary files per site with median values
+    # Emit the summary files per site with median values, sorted by site, measurement (in
+    # columnHeaders order) and date
     # if isForDoE - we are emitting the summary for the DoE
     def emitMedianValuesCSV(self, outputCSVSummaryFile, isForDoE):
-        for site, siteCollection in self.siteMeasurementValues.items():
-            for item, itemCollection in siteCollection.items():
-                for dt, medianValue in itemCollection.calcMedians().items():
+        for site in sorted(self.siteMeasurementValues):
+            siteCollection = self.siteMeasurementValues[site]
+            for item in sorted(siteCollection, key=(columnHeaders + derivedLogHeaders).index):
+                itemCollection = siteCollection[item]
+                for dt, medianValue in sorted(itemCollection.calcMedians().items()):
                     if not isForDoE:
                         outputCSVSummaryFile.write('%s,"%s",%s,%f\n' % (site, item, dt, medianValue))
                     else:
                         # DoE Summary is only for certain measurements and has a completely different format
                         # Get the time to report for this date
                         tm = itemCollection.timestamps[dt]
+                        qualifier = itemCollection.qualifiers.get(dt, '')
                         if item in includeInDoESummary.keys():
-                            # <StudyID>,<Site>,<Site>,Measurement,NGO,<Start Date (MM/DD/YYYY),Time (HH:MM:SS,24),,,,,,,,,,,,,,,,Water (col 24),Fresh/Surface Water,,,,,,,,,<parameter>,,,,,<median>,<unit>,,,,,,,,,,,<method>
-                            outputCSVSummaryFile.write('Yellowhawk,"%s","%s",Measurement,NGO,"%s","%s",,,,,,,,,,,,,,,,"Water","Fresh/Surface Water",,,,,,,,,"%s",,,,,%f,"%s",,,,,,,,,,,"%s"\n' % (site, site,dt,tm,includeInDoESummary[item],medianValue,valueUnitsDoESummary[item],methodsDoESummary[item]))
-
-# Process the Temperature data CSV files found.
-# Input CSV files are in two different formats:
-# The first is for the loggers that only collect temperature, they read 
-#
-#"Plot Title: Caldwell_Mouth"
-#"#","Date Time, GMT-07:00","Temp, ?F (LGR S/N: 10360568, SEN S/N: 10360568)","Coupler Detached (LGR S/N: 10360568)","Coupler Attached (LGR S/N: 10360568)","Stopped (LGR S/N: 10360568)","End Of File (LGR S/N: 10360568)"
-#1,11/03/23 02:30:00 AM,68.828,Logged,,,
-#2,11/03/23 03:00:00 AM,67.413,,,,
-#3,11/03/23 03:30:00 AM,69.300,,,,
-#
-# The second file type is for loggers that collect both temperature and dissolved oxygen, they look like:
-#
-#"Plot Title: Yellowhawk Old Milton Hiway"
-#"#","Date Time, GMT-07:00","DO conc, mg/L (LGR S/N: 11009651, SEN S/N: 11009651)","Temp, ?F (LGR S/N: 11009651, SEN S/N: 11009651)","Coupler Attached (LGR S/N: 11009651)","Stopped (LGR S/N: 11009651)","End Of File (LGR S/N: 11009651)"
-#1,05/21/17 01:31:27 PM,11.11,58.10,,,
-#2,05/21/17 02:31:27 PM,10.89,59.43,,,
-#3,05/21/17 03:31:27 PM,10.61,60.58,,,
-#
-# This routine reads both formats and emits a per-site CSV file with this format:
-#
-# Site,"Date Time, GMT-07:00","DO conc, mg/L","Temp, DegF","Source File"
-#
-def processTemperatureFiles(temperatureFiles, logFile, outputFolder):
-
-    global outputCSVSummary
-    global verbose
-    
-    ret = True      # optimistic
-    
-    siteDataFiles = {}       # indexed by site, gives handle of file
-    
-    # Write header for all-up summary that aggregates all sites.
-    outputCSVSummary.write('"Site","Date","Time (GMT-07:00)","DO conc (mg/L)","Temp (DegF)","RawDataFile"\n')
-    
-    try:    
-        # Process each data (temperature) file
-        for file in temperatureFiles:
-            if verbose:
-                statusCallback("=== %s ===\n" % file)
-            logFile.write("=== %s ===\n" % file)
-            if not processTemperatureFile(file, logFile, outputFolder, siteDataFiles):
-                ret = False
-
-    finally:
-        logFile.close()
-        # Close each per-site DoE summary file created
-        for siteDataFile in siteDataFiles:
-                siteDataFiles[siteDataFile].close()
+                            # <StudyID>,<Site>,<Site>,Measurement,NGO,<Start Date (MM/DD/YYYY),Time (HH:MM:SS,24),,,,,,,,,,,,,,,,,Water (col 24),Fresh/Surface Water,,,,,,,,,<parameter>,,,,,<median>,<unit>,,,,,<qualifier>,,,,,,<method>
+                            outputCSVSummaryFile.write('Yellowhawk,"%s","%s",Measurement,NGO,"%s","%s",,,,,,,,,,,,,,,,,"Water","Fresh/Surface Water",,,,,,,,,"%s",,,,,%f,"%s",,,,,"%s",,,,,,"%s"\n' % (site, site,dt,tm,includeInDoESummary[item],medianValue,valueUnitsDoESummary[item],qualifier,methodsDoESummary[item]))
+
+# Which output compressions can be used here
+def availableCompressions():
+    available = ['gzip']
+    if zstandard is not None:
+        available.append('zstd')
+    if lz4 is not None:
+        available.append('lz4')
+    return available
+
+# Name of an output file once compressed
+def compressedPath(path, compression):
+    if compression is None:
+        return path
+    return path + compressionSuffixes[compression]
+
+# The file an earlier run wrote as path, compressed or not - None if there isn't one
+def existingOutputPath(path):
+    for compression in [None] + sorted(compressionSuffixes):
+        if os.path.isfile(compressedPath(path, compression)):
+            return compressedPath(path, compression)
+    return None
+
+# Open a binary compressed stream writing to path
+def openCompressor(path, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(path, 'wb', mtime=0)     # no timestamp, so the same data gives the same file
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    elif compression == 'lz4':
+        return lz4.frame.open(path, 'wb')
+    raise ValueError('Unknown compression: %s' % compression)
+
+# Open a data file written by an earlier run for reading as text, compressed or not
+def openOutputForReading(path):
+    if path.endswith(compressionSuffixes['gzip']):
+        return gzip.open(path, 'rt', newline='')
+    elif path.endswith(compressionSuffixes['zstd']) and zstandard is not None:
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), newline='')
+    elif path.endswith(compressionSuffixes['lz4']) and lz4 is not None:
+        return lz4.frame.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+# Raw binary stream that hands what is written to it to a background thread, which compresses it
+# into the file.  Errors on the thread are raised by the next write or by close.
+class BackgroundCompressor(io.RawIOBase):
+    def __init__(self, path, compression):
+        self.target = openCompressor(path, compression)
+        self.chunks = queue.Queue(maxsize=compressionQueueChunks)
+        self.error = None
+        self.thread = threading.Thread(target=self.compressChunks, daemon=True)
+        self.thread.start()
+
+    def writable(self):
+        return True
 
-    if verbose:
-        statusCallback("Exiting processTemperatureFiles")
-
-    return ret
+    def write(self, data):
+        self.raiseError()
+        self.chunks.put(bytes(data))
+        return len(data)
+
+    def compressChunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.error is None:      # after an error, keep draining so the writer never blocks
+                try:
+                    self.target.write(chunk)
+                except Exception as e:
+                    self.error = e
+        try:
+            self.target.close()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+    def raiseError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise IOError('Error compressing output: %s' % str(error))
+
+    def close(self):
+        if not self.closed:
+            super().close()     # flushes
+            self.chunks.put(None)
+            self.thread.join()
+            self.raiseError()
+
+# Open an output text file - compressed on the fly if compression isn't None.  path should
+# already have the compression suffix (see compressedPath).
+def openOutputText(path, compression):
+    if compression is None:
+        return open(path, 'w')
+    return io.TextIOWrapper(io.BufferedWriter(BackgroundCompressor(path, compression), compressionChunkBytes))
+
+# The sorted runs of a run's data rows (see sortBufferRows).  A row is a (key, data) tuple and
+# runs are merged by key.  Spill files are kept until close, so in watch mode the outputs can be
+# merged again after each batch of new files.  Spill files go to a temporary folder, or to folder
+# if one is given (the checkpoint folder), which is left in place by close.
+class SortedRunStore(object):
+    def __init__(self, folder=None):
+        self.memoryRuns = []
+        self.memoryRows = 0
+        self.spillFiles = []
+        self.sortedFiles = []           # files of rows already in key order that aren't ours (shard bundles)
+        self.tempFolder = folder
+        self.ownsFolder = folder is None
+        self.nSpills = 0                # for naming spill files
+        self.checkpointFiles = set()    # spill files the last checkpoint needs - kept until the next one
+        self.staleFiles = []            # merged spill files waiting for the next checkpoint to be removed
+
+    # Add the rows of one data file
+    def addRun(self, rows):
+        if len(rows) == 0:
+            return
+        rows.sort(key=itemgetter(0))
+        self.memoryRuns.append(rows)
+        self.memoryRows += len(rows)
+        if self.memoryRows >= sortBufferRows:
+            self.spill(heapq.merge(*self.memoryRuns, key=itemgetter(0)))
+            self.memoryRuns = []
+            self.memoryRows = 0
+            if len(self.spillFiles) >= sortMergeFanIn:
+                spillFiles, self.spillFiles = self.spillFiles, []
+                self.spill(heapq.merge(*[self.readSpill(path) for path in spillFiles], key=itemgetter(0)))
+                for path in spillFiles:
+                    if path in self.checkpointFiles:
+                        self.staleFiles.append(path)
+                    else:
+                        os.remove(path)
+
+    # Write sorted rows to a new spill file
+    def spill(self, rows):
+        if self.tempFolder is None:
+            self.tempFolder = tempfile.mkdtemp(prefix='StreamDataRuns')
+        elif not os.path.isdir(self.tempFolder):
+            os.makedirs(self.tempFolder)
+        path = os.path.join(self.tempFolder, 'run%d' % self.nSpills)
+        self.nSpills += 1
+        with open(path, 'wb') as spillFile:
+            for row in rows:
+                pickle.dump(row, spillFile, pickle.HIGHEST_PROTOCOL)
+        self.spillFiles.append(path)
+
+    def readSpill(self, path):
+        with open(path, 'rb') as spillFile:
+            while True:
+                try:
+                    yield pickle.load(spillFile)
+                except EOFError:
+                    return
+
+    # Add a file of rows already in key order, in the spill file format - e.g. a shard bundle's rows.
+    # It is only read, never merged into a spill file or removed.
+    def addSortedFile(self, path):
+        self.sortedFiles.append(path)
+
+    # All the rows added so far, in key order
+    def merged(self):
+        return heapq.merge(*([self.readSpill(path) for path in self.sortedFiles + self.spillFiles] + self.memoryRuns), key=itemgetter(0))
+
+    # Spill the runs still in memory, so all the rows are in spill files, and return what a
+    # checkpoint needs to restore the store: (spill file names, number of spills so far)
+    def checkpoint(self):
+        if len(self.memoryRuns) > 0:
+            self.spill(heapq.merge(*self.memoryRuns, key=itemgetter(0)))
+            self.memoryRuns = []
+            self.memoryRows = 0
+        return [os.path.basename(path) for path in self.spillFiles], self.nSpills
+
+    # The checkpoint has been saved - the spill files merged away since the last one can go
+    def checkpointSaved(self):
+        for path in self.staleFiles:
+            os.remove(path)
+        self.staleFiles = []
+        self.checkpointFiles = set(self.spillFiles)
+
+    # Pick up the spill files of a checkpoint, removing any written after it was saved
+    def restore(self, spillNames, nSpills):
+        self.spillFiles = [os.path.join(self.tempFolder, name) for name in spillNames]
+        self.nSpills = nSpills
+        self.checkpointFiles = set(self.spillFiles)
+        for name in os.listdir(self.tempFolder):
+            if name.startswith('run') and name not in spillNames:
+                os.remove(os.path.join(self.tempFolder, name))
+
+    def close(self):
+        self.memoryRuns = []
+        self.spillFiles = []
+        self.sortedFiles = []
+        if self.tempFolder is not None and self.ownsFolder:
+            shutil.rmtree(self.tempFolder, ignore_errors=True)
+            self.tempFolder = None
+
+# The path of part partNumber (from 1) of the EIM file path - see EIMFileWriter
+def eimPartPath(path, partNumber, compression):
+    if partNumber == 1:
+        return compressedPath(path, compression)
+    base, ext = os.path.splitext(path)
+    return compressedPath('%s_part%d%s' % (base, partNumber, ext), compression)
+
+# Writes an EIM CSV, rolling over to a new part file whenever the next row would take the
+# current part past maxRows data rows or maxBytes bytes (before any compression).  The first part has the name asked for,
+# later ones have _part2, _part3... added, and each part starts with the header row.  Rows are
+# written straight through, so nothing is buffered or read back.  Parts left over from an
+# earlier run to the same file are removed.  The path of each part is added to outputPaths, if
+# it is given (see RunContext.outputPaths).
+class EIMFileWriter(object):
+    def __init__(self, path, headers, maxRows=0, maxBytes=0, compression=None, outputPaths=None):
+        self.path = path
+        self.compression = compression
+        self.outputPaths = outputPaths
+        self.headerLine = ''.join(item+',' for item in headers) + '\n'
+        self.maxRows = maxRows
+        self.maxBytes = maxBytes
+        self.file = None
+        self.partNumber = 0
+        self.removeLaterParts()
+        self.openPart(1)
+
+    def partPath(self, partNumber):
+        return eimPartPath(self.path, partNumber, self.compression)
+
+    # The paths of the parts written so far
+    def partPaths(self):
+        return [self.partPath(partNumber) for partNumber in range(1, self.partNumber + 1)]
+
+    # Size of text on disk - newlines are \r\n on Windows
+    def textBytes(self, text):
+        return len(text.encode(self.file.encoding, 'replace')) + text.count('\n') * (len(os.linesep) - 1)
+
+    def removeLaterParts(self):
+        partNumber = 2
+        while os.path.exists(self.partPath(partNumber)):
+            os.remove(self.partPath(partNumber))
+            partNumber += 1
+
+    def openPart(self, partNumber):
+        if self.file is not None:
+            self.file.close()
+        self.partNumber = partNumber
+        self.file = openOutputText(self.partPath(partNumber), self.compression)
+        if self.outputPaths is not None:
+            self.outputPaths.append(self.partPath(partNumber))
+        self.file.write(self.headerLine)
+        self.nRows = 0
+        self.nBytes = self.textBytes(self.headerLine)
+
+    # Write one complete row
+    def write(self, row):
+        rowBytes = self.textBytes(row)
+        if self.nRows > 0 and ((self.maxRows > 0 and self.nRows >= self.maxRows) or
+                               (self.maxBytes > 0 and self.nBytes + rowBytes > self.maxBytes)):
+            self.openPart(self.partNumber + 1)
+        self.file.write(row)
+        self.nRows += 1
+        self.nBytes += rowBytes
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 # Mapping of temperature site names in data files to output site names
 def mapTemperatureSiteName(siteName):
@@ -475,21 +1098,40 @@ def mapTemperatureSiteName(siteName):
     return temperatureSiteMap.get(siteName.replace(' ','_'), None)
 
 
-# Process one raw data temperature file 
-def processTemperatureFile(rawDataFile, logFile, outputFolder, siteDataFiles):
+# Process one raw data temperature file, adding its rows to ctx.sortedRuns.
+# Input CSV files are in two different formats:
+# The first is for the loggers that only collect temperature, they read 
+#
+#"Plot Title: Caldwell_Mouth"
+#"#","Date Time, GMT-07:00","Temp, ?F (LGR S/N: 10360568, SEN S/N: 10360568)","Coupler Detached (LGR S/N: 10360568)","Coupler Attached (LGR S/N: 10360568)","Stopped (LGR S/N: 10360568)","End Of File (LGR S/N: 10360568)"
+#1,11/03/23 02:30:00 AM,68.828,Logged,,,
+#2,11/03/23 03:00:00 AM,67.413,,,,
+#3,11/03/23 03:30:00 AM,69.300,,,,
+#
+# The second file type is for loggers that collect both temperature and dissolved oxygen, they look like:
+#
+#"Plot Title: Yellowhawk Old Milton Hiway"
+#"#","Date Time, GMT-07:00","DO conc, mg/L (LGR S/N: 11009651, SEN S/N: 11009651)","Temp, ?F (LGR S/N: 11009651, SEN S/N: 11009651)","Coupler Attached (LGR S/N: 11009651)","Stopped (LGR S/N: 11009651)","End Of File (LGR S/N: 11009651)"
+#1,05/21/17 01:31:27 PM,11.11,58.10,,,
+#2,05/21/17 02:31:27 PM,10.89,59.43,,,
+#3,05/21/17 03:31:27 PM,10.61,60.58,,,
+#
+# This routine reads both formats and emits a per-site CSV file with this format:
+#
+# Site,"Date Time, GMT-07:00","DO conc, mg/L","Temp, DegF","Source File"
+def processTemperatureFile(ctx, rawDataFile):
     
-    global sites
-    global outputCSVSummary
-    global DoEOutputOption
-    global verbose
+    logFile = ctx.outputLogFile
 
     nRows = 0           # Number rows written to output
     ret = True
+    records = []        # this file's data rows, which become a sorted run in ctx.sortedRuns
+    days = set()        # ordinals of the days the file has data for
     
-    statusCallback('\nProcessing '+rawDataFile)
+    ctx.statusCallback('\nProcessing '+rawDataFile)
 
     try:
-        with open(rawDataFile) as csvfile:
+        with openDataText(rawDataFile) as csvfile:
             datarows = csv.reader(csvfile)
             for row in datarows:
                 if nRows == 0:      # Site name - after "Plot Name: " on first row.  Sigh.
@@ -507,10 +1149,10 @@ def processTemperatureFile(rawDataFile, logFile, outputFolder, siteDataFiles):
                         siteName = siteName[:-1]
                     # Use the mapping list to standardize sitenames
                     newSiteName = mapTemperatureSiteName(siteName)
-                    statusCallback ('Site name in data file {} => {}'.format(siteName,newSiteName))
+                    ctx.statusCallback ('Site name in data file {} => {}'.format(siteName,newSiteName))
                     # Fix - 8/30/2019 - if site name not in mapping, just use site name from data file
                     if newSiteName is None:
-                        statusCallback('No mapping for site name, using name in raw data file')
+                        ctx.statusCallback('No mapping for site name, using name in raw data file')
                         logFile.write('No mapping for site name "{}", using name in raw data\n'.format(siteName))
                     else:
                         siteName = newSiteName
@@ -523,9 +1165,11 @@ def processTemperatureFile(rawDataFile, logFile, outputFolder, siteDataFiles):
                             if row[2][:2] == "DO":
                                 # Flavor with DO in row
                                 hasDO = True
+                                ctx.fileFormat = 'HOBO DO and temperature'
                             elif nRows == 1 and row[2][:4] == "Temp":
                                 # Flavor with only temperature
                                 hasDO = False
+                                ctx.fileFormat = 'HOBO temperature'
                             else:
                                 # Some other format
                                 ret = False
@@ -544,22 +1188,10 @@ def processTemperatureFile(rawDataFile, logFile, outputFolder, siteDataFiles):
                         ret = False
                         
                     if not ret:
-                        statusCallback('CSV has non-standard format - skipping file')
+                        ctx.statusCallback('CSV has non-standard format - skipping file')
                         logFile.write('CSV has non-standard format - skipping file\n')
                     elif nRows > 1:
-                        # Skip first two rows that are headers - emit data for rows 2... n
-                        # Have we seen this site before, i.e. do we have a file for it?
-                        if siteName not in siteDataFiles:
-                            if DoEOutputOption:
-                                todaysDate = time.strftime("%m/%d/%Y")                            
-                                # First time we've seen this site - create a file and emit the header
-                                siteTemperatureFilePath = os.path.join(outputFolder, siteName + "_Temperature_EIM"+todaysDate+".csv")
-                                siteDataFiles[siteName] = open(siteTemperatureFilePath, 'w')
-                                # Write the CSV header row for the 
-                                # per-site DoE Summary
-                                for item in outputCSVDoETemperatureHeaders:
-                                    siteDataFiles[siteName].write(item+',')
-                                siteDataFiles[siteName].write('\n')
+                        # Skip first two rows that are headers - keep data for rows 2... n
                         # Handle some data mappings and split out date and time
                         specialSites = [ "YELMO" , "YELRU" , "YELPR" ]
                         if siteName in specialSites:
@@ -571,121 +1203,524 @@ def processTemperatureFile(rawDataFile, logFile, outputFolder, siteDataFiles):
                             dttime = parse(row[1])
                             dt = dttime.strftime("%m-%d-%Y")
                             tm = dttime.strftime("%H:%M:%S")
+                            sortTime = dttime.strftime("%Y-%m-%d %H:%M:%S")
+                            days.add(dttime.toordinal())
                         except ValueError:
                             dt = ""
                             tm = ""
-
-                        # Write to the all-up summary that isn't for the DoE
-                        outputCSVSummary.write('{},{},{},{},{},{}\n'.format(siteName, dt, tm, temp, do, rawDataFile))
-                        
-                        # Write to DoE Summary file - different format, one line per measurement for DO and temp
-                        # If DO is present in input data, emit rows for both DO and temp
-                        if DoEOutputOption:
-                            if hasDO:
-                                # Yellowhawk,<Instrument>,<Site>,<Site>,Measurement,NGO,,,,Water,Fresh/Surface Water,<Start Date (MM/DD/YYYY),Time (HH:MM:SS,24),,,<parameter>,<val>,<unit>,<method>
-                                siteDataFiles[siteName].write('Yellowhawk,"%s","%s","%s",Measurement,NGO,,,,"Water","Fresh/Surface Water","%s","%s",,,"%s","%s","%s",,"DO-OPTICAL"\n' % (instrumentID, siteName, siteName, dt,tm,"Dissolved Oxygen",do,"mg/L"))
-                            #Temp
-                            siteDataFiles[siteName].write(    'Yellowhawk,"%s","%s","%s",Measurement,NGO,,,,"Water","Fresh/Surface Water","%s","%s",,,"%s","%s","%s",,"TEMPLOGGER"\n' % (instrumentID, siteName, siteName, dt,tm,"Temperature, water",temp,"deg F"))
+                            sortTime = ""
+
+                        # Non-numeric cells (e.g. '-----') are missing values - leave them blank
+                        # and don't emit a DoE row for them
+                        if parseMeasurement(do) is None:
+                            do = ""
+                        if parseMeasurement(temp) is None:
+                            temp = ""
+
+                        # The row for the all-up summary that isn't for the DoE, and what the DoE
+                        # rows need - they are written once all the files are read (see emitTemperatureOutputs)
+                        summaryLine = '{},{},{},{},{},{}'.format(siteName, dt, tm, do, temp, rawDataFile)
+                        records.append(((siteName, sortTime, rawDataFile, nRows), (summaryLine, dt, tm, instrumentID, do, temp)))
                         ret = True
                 nRows += 1
                 time.sleep(0)     # yield
                 
                 # If encountered a format error - skip out
                 if not ret:
-                    return ret
+                    break
                 
     except csv.Error as e:
-        statusCallback('Error opening CSV file: %s\n' % (str(e)))
+        ctx.statusCallback('Error opening CSV file: %s\n' % (str(e)))
         logFile.write('Error opening CSV file {} (line {}): {}\n'.format(rawDataFile, datarows.line_num, e))
         ret = False
+
+    # The rows read before a format error are passed on with the rest, but the file is then
+    # rejected and readDataFiles leaves them out.  Any other exception leaves them out here.
+    if len(records) > 0:
+        minDate = datetime.date.fromordinal(min(days)) if days else datetime.date.max
+        maxDate = datetime.date.fromordinal(max(days)) if days else datetime.date.min
+        siteData = SiteData(rawDataFile, minDate=minDate, maxDate=maxDate, numRecs=len(records), days=days)
+        ctx.sites.setdefault(records[0][0][0], []).append(siteData)
+    ctx.sortedRuns.addRun(records)
         
     if ret:
-        statusCallback('%d data rows read.' % nRows)
+        ctx.statusCallback('%d data rows read.' % nRows)
         logFile.write('%d data rows read.\n' % nRows)
+        ctx.nDataRows += max(nRows - 2, 0)      # the first two rows are headers
         
     return ret
 
+#
+# DERIVED PARAMETERS
+#
+# Each of these takes whole columns as lists of floats, NaN for a missing value, and returns the
+# derived column, NaN wherever an input was missing
+def fahrenheitToCelsius(tempF):
+    if numpy is not None:
+        return ((numpy.asarray(tempF, dtype=numpy.float64) - 32.0) * (5.0 / 9.0)).tolist()
+    return [(value - 32.0) * (5.0 / 9.0) for value in tempF]
+
+def celsiusToFahrenheit(tempC):
+    if numpy is not None:
+        return (numpy.asarray(tempC, dtype=numpy.float64) * (9.0 / 5.0) + 32.0).tolist()
+    return [value * (9.0 / 5.0) + 32.0 for value in tempC]
+
+# Conductivity at the water temperature to specific conductance (at 25 deg C).  Impossible
+# temperatures give an infinite value, which derivedText leaves blank.
+def specificConductance(conductivity, tempC):
+    if numpy is not None:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return (numpy.asarray(conductivity, dtype=numpy.float64) /
+                    (1.0 + conductivityTempCoefficient * (numpy.asarray(tempC, dtype=numpy.float64) - 25.0))).tolist()
+    values = []
+    for value, temp in zip(conductivity, tempC):
+        compensation = 1.0 + conductivityTempCoefficient * (temp - 25.0)
+        values.append(value / compensation if compensation != 0 else math.inf)
+    return values
+
+# ln of the saturation DO concentration (mg/L) at kelvin - Benson and Krause (1984)
+def oxygenSaturationLog(kelvin):
+    return -139.34411 + 1.575701e5 / kelvin - 6.642308e7 / kelvin ** 2 + 1.243800e10 / kelvin ** 3 - 8.621949e11 / kelvin ** 4
+
+# DO concentration (mg/L) to percent saturation
+def oxygenSaturationPercent(oxygen, tempC):
+    if numpy is not None:
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            saturation = numpy.exp(oxygenSaturationLog(numpy.asarray(tempC, dtype=numpy.float64) + 273.15))
+            return (100.0 * numpy.asarray(oxygen, dtype=numpy.float64) / saturation).tolist()
+    percents = []
+    for value, temp in zip(oxygen, tempC):
+        try:
+            percents.append(100.0 * value / math.exp(oxygenSaturationLog(temp + 273.15)))
+        except OverflowError:       # saturation too big to hold, as numpy gives
+            percents.append(0.0)
+        except ZeroDivisionError:
+            percents.append(math.nan)
+    return percents
+
+# Derived parameters for a batch of HI-9829 rows, 1:1 with derivedLogHeaders
+def deriveLogValues(batch):
+    tempC = []
+    conductivity = []
+    for key, (line, strDate, strTime, measurements) in batch:
+        values = dict(measurements)
+        tempC.append(values.get('Temp.[C]', math.nan))
+        conductivity.append(values.get('EC[uS/cm]', math.nan))
+    return [celsiusToFahrenheit(tempC), specificConductance(conductivity, tempC)]
+
+# Derived parameters for a batch of HOBO rows, 1:1 with derivedTemperatureHeaders
+def deriveTemperatureValues(batch):
+    tempF = []
+    oxygen = []
+    for key, (summaryLine, dt, tm, instrumentID, do, temp) in batch:
+        tempF.append(float(temp) if temp != '' else math.nan)
+        oxygen.append(float(do) if do != '' else math.nan)
+    tempC = fahrenheitToCelsius(tempF)
+    return [tempC, oxygenSaturationPercent(oxygen, tempC)]
+
+# Add derived parameters to a stream of (key, data) rows - yields (key, data, derived values), the
+# derived values worked out by derive a batch of derivedBatchRows rows at a time
+def withDerivedValues(rows, derive):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == derivedBatchRows:
+            for (key, data), derived in zip(batch, zip(*derive(batch))):
+                yield key, data, derived
+            batch = []
+    if len(batch) > 0:
+        for (key, data), derived in zip(batch, zip(*derive(batch))):
+            yield key, data, derived
+
+# A derived value as CSV text - blank if it is missing (or couldn't be worked out)
+def derivedText(value, decimals):
+    if math.isnan(value) or math.isinf(value):
+        return ''
+    return '%.*f' % (decimals, value)
+
+# Write the temperature outputs from the sorted runs of data rows: the all-up summary CSV and,
+# for the DoE, a file per site with a row per measurement.  The rows are grouped by site, so
+# only one site's DoE file is open at a time.  QC is done here, in sorted order, so it comes out
+# the same whatever order the files were read in.
+def emitTemperatureOutputs(ctx, keptSites=()):
+    outputFolder = ctx.outputFolder
+    outputSummaryPath = compressedPath(os.path.join(outputFolder, 'TemperatureData.CSV'), ctx.compression)
+    ctx.qualityChecker = QualityChecker(ctx.qcWindowSize, ctx.qcThreshold, qcMinReadings)
+    todaysDate = time.strftime("%m-%d-%Y")
+
+    try:
+        ctx.outputCSVSummary = openOutputText(outputSummaryPath, ctx.compression)
+        ctx.outputPaths.append(outputSummaryPath)
+    except IOError as e:
+        ctx.statusCallback('Error opening '+outputSummaryPath+': '+str(e))
+        raise
+    # Write header for all-up summary that aggregates all sites.
+    ctx.outputCSVSummary.write('"Site","Date","Time (GMT-07:00)","DO conc (mg/L)","Temp (DegF)","RawDataFile"' +
+                               ''.join(',"%s"' % header for header in derivedTemperatureHeaders) + '\n')
+
+    qualityChecker = ctx.qualityChecker
+    write = ctx.outputCSVSummary.write
+    rollups = openRollups(ctx, temperatureRollupParameters.index, keptSites)
+    eimSite = None
+    siteDataFile = None
+    nFlagged = 0        # values flagged before the site's EIM file was started
+    for key, (summaryLine, dt, tm, instrumentID, do, temp), (tempC, doSaturation) in withDerivedValues(ctx.sortedRuns.merged(), deriveTemperatureValues):
+        siteName = key[0]
+        readings = []
+        if do != "":
+            readings.append(('DO conc (mg/L)', float(do)))
+        if temp != "":
+            readings.append(('Temp (DegF)', float(temp)))
+        if math.isfinite(tempC):
+            readings.append(('Temp (DegC)', tempC))
+        if math.isfinite(doSaturation):
+            readings.append(('DO sat (%)', doSaturation))
+        rollups.addReadings(siteName, key[1][:10], readings)
+        doSaturation = derivedText(doSaturation, 1)
+        write('%s,%s,%s\n' % (summaryLine, derivedText(tempC, 3), doSaturation))
+        if not ctx.DoEOutputOption:
+            continue
+
+        # First row for this site - create its file, which starts with the header, unless the file
+        # already written is kept
+        if siteName != eimSite:
+            finishSiteEIMFile(ctx, eimSite, siteDataFile, nFlagged)
+            eimSite = siteName
+            siteDataFile = None
+            if siteName not in keptSites or not keepSiteEIMFile(ctx, siteName, todaysDate):
+                siteDataFile = ctx.siteDataFiles[siteName] = EIMFileWriter(siteEIMPath(ctx, siteName, todaysDate), outputCSVDoETemperatureHeaders,
+                                                                           ctx.eimMaxRows, ctx.eimMaxBytes, ctx.compression,
+                                                                           ctx.outputPaths)
+                nFlagged = qualityChecker.nFlagged
+        if siteDataFile is None:
+            continue
+
+        # DoE Summary file - different format, one line per measurement for DO and temp
+        # If DO is present in input data, emit rows for both DO and temp
+        if do != "":
+            qualifier = qualityChecker.check(siteName, "Dissolved Oxygen", float(do))
+            # Yellowhawk,<Instrument>,<Site>,<Site>,Measurement,NGO,,,,Water,Fresh/Surface Water,<Start Date (MM/DD/YYYY),Time (HH:MM:SS,24),,,<parameter>,<val>,<unit>,<qualifier>,<method>
+            siteDataFile.write('Yellowhawk,"%s","%s","%s",Measurement,NGO,,,,"Water","Fresh/Surface Water","%s","%s",,,"%s","%s","%s","%s","DO-OPTICAL"\n' % (instrumentID, siteName, siteName, dt,tm,"Dissolved Oxygen",do,"mg/L",qualifier))
+        # DO saturation, derived from DO and temp
+        if doSaturation != "":
+            qualifier = qualityChecker.check(siteName, "Dissolved Oxygen Percent Saturation", float(doSaturation))
+            siteDataFile.write('Yellowhawk,"%s","%s","%s",Measurement,NGO,,,,"Water","Fresh/Surface Water","%s","%s",,,"%s","%s","%s","%s","DO-OPTICAL"\n' % (instrumentID, siteName, siteName, dt,tm,"Dissolved Oxygen Percent Saturation",doSaturation,"%",qualifier))
+        #Temp
+        if temp != "":
+            qualifier = qualityChecker.check(siteName, "Temperature, water", float(temp))
+            siteDataFile.write(    'Yellowhawk,"%s","%s","%s",Measurement,NGO,,,,"Water","Fresh/Surface Water","%s","%s",,,"%s","%s","%s","%s","TEMPLOGGER"\n' % (instrumentID, siteName, siteName, dt,tm,"Temperature, water",temp,"deg F",qualifier))
+
+    finishSiteEIMFile(ctx, eimSite, siteDataFile, nFlagged)
+    ctx.outputCSVSummary.close()
+    ctx.outputCSVSummary = None
+    closeRollups(ctx, rollups)
+
+# The path of a site's temperature EIM file written on date (MM-DD-YYYY)
+def siteEIMPath(ctx, site, date):
+    return os.path.join(ctx.outputFolder, site + "_Temperature_EIM" + date + ".csv")
+
+# Close the EIM file of site, if it was written, and remember its parts and how many of its values
+# were flagged, counting from nFlaggedBefore - see keepSiteEIMFile
+def finishSiteEIMFile(ctx, site, siteDataFile, nFlaggedBefore):
+    if siteDataFile is None:
+        return
+    siteDataFile.close()
+    ctx.siteDataFiles = {}
+    ctx.siteEIMFiles[site] = (siteDataFile.partPaths(), ctx.qualityChecker.nFlagged - nFlaggedBefore)
+
+# Keep the EIM file of a site written by an earlier batch in watch mode, instead of writing the
+# same rows again - renamed for date, if it was written on another day.  Its flagged values are
+# counted as if they were checked again.  Returns False if there isn't one to keep.
+def keepSiteEIMFile(ctx, site, date):
+    if site not in ctx.siteEIMFiles:
+        return False
+    paths, nFlagged = ctx.siteEIMFiles[site]
+    if not all(os.path.isfile(path) for path in paths):
+        return False
+    newPaths = [eimPartPath(siteEIMPath(ctx, site, date), partNumber, ctx.compression) for partNumber in range(1, len(paths) + 1)]
+    for path, newPath in zip(paths, newPaths):
+        if newPath != path:
+            os.replace(path, newPath)
+    ctx.siteEIMFiles[site] = (newPaths, nFlagged)
+    ctx.qualityChecker.nFlagged += nFlagged
+    return True
+
 #
 # LOGGER FILES
 #
-# Process the log files found
-def processLogFiles(outputLogFile, logFiles):
-    global outputCSVSummary
-    global outputCSVDoE
-    global DoEOutputOption
-    
-    ret = True      # optimistic
-    
-    skip_these = (
-        "WARNING *** OLE2 inconsistency",
-        )
-    try:        
-        xlrdLogFile = XlrdLogFileFilter(outputLogFile, skip_these)
-        
-        # Write the CSV header row
-        outputCSVSummary.write('Site, RawDataFile,')
-        for colName in columnHeaders:
-            outputCSVSummary.write(colName+',')
-        outputCSVSummary.write('\n')
+# xlrd warnings that aren't worth putting in the log
+xlrdWarningsToSkip = (
+    "WARNING *** OLE2 inconsistency",
+    )
+
+# Write the logger outputs from the sorted runs of data rows: the summary CSV with the data rows
+# followed by the medians for each measurement, and the DoE summary CSV.  QC and the medians are
+# done here, in sorted order, so they come out the same whatever order the files were read in.
+# The rows are grouped by site, so only one site's values for the medians are held at a time.
+def emitLogOutputs(ctx, keptSites=()):
+    outputFolder = ctx.outputFolder
+    outputSummaryPath = compressedPath(os.path.join(outputFolder, 'StreamData.CSV'), ctx.compression)
+    outputCSVDoE = None
+    ctx.qualityChecker = QualityChecker(ctx.qcWindowSize, ctx.qcThreshold, qcMinReadings)
+    medianSection = io.StringIO()
 
-        medianCollector = MedianCollector()       
-        
-        # Process each data (log) file
-        for file in logFiles:
-            outputLogFile.write("=== %s ===\n" % file)
-            if not processLogFile(file, xlrdLogFile, medianCollector):
-                outputLogFile.write('Error processing %s\n' % file)
-                ret = False
-            sleep(0.5)
-    except Exception as e:
-        outputLogFile.write("Error - %s\n", str(e))
-        ret = False 
-        
-    # Emit the median values for each measurement to the CSV
-    outputCSVSummary.write('\n\nMEDIAN VALUES\nSite,Measurement,Date,Median\n')
-    medianCollector.emitMedianValuesCSV(outputCSVSummary,False)
-    
-    # Write the DoE summary CSV
-    if DoEOutputOption:
-        for item in outputCSVDoEHeaders:
-            outputCSVDoE.write(item+',')
-        outputCSVDoE.write('\n')    
-        medianCollector.emitMedianValuesCSV(outputCSVDoE,True)
+    try:
+        ctx.outputCSVSummary = openOutputText(outputSummaryPath, ctx.compression)
+        ctx.outputPaths.append(outputSummaryPath)
+        if ctx.DoEOutputOption:
+            todaysDate = time.strftime("%m-%d-%Y")
+            outputDoESummaryPath = os.path.join(outputFolder, 'HI-9829_EIM_'+todaysDate+'.CSV')
+            ctx.outputCSVDoE = outputCSVDoE = EIMFileWriter(outputDoESummaryPath, outputCSVDoEHeaders, ctx.eimMaxRows,
+                                                            ctx.eimMaxBytes, ctx.compression, ctx.outputPaths)
+    except IOError as e:
+        ctx.statusCallback('Error opening output files in '+outputFolder+': '+str(e))
+        raise
+
+    # Write the CSV header row
+    ctx.outputCSVSummary.write('Site, RawDataFile,')
+    for colName in columnHeaders + derivedLogHeaders:
+        ctx.outputCSVSummary.write(colName+',')
+    ctx.outputCSVSummary.write('\n')
+
+    qualityChecker = ctx.qualityChecker
+    write = ctx.outputCSVSummary.write
+    rollups = openRollups(ctx, (columnHeaders + derivedLogHeaders).index, keptSites)
+    medianCollector = None      # for the site being read
+    medianSite = None
+    for key, (line, strDate, strTime, measurements), derived in withDerivedValues(ctx.sortedRuns.merged(), deriveLogValues):
+        siteName = key[0]
+        if medianCollector is None or siteName != medianSite:
+            if medianCollector is not None:
+                emitSiteMedians(medianCollector, medianSection, outputCSVDoE)
+            medianCollector = MedianCollector(ctx)
+            medianSite = siteName
+        tempF, specificCond = derived
+        write('%s,%s,%s\n' % (line, derivedText(tempF, 3), derivedText(specificCond, 1)))
+        measurements = list(measurements)
+        for item, value in zip(derivedLogHeaders, derived):
+            if not (math.isnan(value) or math.isinf(value)):
+                measurements.append((item, value))
+        for item, value in measurements:
+            qualifier = qualityChecker.check(siteName, item, value)
+            medianCollector.addMeasurement(siteName, strDate, strTime, item, value, qualifier)
+        rollups.addReadings(siteName, strDate, measurements)
+    if medianCollector is not None:
+        emitSiteMedians(medianCollector, medianSection, outputCSVDoE)
+
+    write('\n\nMEDIAN VALUES\nSite,Measurement,Date,Median\n')
+    write(medianSection.getvalue())
+    ctx.outputCSVSummary.close()
+    ctx.outputCSVSummary = None
+    if outputCSVDoE is not None:
+        outputCSVDoE.close()
+        ctx.outputCSVDoE = None
+    closeRollups(ctx, rollups)
+
+# Emit one site's medians to the median section of the summary and the DoE summary
+def emitSiteMedians(medianCollector, medianSection, outputCSVDoE):
+    medianCollector.emitMedianValuesCSV(medianSection, False)
+    if outputCSVDoE is not None:
+        medianCollector.emitMedianValuesCSV(outputCSVDoE, True)
+
+# The HI-9829 column layouts - each is picked by the text in some of the header cells of the data
+# sheet (its signature) and says which column of the sheet goes in each column of the standard
+# layout (columnHeaders).  They are kept in layoutRegistryFileName, next to this script, so a new
+# firmware layout only needs an entry there:
+#
+#   { "name" : "HI-9829 no mV[pH]", "signature" : { "5" : "D.O.[%]" },
+#     "columns" : [0, 1, 2, 3, null, 4, 5, 6, 7, 8] }
+#
+# signature is header text by column (counting from 0), columns has a sheet column number (or null
+# for a blank column) for each column of the standard layout, starting with Date and Time.
+layoutRegistryFileName = 'InstrumentLayouts.json'
+
+# Where the layout registry is by default - next to this script, or to the executable in the
+# frozen GUI build
+def defaultLayoutFile():
+    if getattr(sys, 'frozen', False):
+        return os.path.join(os.path.dirname(sys.executable), layoutRegistryFileName)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), layoutRegistryFileName)
+
+class InstrumentLayout(object):
+    def __init__(self, name, signature, columns):
+        self.name = name
+        self.signature = signature      # sorted list of (column, header text)
+        self.columns = columns
+        self.extractors = {}            # compiled extractors, indexed by number of sheet columns
+
+    # True if the sheet's columns are already in the standard order
+    def isStandard(self):
+        return self.columns == list(range(len(self.columns)))
+
+    # The row extractor for sheets with numColumns columns - compiled the first time it is
+    # needed and reused for every file with this layout
+    def extractorFor(self, numColumns):
+        extractor = self.extractors.get(numColumns)
+        if extractor is None:
+            extractor = self.extractors[numColumns] = LayoutRowExtractor(self, numColumns)
+        return extractor
+
+# The layouts from a registry file.  Layouts are grouped by the header columns their signatures
+# look at, and within a group looked up by the header text in those columns, so matching a
+# header is a dictionary lookup per group rather than a comparison per layout.  Groups are tried
+# in the order they first appear in the file.
+class LayoutRegistry(object):
+    def __init__(self, layouts):
+        self.layouts = layouts
+        self.signatureGroups = []       # list of ([columns], {(header text, ...): layout})
+        groups = {}
+        for layout in layouts:
+            signatureColumns = tuple(column for column, text in layout.signature)
+            if signatureColumns not in groups:
+                groups[signatureColumns] = {}
+                self.signatureGroups.append((signatureColumns, groups[signatureColumns]))
+            key = tuple(text for column, text in layout.signature)
+            if key in groups[signatureColumns]:
+                raise ValueError('layouts "%s" and "%s" have the same signature' % (groups[signatureColumns][key].name, layout.name))
+            groups[signatureColumns][key] = layout
+
+    # The layout for a header row of (ctype, value) cells, or None
+    def match(self, header):
+        for signatureColumns, layouts in self.signatureGroups:
+            if signatureColumns[-1] >= len(header):
+                continue
+            key = tuple(header[column][1] if header[column][0] == 1 else None for column in signatureColumns)
+            layout = layouts.get(key)
+            if layout is not None:
+                return layout
+        return None
 
-    return ret
+# Load a layout registry file - raises IOError or ValueError if it can't be read or makes no sense
+def loadLayoutRegistry(path):
+    with open(path, encoding='utf-8') as layoutFile:
+        registry = json.load(layoutFile)
+    layouts = []
+    for entry in registry.get('layouts', []):
+        name = entry.get('name', '?')
+        try:
+            signature = sorted((int(column), text) for column, text in entry['signature'].items())
+            columns = entry['columns']
+        except (KeyError, AttributeError, ValueError):
+            raise ValueError('layout "%s" in %s needs a signature and columns' % (name, path))
+        if len(signature) == 0 or any(not isinstance(text, str) for column, text in signature):
+            raise ValueError('layout "%s" in %s has a bad signature' % (name, path))
+        if (len(columns) < 2 or len(columns) > len(columnHeaders) or columns[:2] != [0, 1] or
+                any(column is not None and (not isinstance(column, int) or column < 0) for column in columns)):
+            raise ValueError('layout "%s" in %s: columns must start with 0, 1 (Date, Time) and have at most %d entries'
+                             % (name, path, len(columnHeaders)))
+        layouts.append(InstrumentLayout(name, signature, columns))
+    if len(layouts) == 0:
+        raise ValueError('no layouts in %s' % path)
+    return LayoutRegistry(layouts)
+
+# What a LayoutRowExtractor needs to know about the workbook it is reading, and what it
+# accumulates from it
+class LogWorkbookRows(object):
+    def __init__(self, ctx, siteName, rawDataFile, xlrdLog):
+        self.ctx = ctx
+        self.siteName = siteName
+        self.rawDataFile = rawDataFile
+        self.xlrdLog = xlrdLog
+        self.prefix = siteName+','+rawDataFile+','      # each row starts with the site and file name
+        self.rowIndex = 0
+        self.strDate = None
+        self.strTime = None
+        self.earliestDateSeen = datetime.date.max        # set to HIGHEST date so the first one we encounter is less
+        self.latestDateSeen = datetime.date.min
+        self.days = set()       # ordinals of the days seen
+
+# A layout compiled for sheets with a given number of columns: which sheet column each output
+# column comes from, whether it is blank or missing on these sheets and whether it has medians
+# are all worked out once here, so extractRow only has to go through the plan.
+class LayoutRowExtractor(object):
+    def __init__(self, layout, numColumns):
+        self.plan = []      # (sheet column or None for blank, item to calculate medians for or None)
+        for outputIndex in range(len(columnHeaders)):
+            columnIndex = layout.columns[outputIndex] if outputIndex < len(layout.columns) else None
+            if columnIndex is None or columnIndex >= numColumns:
+                # emit a blank column - this isn't in source sheet, so the columns after it still line up
+                self.plan.append((None, None))
+            else:
+                medianItem = columnHeaders[outputIndex] if calculateMedians[outputIndex] else None
+                self.plan.append((columnIndex, medianItem))
+
+    # The summary CSV line for one data row (a list of (ctype, value) cells), without the line
+    # end so derived values can be added, and a list of (item, value) for the values it has that
+    # medians are calculated for
+    def extractRow(self, row, rows):
+        line = []
+        measurements = []
+        for columnIndex, medianItem in self.plan:
+            if columnIndex is None:
+                line.append('')
+                continue
+            cellType, cellValue = row[columnIndex]
+            # 3 == date per https://pythonhosted.org/xlrd3/cell.html - but there are two
+            # in the data, a date and a time.  0 is the date, 1 is the time.  Sigh.
+            if cellType == 3:
+                year, month, day, hour, minute, second = cellValue
+                if columnIndex == 0:        # Date
+                    rows.strDate = '%4d-%02d-%02d' % (year, month, day)
+                    line.append(rows.strDate)
+                    d = datetime.date(year, month, day)
+                    rows.days.add(d.toordinal())
+                    if d < rows.earliestDateSeen:
+                        rows.earliestDateSeen = d
+                    if d > rows.latestDateSeen:
+                        rows.latestDateSeen = d
+                else:   # Only other date value in input is the Time stamp - remember it for the DoE Summary
+                    rows.strTime = '%02d:%02d:%02d' % (hour, minute, second)
+                    line.append(rows.strTime)
+            elif cellType == 1 or cellType == 2:   # 1 = text, 2 = number
+                # Other column - e.g. ph, Turb.FNU, etc.
+                line.append(str(cellValue))
+                # Note some measurements have '-----' for missing values, so only
+                # numeric values are recorded - text is a missing value, not a 0
+                if cellType == 2 and medianItem is not None:
+                    measurements.append((medianItem, cellValue))
+            else:
+                rows.xlrdLog.write('%s: Unknown value type for [%s,%s] : %s\n' % (rows.rawDataFile, rows.rowIndex, columnIndex, cellType))
+                line.append('')
+        return rows.prefix + ','.join(line), measurements
 
 # Process one raw data file (a/k/a LogFile which is confusing, since it conflicts
-# with XLRD's use of LogFile as a output of errors, warnings, etc.)
-# the second parameter here is used for XLRD's log  messages
+# with XLRD's use of LogFile as a output of errors, warnings, etc.) - an .xls or .xlsx workbook
+# the second parameter here is used for XLRD's log  messages (and errors opening .xlsx files)
  
-def processLogFile(rawDataFile, xlrdLog, medianCollector):
+def processLogFile(ctx, rawDataFile, xlrdLog):
     
-    global sites, outputCSVSummary
+    if ctx.statusCallback:
+        ctx.statusCallback('processLogFile: Processing '+rawDataFile)
+    try:
+        book = openLogWorkbook(rawDataFile, xlrdLog)
+    except WorkbookError as e:
+        ctx.statusCallback('Error opening workbook: %s\n' % (str(e)))
+        xlrdLog.write('Error opening workbook %s: %s\n' % (rawDataFile, str(e)))
+        return False
+
+    try:
+        return processLogWorkbook(ctx, rawDataFile, book, xlrdLog)
+    finally:
+        book.close()
+
+# Process the data in one logger workbook, opened with openLogWorkbook
+def processLogWorkbook(ctx, rawDataFile, book, xlrdLog):
+
     nRows = 0           # Number rows written to output
     earliestDateSeen = datetime.date.max        # set to HIGHEST date so the first one we encounter is less
     latestDateSeen = datetime.date.min
     ret = True
-    
-    if statusCallback:
-        statusCallback('processLogFile: Processing '+rawDataFile)
-    try:
-        book = open_workbook(rawDataFile, logfile=xlrdLog)
-    except XLRDError as e:
-        statusCallback('Error opening workbook: %s\n' % (str(e)))
-        xlrdLog.write('Error opening workbook %s: %s\n' % (rawDataFile, str(e)))
-        return False
-    
-    sheet = book.sheet_by_index(0)
+
     # Site is always B19 per Evan
-    siteName = sheet.cell_value(rowx=18, colx=1)
+    siteName = book.cellValue(0, rowx=18, colx=1)
 
     # Some sanity checking - is the book in the expected format?
     if book.nsheets != 2 or not isinstance(siteName, str):
-        statusCallback('Workbook not in expected format')
+        ctx.statusCallback('Workbook not in expected format')
         xlrdLog.write('Workbook %s not in expected format\n' % (rawDataFile))
         return False
 
-    statusCallback ('Site name in data file: '+siteName)
+    ctx.statusCallback ('Site name in data file: '+siteName)
     
     # Map some sitenames together
     siteName = siteName.upper()
@@ -702,274 +1737,1813 @@ def processLogFile(rawDataFile, xlrdLog, medianCollector):
     
     siteName = siteMap.get(siteName, siteName)
     
-    if statusCallback:
-        statusCallback('Site name: '+siteName)
-
-    # Open the sheet and grab the data, copying it to the output CSV
-    try:
-        dataSheet = book.sheet_by_index(1)
-        if verbose:
-            statusCallback('Sheets: ',book.sheet_names())
-
-    except XLRDError as e:
-        statusCallback('Workbook does not have correct number of sheets')
-        xlrdLog.write('Error getting data sheet for '+rawDataFile+' - Skipping Workbook for "'+siteName+'"\n')
-        return False
-
-    # Switch to data sheet
-    sheet = book.sheet_by_index(1)
-    
-    # Get first line from sheet and analyze
-    numColumns = sheet.ncols   # Number of columns
+    if ctx.statusCallback:
+        ctx.statusCallback('Site name: '+siteName)
+
+    # Switch to the data sheet, and get its first line and analyze
+    numColumns = book.ncols(1)   # Number of columns
+    rows = book.rows(1)
+    header = next(rows, [])
+    nSheetRows = 1 if header else 0
     
     # Check if workbook seems to match expected format:
     # 2 sheets
     # first cell in 2nd sheet has Date in the name
-    if sheet.cell_value(rowx=0,colx=0) == u'Date' and book.nsheets == 2:
-        # Print header row
-        # Check to see if we have one of those books where the data doesn't match - in that case we have to do
-        # some magic transposing
-        # Three variations:
-        # Date  Time	Temp.[C]	pH 	EC[uS/cm]	D.O.[%]	    D.O.[ppm]	Turb.FNU	Remarks
-        # Date	Time    Temp.[C]	pH 	D.O.[%]	    D.O.[ppm]	Turb.FNU	EC[uS/cm]   Remarks
-        # Date	Time	Temp.[C]	pH 	mV[pH]	    EC[uS/cm]	D.O.[%]	    D.O.[ppm]	Turb.FNU	Remarks
-        # 0     1       2           3   4           5           6           7           8           9
-
-        # We've adopted the third one (which is the most complete) as the standard, so if we
-        # detect the others, we have to do move columns around as we emit them to the CSV
-        # columns in the right order.
-        
-        columnFormatModel = None
-
-        if numColumns > 4 and sheet.cell(0, 4).ctype == 1 and sheet.cell(0, 4).value == 'D.O.[%]':
-            columnFormatModel = 1           
-                # Transpose columns if needed - column indices are in the
-                # source sheet - they will be pulled from those source columns
-                # and then written to columns 2, 3, 4 etc. - since 0 is the site name
-                # and 1 is the file name.  -1 means blank column (skip)
-            colOrder = [0, 1, 2, 3, -1, 7, 4, 5, 6, 8]
-            statusCallback("This sheet has non-standard column ordering; adjusting columns to match standard.\n")
-        elif numColumns > 4 and sheet.cell(0, 4).ctype == 1 and sheet.cell(0, 4).value == 'mV[pH]':
-            columnFormatModel = 0
-            colOrder = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
-        elif numColumns > 4 and sheet.cell(0, 5).ctype == 1 and sheet.cell(0, 5).value == 'D.O.[%]':
-            columnFormatModel = 2
-            colOrder = [0, 1, 2, 3, -1, 4, 5, 6, 7, 8]
-        else:
-            statusCallback('Workbook has non-standard column headers - see columnFormatModel in processLogFile to address - skipping workbook')
-            xlrdLog.write('Workbook has non-standard column headers - see columnFormatModel in processLogFile to address - Skipping Workbook for "'+siteName+'"\n')
-            return False 
-        
-        nColsToWrite = len(colOrder)
-
-        for rowIndex in range(1, sheet.nrows):    # Iterate through data rows
-            if verbose:
-                statusCallback ('-'*40)
-                statusCallback ('Row: %s' % rowIndex)   # Print row number
+    if len(header) > 0 and header[0][1] == u'Date' and book.nsheets == 2:
+        # There are several variations on the column order (see InstrumentLayouts.json) - the
+        # layout is picked by the header row, and its columns are moved around as they are
+        # emitted to match the standard order (columnHeaders)
+        layout = ctx.layoutRegistry.match(header)
+        ctx.fileFormat = layout.name if layout is not None else None
+        if layout is None:
+            ctx.statusCallback('Workbook has non-standard column headers - add its layout to '+layoutRegistryFileName+' - skipping workbook')
+            xlrdLog.write('Workbook has non-standard column headers - add its layout to '+layoutRegistryFileName+' - Skipping Workbook for "'+siteName+'"\n')
+            return False
+        if not layout.isStandard():
+            ctx.statusCallback("This sheet has non-standard column ordering (%s); adjusting columns to match standard.\n" % layout.name)
+
+        extractor = layout.extractorFor(numColumns)
+        workbookRows = LogWorkbookRows(ctx, siteName, rawDataFile, xlrdLog)
+        records = []        # this file's data rows, which become a sorted run in ctx.sortedRuns
+
+        for rowIndex, row in enumerate(rows, 1):    # Iterate through data rows
+            nSheetRows += 1
+            if ctx.verbose:
+                ctx.statusCallback ('-'*40)
+                ctx.statusCallback ('Row: %s' % rowIndex)   # Print row number
+                for columnIndex, cell in enumerate(row):
+                    ctx.statusCallback ('Column: [%s] is [%s] : [%s]' % (columnIndex, cell[0], cell[1]))
             # Skip entirely blank rows
-            rowIsBlank = True
-            for columnIndex in range(1, sheet.ncols):  # Iterate through columns
-                val = sheet.cell(rowIndex, columnIndex)
-                if (val.ctype != 0 or (val.ctype == 1 and len(str(val)) > 0)):
-                    rowIsBlank = False
-                    
-            if rowIsBlank:
-                if verbose:
-                    statusCallback('Skipping blank row')
+            if all(cell[0] == 0 for cell in row[1:numColumns]):
+                if ctx.verbose:
+                    ctx.statusCallback('Skipping blank row')
                 continue
-            else:
-                nRows += 1              
-  
-            nCols = 0           # Number of columns processed - so we can omit the last "," in the CSV output
-            
-            for columnIndex in colOrder:  # Iterate through columns
-                nCols += 1
-                if columnIndex >= numColumns:
-                    continue            # don't access columns that don't exist on this sheet
-                elif columnIndex == -1:     # emit a blank column - this isn't in source sheet
-                    outputCSVSummary.write(',')
-                    continue
-                else:
-                    cellValue = sheet.cell(rowIndex, columnIndex)  # Get cell object by row, col
-                    cellType = cellValue.ctype
-                    
-                    # Prefix each row with the site name of the data and the
-                    # file name it came from
-                    if (columnIndex == 0):
-                        outputCSVSummary.write(siteName+','+rawDataFile+',')
-                        
-                    if verbose:
-                        statusCallback ('Column: [%s] is [%s] : [%s]' % (columnIndex, cellType, cellValue))
-                        
-                    # Somewhere these numeric values have to be defined, right?
-                    # 3 == date per https://pythonhosted.org/xlrd3/cell.html - but there are two
-                    # in the data, a date and a time.  0 is the date, 1 is the time.  Sigh.
-                    if (cellType == 3):
-                        if (columnIndex == 0):      # Date
-                            # Date
-                            year, month, day, hour, minute, second = xldate.xldate_as_tuple(cellValue.value, book.datemode)
-                            strDate = '%4d-%02d-%02d' % (year, month, day)
-                            outputCSVSummary.write(strDate)
-                            d = datetime.date(year,month,day)
-                            if (d < earliestDateSeen):
-                                earliestDateSeen = d
-                            if (d > latestDateSeen):
-                                latestDateSeen = d
-                        else:  # Only other date value in input is the Time stamp
-                            # Just emit time as is.  Remember since we need to add it
-                            # to the median finder so we can emit the timestamp in the
-                            # DoE Summary.
-                            year, month, day, hour, minute, second = xldate.xldate_as_tuple(cellValue.value, book.datemode)
-                            strTime = '%02d:%02d:%02d' % (hour, minute, second)
-                            outputCSVSummary.write(strTime)
-                    elif (cellType in [1, 2]):   # 1 = text, 2 = number
-                            # Other column - e.g. ph, Turb.FNU, etc.
-                            outputCSVSummary.write(str(cellValue.value))
-                            # Do we need to accumulate values for this for median calculation?
-                            # Note some measurements have '-----' instead of 0 for missing values
-                            # so catch that here by checking only for numeric values
-                            if cellType == 1:
-                                measurementValue = 0
-                            else:
-                                measurementValue = cellValue.value
-                            if calculateMedians[columnIndex]:
-                                medianCollector.addMeasurement(siteName, strDate, strTime, columnHeaders[columnIndex], measurementValue)
-                    else:
-                        xlrdLog.write('%s: Unknown value type for [%s,%s] : %s\n' % (rawDataFile, rowIndex, columnIndex, cellType))
-                    if (nCols < nColsToWrite):
-                        outputCSVSummary.write(',')        # append , except after last column value                    
-                        
-            # After emitting all columns, terminate the line in the CSV file
-            outputCSVSummary.write('\n')       # Terminate line
+            nRows += 1
+
+            workbookRows.rowIndex = rowIndex
+            line, measurements = extractor.extractRow(row, workbookRows)
+            strDate = workbookRows.strDate or ''
+            strTime = workbookRows.strTime or ''
+            records.append(((siteName, strDate, strTime, rawDataFile, rowIndex), (line, strDate, strTime, measurements)))
+        ctx.sortedRuns.addRun(records)
+        earliestDateSeen = workbookRows.earliestDateSeen
+        latestDateSeen = workbookRows.latestDateSeen
     else:
-        statusCallback('Wrong # of sheets or first row of 2nd worksheet is not Date.. skipping')
+        ctx.statusCallback('Wrong # of sheets or first row of 2nd worksheet is not Date.. skipping')
         ret = False
        
-    if statusCallback:
-        statusCallback('%d data rows read.' % sheet.nrows)
+    if ctx.statusCallback:
+        ctx.statusCallback('%d data rows read.' % nSheetRows)
         
     if ret:
-        siteData = SiteData(rawDataFile, minDate=earliestDateSeen, maxDate=latestDateSeen, numRecs=nRows)
-        if siteName not in sites:
+        ctx.nDataRows += nRows
+        siteData = SiteData(rawDataFile, minDate=earliestDateSeen, maxDate=latestDateSeen, numRecs=nRows, days=workbookRows.days)
+        if siteName not in ctx.sites:
             # Not in list yet - add a tuple
-            statusCallback("This data is for a new site: " + siteName)
-            sites[siteName] = [ siteData ]
+            ctx.statusCallback("This data is for a new site: " + siteName)
+            ctx.sites[siteName] = [ siteData ]
         else:
-            statusCallback("This is additional data for site: " + siteName)
-            sites[siteName].append(siteData)
+            ctx.statusCallback("This is additional data for site: " + siteName)
+            ctx.sites[siteName].append(siteData)
 
     return ret
  
-def statusCallback(string):
-    """Puts status messages from this script into a queue which is threadsafe and is read by the GUI"""
-    
-    global messageQueue
+#
+# SITE COVERAGE
+#
+# Index of the date ranges covered by each site's data files (the SiteData records in
+# RunContext.sites), for finding where several files cover the same dates and where there are
+# gaps in the sampling.  Each site's files are kept as (first day, last day, file) intervals
+# sorted by first day; overlaps come from one sweep over the interval ends, and gaps from a
+# bitmap of the days each site has data for, so the report is O(n log n) in the number of files
+# plus the number of days covered.
+class SiteCoverage(object):
+
+    def __init__(self, sites):
+        self.intervals = {}     # indexed by site: [(first day ordinal, last day ordinal, SiteData)]
+        for site, siteDataList in sites.items():
+            dated = [siteData for siteData in siteDataList if len(siteData.days) > 0]
+            if len(dated) > 0:
+                self.intervals[site] = sorted(((siteData.minDate.toordinal(), siteData.maxDate.toordinal(), siteData)
+                                               for siteData in dated), key=itemgetter(0, 1))
+
+    def sites(self):
+        return sorted(self.intervals)
+
+    # The first day the site has data for, and a bytearray with a 1 for each day from then on
+    # that it has data for (the last byte is for the last day)
+    def dayBitmap(self, site):
+        intervals = self.intervals[site]
+        firstDay = intervals[0][0]
+        lastDay = max(lastDay for _, lastDay, _ in intervals)
+        bitmap = bytearray(lastDay - firstDay + 1)
+        for _, _, siteData in intervals:
+            for day in siteData.days:
+                bitmap[day - firstDay] = 1
+        return firstDay, bitmap
+
+    # Date ranges covered by more than one of the site's files - a list of (first day, last day,
+    # [file paths]), a new range starting whenever the set of files covering it changes
+    def overlaps(self, site):
+        events = []
+        for firstDay, lastDay, siteData in self.intervals[site]:
+            events.append((firstDay, 1, siteData.filePath))
+            events.append((lastDay + 1, -1, siteData.filePath))
+        events.sort()
+
+        found = []
+        active = defaultdict(int)      # files covering the days from rangeStart on
+        rangeStart = None
+        for day, change, filePath in events:
+            if rangeStart is not None and day > rangeStart and len(active) > 1:
+                found.append((rangeStart, day - 1, sorted(active)))
+            active[filePath] += change
+            if active[filePath] == 0:
+                del active[filePath]
+            rangeStart = day
+        return found
+
+    # Runs of days with no data between the site's first and last days - a list of (first day,
+    # last day) of each gap
+    def gaps(self, site):
+        firstDay, bitmap = self.dayBitmap(site)
+        found = []
+        gapStart = bitmap.find(0)
+        while gapStart != -1:
+            gapEnd = bitmap.find(1, gapStart)     # there is always one - the last day has data
+            found.append((firstDay + gapStart, firstDay + gapEnd - 1))
+            gapStart = bitmap.find(0, gapEnd)
+        return found
+
+# Write the site coverage report next to the summary CSV: for each site a Span row (first and last
+# day, number of days with data and of files), then an Overlap row for each date range covered by
+# several files and a Gap row for each run of days with no data
+def writeCoverageReport(ctx):
+    coveragePath = compressedPath(os.path.join(ctx.outputFolder, coverageFileName), ctx.compression)
+    coverage = SiteCoverage(ctx.sites)
+    ctx.outputPaths.append(coveragePath)
+
+    def dayText(day):
+        return datetime.date.fromordinal(day).isoformat()
+
+    with openOutputText(coveragePath, ctx.compression) as coverageFile:
+        writer = csv.writer(coverageFile, lineterminator='\n')
+        writer.writerow(['Site', 'Kind', 'Start', 'End', 'Days', 'NumFiles', 'Files'])
+        for site in coverage.sites():
+            firstDay, bitmap = coverage.dayBitmap(site)
+            writer.writerow([site, 'Span', dayText(firstDay), dayText(firstDay + len(bitmap) - 1), bitmap.count(1),
+                             len(coverage.intervals[site]), ''])
+            for rangeStart, rangeEnd, filePaths in coverage.overlaps(site):
+                writer.writerow([site, 'Overlap', dayText(rangeStart), dayText(rangeEnd), rangeEnd - rangeStart + 1,
+                                 len(filePaths), '; '.join(filePaths)])
+            for gapStart, gapEnd in coverage.gaps(site):
+                writer.writerow([site, 'Gap', dayText(gapStart), dayText(gapEnd), gapEnd - gapStart + 1, 0, ''])
+
+#
+# ROLLUPS
+#
+# Pre-aggregated tables for reports, written to rollupFileName next to the summary CSV: for each site
+# and parameter, the readings of each day, month, season and year rolled up into a count, sum,
+# minimum, maximum, mean and median.  The month, season and year rows also keep the readings rounded
+# to rollupDecimals places with how many there were of each.  The rounded readings are a quantile
+# state that merges by adding the counts, so the median (or any quantile) of a quarter, a water year
+# or any other run of whole months comes from a few rows of the table instead of from every reading -
+# see RollupStreamData.py.  The day rows don't keep them: there are thirty times as many days as
+# months, and a day's rounded readings are nearly as many as its readings, so they made the table
+# over half the size of the summary CSV.  The rollups are built in the same pass over the sorted rows
+# as the outputs, so the whole table is rebuilt with them on every run rather than updated - except
+# that after a batch of new files in watch mode, the rows of the sites the batch had no data for are
+# copied from the table before.  Seasons are meteorological: Winter is December to February.
+#
+# For long series of fine-grained readings (years of 5 minute HOBO data) the rounded readings of a
+# year can still run to thousands of values per cell, so the rollups can instead keep a KLL sketch of
+# them (see KLLSketch) - rollupSketchK > 0 (--sketch) is the size of the sketches.  The count, sum,
+# minimum and maximum stay exact either way, and so do the EIM medians, which don't use the rollups.
+rollupFileName = 'Rollups.CSV'
+previousRollupsPrefix = 'Previous'
+rollupDecimals = 2
+rollupSketchK = 0
+rollupLevels = ['Day', 'Month', 'Season', 'Year']
+rollupHeaders = ['Site', 'Level', 'Period', 'Start', 'End', 'Parameter', 'Count', 'Sum', 'Min', 'Max', 'Mean', 'Median', 'Values']
+seasonNames = {12: 'Winter', 3: 'Spring', 6: 'Summer', 9: 'Fall'}     # by first month
+
+# The parameters of the temperature rollups, named as in TemperatureData.CSV
+temperatureRollupParameters = ['DO conc (mg/L)', 'Temp (DegF)'] + derivedTemperatureHeaders
+
+# KLL quantile sketch (Karnin, Lang and Liberty, "Optimal Quantile Approximation in Streams", 2016):
+# a fixed-size summary of any number of values that can be merged with another.  The values are kept
+# in levels of compactors; a value at level h stands for 2**h of the values added.  When the sketch
+# is full, the lowest level over its capacity is sorted and every other value in it (starting with
+# the first or the second, at random) moves up a level.  The capacities shrink by 2/3 per level
+# down from k at the top, so the sketch never holds more than about 3k values.  The rank of a value
+# in the sketch is within about 1.7/k of the values added of its true rank, 99% of the time - with
+# k = 200, a median from the sketch is within 0.85% of the ranks either side of the true median.
+# The coin flips come from a fixed seed, so the same values in the same order give the same sketch
+# every run.
+class KLLSketch(object):
+    __slots__ = ('k', 'levels', 'count', 'coins')
+
+    def __init__(self, k):
+        self.k = k
+        self.levels = [[]]
+        self.count = 0
+        self.coins = 1          # state of the coin flips
+
+    def capacity(self, level):
+        return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** (len(self.levels) - 1 - level))))
+
+    # Add a list of values
+    def update(self, values):
+        self.levels[0].extend(values)
+        self.count += len(values)
+        self.compress()
+
+    # Add in the values of another sketch
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, values in enumerate(other.levels):
+            self.levels[level].extend(values)
+        self.count += other.count
+        self.compress()
+
+    # Compact levels until the sketch is back within its capacity
+    def compress(self):
+        while sum(len(values) for values in self.levels) > sum(self.capacity(level) for level in range(len(self.levels))):
+            for level, values in enumerate(self.levels):
+                if len(values) >= self.capacity(level):
+                    break
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            values.sort()
+            kept = [values.pop()] if len(values) % 2 == 1 else []
+            self.coins = (self.coins * 1103515245 + 12345) & 0x7fffffff
+            self.levels[level + 1].extend(values[(self.coins >> 16) & 1::2])
+            self.levels[level] = kept
+
+    # The values of rank q * (count - 1) for each q of qs (0 to 1) among the values added, as near as
+    # the sketch knows them - in one pass over its sorted values.  NaN if nothing has been added.
+    def quantiles(self, qs):
+        if self.count == 0:
+            return [math.nan] * len(qs)
+        found = {}
+        wanted = sorted(set(q * (self.count - 1) for q in qs))
+        nFound = 0
+        seen = 0
+        for value, weight in sorted((value, 1 << level) for level, values in enumerate(self.levels) for value in values):
+            seen += weight
+            while nFound < len(wanted) and seen > wanted[nFound]:
+                found[wanted[nFound]] = value
+                nFound += 1
+            if nFound == len(wanted):
+                break
+        for rank in wanted[nFound:]:
+            found[rank] = value
+        return [found[q * (self.count - 1)] for q in qs]
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    # The sketch as text for rollupFileName: "kll<k>", then the values of each level, levels
+    # separated by |
+    def text(self):
+        return 'kll%d|%s' % (self.k, '|'.join(' '.join(repr(value) for value in values) for values in self.levels))
+
+# A KLLSketch from its text (see KLLSketch.text)
+def parseKLLSketch(text):
+    parts = text.split('|')
+    sketch = KLLSketch(int(parts[0][3:]))
+    sketch.levels = [[float(value) for value in part.split()] for part in parts[1:]]
+    sketch.count = sum(len(values) << level for level, values in enumerate(sketch.levels))
+    return sketch
+
+# The readings of one site and parameter over a period.  The rounded readings are kept with how
+# many there are of each (a Counter), or in a KLLSketch of size sketchK if it is more than 0.
+class RollupCell(object):
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'values')
+
+    def __init__(self, sketchK=0):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.values = KLLSketch(sketchK) if sketchK > 0 else Counter()
+
+    # Add a list of readings
+    def addReadings(self, readings):
+        self.count += len(readings)
+        self.total += math.fsum(readings)
+        self.minimum = min(self.minimum, min(readings))
+        self.maximum = max(self.maximum, max(readings))
+        self.values.update([round(reading, rollupDecimals) for reading in readings])
+
+    # Add in the readings of another cell.  If either has a sketch, the result is a sketch; if either
+    # has no rounded readings (values None, as for a day read back from rollupFileName), neither does
+    # the result.
+    def add(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        if self.values is None or other.values is None:
+            self.values = None
+        elif isinstance(other.values, KLLSketch):
+            if not isinstance(self.values, KLLSketch):
+                sketch = KLLSketch(other.values.k)
+                sketch.update(list(self.values.elements()))
+                self.values = sketch
+            self.values.merge(other.values)
+        elif isinstance(self.values, KLLSketch):
+            self.values.update(list(other.values.elements()))
+        else:
+            self.values.update(other.values)
+
+    def mean(self):
+        return self.total / self.count
+
+    # The index'th (from 0) smallest rounded readings for each of indexes - in one pass over the
+    # sorted readings, whatever the number of indexes.  Returns {index: reading}.
+    def valuesAt(self, indexes):
+        found = {}
+        wanted = sorted(set(indexes))
+        nFound = 0
+        seen = 0
+        for value in sorted(self.values):
+            seen += self.values[value]
+            while nFound < len(wanted) and seen > wanted[nFound]:
+                found[wanted[nFound]] = value
+                nFound += 1
+            if nFound == len(wanted):
+                break
+        return found
+
+    # The qs quantiles (each 0 to 1) of the rounded readings, interpolating between the nearest two
+    # as numpy does by default - so quantiles([0.5]) is the median as MedianFinder gives it.  From a
+    # sketch, each is the reading nearest that rank the sketch knows of.  NaN if the cell has no
+    # rounded readings.
+    def quantiles(self, qs):
+        if self.values is None or self.count == 0:
+            return [math.nan] * len(qs)
+        if isinstance(self.values, KLLSketch):
+            return self.values.quantiles(qs)
+        ranks = [q * (self.count - 1) for q in qs]
+        values = self.valuesAt([int(rank) for rank in ranks] + [int(rank) + 1 for rank in ranks if rank > int(rank)])
+        result = []
+        for rank in ranks:
+            lower = int(rank)
+            value = values[lower]
+            if rank > lower:
+                value += (rank - lower) * (values[lower + 1] - value)
+            result.append(value)
+        return result
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    # The rounded readings as text for rollupFileName, e.g. "10.08:3 10.1:2", or the sketch's text
+    def valuesText(self):
+        if isinstance(self.values, KLLSketch):
+            return self.values.text()
+        return ' '.join('%r:%d' % (value, count) for value, count in sorted(self.values.items()))
+
+# The first month of a month n months after the one day is in
+def addMonths(day, n):
+    months = day.year * 12 + day.month - 1 + n
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+# The periods a day is in - (level, label, first day, last day) for its day, month, season and year
+def rollupPeriods(day):
+    month = day.replace(day=1)
+    season = addMonths(month, -(day.month % 3))
+    seasonName = seasonNames[season.month]
+    seasonLabel = '%s %d-%02d' % (seasonName, season.year, (season.year + 1) % 100) if season.month == 12 else '%s %d' % (seasonName, season.year)
+    oneDay = datetime.timedelta(days=1)
+    return [(0, day.isoformat(), day, day),
+            (1, month.strftime('%Y-%m'), month, addMonths(month, 1) - oneDay),
+            (2, seasonLabel, season, addMonths(season, 3) - oneDay),
+            (3, '%d' % day.year, datetime.date(day.year, 1, 1), datetime.date(day.year, 12, 31))]
+
+# Builds the rollups from the readings of the sorted rows.  The rows come grouped by site and in
+# date order, so each day's cells are written as soon as the day is over, and only the site's month,
+# season and year cells are held until the site is done.
+class RollupBuilder(object):
+
+    # The rows of keptSites are copied from keptRows (a csv.reader over an earlier table of the same
+    # rows, after its header) instead of being built again
+    def __init__(self, outputFile, parameterOrder, sketchK=0, keptSites=(), keptRows=None):
+        self.writer = csv.writer(outputFile, lineterminator='\n')
+        self.writer.writerow(rollupHeaders)
+        self.parameterOrder = parameterOrder    # sort key for the parameters
+        self.sketchK = sketchK
+        self.keptSites = keptSites
+        self.keptRows = keptRows
+        self.keptRow = next(keptRows, None) if keptRows is not None else None
+        self.keeping = False        # the site's rows are copied
+        self.site = None
+        self.day = ''
+        self.dayReadings = {}       # readings of the day so far, by parameter
+        self.periodCells = {}       # the site's month, season and year cells: (level, first day, parameter) -> (label, last day, RollupCell)
+
+    # Add the readings [(parameter, value)] of a row for site on day (YYYY-MM-DD).  Readings without
+    # a date can't be put in any period, so they are left out.
+    def addReadings(self, site, day, readings):
+        if day != self.day or site != self.site:
+            self.finishDay()
+            if site != self.site:
+                self.finishSite()
+                self.site = site
+                self.keeping = site in self.keptSites
+                if self.keeping:
+                    self.copyKeptRows()
+            self.day = day
+        if day == '' or self.keeping:
+            return
+        dayReadings = self.dayReadings
+        for parameter, value in readings:
+            if parameter in dayReadings:
+                dayReadings[parameter].append(value)
+            else:
+                dayReadings[parameter] = [value]
+
+    # Write a cell's row - with its rounded readings (or sketch) unless it is a day's
+    def writeCell(self, period, parameter, cell):
+        level, label, firstDay, lastDay = period
+        self.writer.writerow([self.site, rollupLevels[level], label, firstDay.isoformat(), lastDay.isoformat(), parameter,
+                              cell.count, repr(cell.total), repr(cell.minimum), repr(cell.maximum),
+                              '%.4f' % cell.mean(), '%.4f' % cell.quantile(0.5), cell.valuesText() if level > 0 else ''])
+
+    # Copy the site's rows from the earlier table.  Both are in the order of the sorted rows, which is
+    # by site, so the rows of sites before it (which are being built again) are skipped.
+    def copyKeptRows(self):
+        row = self.keptRow
+        while row is not None and row[0] < self.site:
+            row = next(self.keptRows, None)
+        while row is not None and row[0] == self.site:
+            self.writer.writerow(row)
+            row = next(self.keptRows, None)
+        self.keptRow = row
+
+    # Write the day's cells and add them to its month, season and year
+    def finishDay(self):
+        if len(self.dayReadings) == 0:
+            return
+        periods = rollupPeriods(datetime.date(int(self.day[:4]), int(self.day[5:7]), int(self.day[8:10])))
+        for parameter in sorted(self.dayReadings, key=self.parameterOrder):
+            cell = RollupCell(self.sketchK)
+            cell.addReadings(self.dayReadings[parameter])
+            self.writeCell(periods[0], parameter, cell)
+            for level, label, firstDay, lastDay in periods[1:]:
+                key = (level, firstDay, parameter)
+                if key not in self.periodCells:
+                    self.periodCells[key] = (label, lastDay, RollupCell(self.sketchK))
+                self.periodCells[key][2].add(cell)
+        self.dayReadings = {}
+
+    # Write the site's month, season and year cells
+    def finishSite(self):
+        for level, firstDay, parameter in sorted(self.periodCells, key=lambda key: (key[0], key[1], self.parameterOrder(key[2]))):
+            label, lastDay, cell = self.periodCells[(level, firstDay, parameter)]
+            self.writeCell((level, label, firstDay, lastDay), parameter, cell)
+        self.periodCells = {}
+
+    def finish(self):
+        self.finishDay()
+        self.finishSite()
+
+# Start the run's rollups - parameterOrder is the sort key for its parameters.  The rows of
+# keptSites are copied from the rollups written before, which are moved to previousRollupsPrefix +
+# their name until the new ones are written - if there aren't any, every site's are built.
+def openRollups(ctx, parameterOrder, keptSites=()):
+    rollupsPath = compressedPath(os.path.join(ctx.outputFolder, rollupFileName), ctx.compression)
+    keptRows = None
+    if len(keptSites) > 0 and os.path.isfile(rollupsPath):
+        previousPath = os.path.join(ctx.outputFolder, previousRollupsPrefix + os.path.basename(rollupsPath))
+        os.replace(rollupsPath, previousPath)
+        ctx.previousRollups = openOutputForReading(previousPath)
+        keptRows = csv.reader(ctx.previousRollups)
+        next(keptRows, None)
+    else:
+        keptSites = ()
+    ctx.outputRollups = openOutputText(rollupsPath, ctx.compression)
+    ctx.outputPaths.append(rollupsPath)
+    return RollupBuilder(ctx.outputRollups, parameterOrder, ctx.rollupSketch, keptSites, keptRows)
+
+def closeRollups(ctx, rollups):
+    rollups.finish()
+    ctx.outputRollups.close()
+    ctx.outputRollups = None
+    if ctx.previousRollups is not None:
+        ctx.previousRollups.close()
+        ctx.previousRollups = None
+        os.remove(os.path.join(ctx.outputFolder, previousRollupsPrefix + os.path.basename(compressedPath(rollupFileName, ctx.compression))))
+
+# All the state of one run: the options it was started with, its output files and everything
+# accumulated from the data files so far.  FormatStreamData and watchStreamData each create their
+# own, so several runs can go on in one process - e.g. one GUI run after another, or logger and
+# temperature runs in separate threads - without seeing each other's data, and everything a run
+# accumulated is freed when it ends.
+class RunContext(object):
+
+    def __init__(self, outputFolder, inputFolder, doTemperature, DoEOutputOption=False, verbose=False,
+                 messageQueue=None, qcThreshold=None, qcWindowSize=None, eimMaxRows=None, eimMaxBytes=None,
+                 compression=None, layoutFile=None, resume=False, checkpointFiles=None, checkpointSeconds=None,
+                 fileWorkers=None, fileTimeout=None, fileMemoryLimit=None, shard=None, rollupSketch=None,
+                 progressCallback=None, parseCacheFolder=None):
+        self.outputFolder = normalizedPath(outputFolder)
+        self.inputFolder = normalizedPath(inputFolder)
+        self.doTemperature = doTemperature
+        self.DoEOutputOption = DoEOutputOption
+        self.verbose = verbose
+        self.messageQueue = messageQueue        # queue for messages to the GUI, None for the command line
+
+        self.qcThreshold = qcThreshold if qcThreshold is not None else globals()['qcThreshold']
+        self.qcWindowSize = qcWindowSize if qcWindowSize is not None else globals()['qcWindowSize']
+        self.qualityChecker = QualityChecker(self.qcWindowSize, self.qcThreshold, qcMinReadings)
+        self.eimMaxRows = eimMaxRows if eimMaxRows is not None else globals()['eimMaxRows']
+        self.eimMaxBytes = eimMaxBytes if eimMaxBytes is not None else globals()['eimMaxBytes']
+        self.compression = compression if compression is not None else outputCompression
+        self.layoutFile = layoutFile if layoutFile is not None else defaultLayoutFile()
+        self.layoutRegistry = None      # loaded by startRun for logger data
+        self.rollupSketch = rollupSketch if rollupSketch is not None else rollupSketchK
+        if self.compression is not None and self.compression not in availableCompressions():
+            raise ValueError('%s compression is not available' % self.compression)
+
+        # Reading the data files - see fileWorkers
+        self.fileWorkers = fileWorkers if fileWorkers is not None else globals()['fileWorkers']
+        self.fileTimeout = fileTimeout if fileTimeout is not None else fileTimeoutSeconds
+        self.fileMemoryLimit = fileMemoryLimit if fileMemoryLimit is not None else globals()['fileMemoryLimit']
+        self.parseCacheFolder = parseCacheFolder
+        self.parseCache = None          # a ParseCache, set up by startRun if there is a parseCacheFolder
+        self.rejects = []               # (path, reason) of each data file that couldn't be read
+        self.fileCosts = {}             # see fileCostsFileName - loaded by startRun
+        self.costEstimates = {}         # seconds each file being read is expected to take, indexed by path
+        self.progress = RunProgress(0, 0, 0.0, 0.0, 0, 0, 0, 0.0)
+        self.progressStartTime = time.time()
+        self.progressReportTime = time.time()
+        self.progressCallback = progressCallback    # called with a RunProgress as files are read, e.g. for the GUI
+
+        # Checkpoints - see checkpointFolderName.  startRun sets them up.
+        self.resume = resume
+        self.checkpointFiles = checkpointFiles if checkpointFiles is not None else checkpointEveryFiles
+        self.checkpointSeconds = checkpointSeconds if checkpointSeconds is not None else checkpointEverySeconds
+        self.checkpointing = self.checkpointFiles > 0 or self.checkpointSeconds > 0
+        self.filesRead = {}             # signature of each data file read, indexed by path
+        self.filesSinceCheckpoint = 0
+        self.lastCheckpointTime = time.time()
+        self.logOffset = None           # where to carry on the log file from, when resuming
+
+        # Shards - see SHARDS.  shard is (i, N) for shard i of N, None for a run over all the files.
+        self.shard = shard
+        self.filesFound = None          # (number, crc) of all the data files found, to check the shards agree
+        self.fileOrder = {}             # index of each of the shard's files among all the data files found
+
+        # handles to output files - the log is open for the whole run, the others while they
+        # are being written
+        self.outputLogFile = None
+        self.outputCSVSummary = None    # Data summary by site, with median values
+        self.outputCSVDoE = None        # Output for DoE logger data
+        self.siteDataFiles = {}         # Per-site DoE file for temperature data being written, indexed by site
+        self.siteEIMFiles = {}          # Per-site DoE files written, indexed by site: ([paths], values flagged by QC)
+        self.outputRollups = None       # Rollup tables - see ROLLUPS
+        self.previousRollups = None     # Rollup tables being replaced, while the rows of kept sites are copied
+
+        # Dictionary of sites encountered, see SiteData above
+        self.sites = {}
+        # Sorted runs of the data rows read so far, for the outputs
+        self.sortedRuns = SortedRunStore()
+
+        # Counts for the run summary
+        self.nFilesProcessed = 0
+        self.nFilesFailed = 0
+        self.nDataRows = 0
+        self.startTime = time.time()
+
+        # Metrics for monitoring - see METRICS
+        self.metrics = RunMetrics()
+        self.fileFormat = None          # format of the data file being read (layout name or HOBO flavor)
+        self.outputPaths = []           # output files written since the outputs were last started
+
+    def statusCallback(self, string):
+        """Puts status messages from this script into a queue which is threadsafe and is read by the GUI"""
+        if self.messageQueue is not None:
+            self.messageQueue.put(string)
+        else:       # command line
+            print(string)
+
+    # Close any output files still open, and remove the sorted runs
+    def close(self):
+        for outputFile in [self.outputCSVSummary, self.outputCSVDoE, self.outputRollups, self.previousRollups, self.outputLogFile] + list(self.siteDataFiles.values()):
+            if outputFile is not None:
+                outputFile.close()
+        self.siteDataFiles = {}
+        self.sortedRuns.close()
+
+# Check the options a run was started with.  Returns False if the run can't go ahead.
+def startRun(ctx):
+    if ctx.inputFolder == '' or not os.path.isdir(ctx.inputFolder):
+        ctx.statusCallback(ctx.inputFolder+' is not a folder containing data files.')
+        return False
+
+    # A run from the command line or a batch job can be given an output folder that isn't there yet
+    if not os.path.isdir(ctx.outputFolder):
+        try:
+            os.makedirs(ctx.outputFolder)
+        except OSError as e:
+            ctx.statusCallback('Error creating output folder %s: %s' % (ctx.outputFolder, str(e)))
+            return False
+
+    ctx.fileCosts = loadFileCosts(ctx.outputFolder)
+
+    if not ctx.doTemperature:
+        try:
+            ctx.layoutRegistry = loadLayoutRegistry(ctx.layoutFile)
+        except (IOError, ValueError) as e:
+            ctx.statusCallback('Error loading instrument layouts from %s: %s' % (ctx.layoutFile, str(e)))
+            return False
+
+    if ctx.parseCacheFolder is not None:
+        try:
+            ctx.parseCache = ParseCache(ctx)
+        except OSError as e:
+            ctx.statusCallback('Error creating parse cache folder %s: %s - reading every data file' % (ctx.parseCacheFolder, str(e)))
+
+    if ctx.checkpointing:
+        startCheckpoints(ctx)
+    elif ctx.resume:
+        ctx.statusCallback('--resume needs checkpoints - starting from the beginning')
+    return True
+
+#
+# CHECKPOINTS
+#
+# Set up checkpoints for a run (see checkpointFolderName): the sorted runs are kept in the
+# checkpoint folder, and a resumed run picks up the last checkpoint's state.  The checkpoint is
+# only used if it is for the same input folder and kind of data and none of the files it read
+# has changed since - otherwise the run starts from the beginning.
+def startCheckpoints(ctx):
+    checkpointFolder = os.path.join(ctx.outputFolder, checkpointFolderName)
+    state = None
+    if ctx.resume:
+        try:
+            with open(os.path.join(checkpointFolder, checkpointStateFileName), 'rb') as stateFile:
+                state = pickle.load(stateFile)
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            ctx.statusCallback('No checkpoint to resume from (%s) - starting from the beginning' % str(e))
+        if state is not None:
+            if (state['inputFolder'] != ctx.inputFolder or state['doTemperature'] != ctx.doTemperature or
+                    state.get('shard') != ctx.shard):
+                ctx.statusCallback('The checkpoint is for a different run - starting from the beginning')
+                state = None
+            elif any(fileSignature(path) != signature for path, signature in state['filesRead'].items()):
+                ctx.statusCallback('Files read before the checkpoint have changed - starting from the beginning')
+                state = None
+
+    if state is None:
+        shutil.rmtree(checkpointFolder, ignore_errors=True)
+        ctx.sortedRuns = SortedRunStore(checkpointFolder)
+        return
+
+    ctx.sortedRuns = SortedRunStore(checkpointFolder)
+    ctx.sortedRuns.restore(state['spillFiles'], state['nSpills'])
+    ctx.filesRead = state['filesRead']
+    ctx.sites = dict((site, [SiteData(*siteData) for siteData in siteDataList]) for site, siteDataList in state['sites'].items())
+    ctx.nFilesProcessed = state['nFilesProcessed']
+    ctx.nFilesFailed = state['nFilesFailed']
+    ctx.nDataRows = state['nDataRows']
+    ctx.rejects = state['rejects']
+    ctx.logOffset = state['logOffset']
+    if 'metrics' in state:
+        ctx.metrics.restore(state['metrics'])
+    ctx.statusCallback('Resuming from the checkpoint - %d files already read' % len(ctx.filesRead))
+
+# Save the state of the run so far to the checkpoint folder.  The state file is replaced in one
+# step, so a run stopped while a checkpoint is being written still has the one before.
+def writeCheckpoint(ctx):
+    spillFiles, nSpills = ctx.sortedRuns.checkpoint()
+    ctx.outputLogFile.flush()
+    state = {'inputFolder': ctx.inputFolder, 'doTemperature': ctx.doTemperature, 'shard': ctx.shard, 'filesRead': ctx.filesRead,
+             'sites': dict((site, [tuple(siteData) for siteData in siteDataList]) for site, siteDataList in ctx.sites.items()),
+             'nFilesProcessed': ctx.nFilesProcessed, 'nFilesFailed': ctx.nFilesFailed, 'nDataRows': ctx.nDataRows,
+             'rejects': ctx.rejects, 'logOffset': ctx.outputLogFile.tell(), 'spillFiles': spillFiles, 'nSpills': nSpills,
+             'metrics': ctx.metrics.state()}
+    statePath = os.path.join(ctx.sortedRuns.tempFolder, checkpointStateFileName)
+    if not os.path.isdir(ctx.sortedRuns.tempFolder):     # no rows yet
+        os.makedirs(ctx.sortedRuns.tempFolder)
+    with open(statePath + '.tmp', 'wb') as stateFile:
+        pickle.dump(state, stateFile, pickle.HIGHEST_PROTOCOL)
+    os.replace(statePath + '.tmp', statePath)
+    ctx.sortedRuns.checkpointSaved()
+    ctx.filesSinceCheckpoint = 0
+    ctx.lastCheckpointTime = time.time()
+    if ctx.verbose:
+        ctx.statusCallback('Checkpoint saved - %d files read' % len(ctx.filesRead))
+
+# Note that a data file has been read, and save a checkpoint if one is due
+def fileRead(ctx, path):
+    ctx.filesRead[path] = fileSignature(path)
+    if ctx.checkpointing:
+        ctx.filesSinceCheckpoint += 1
+        if ((ctx.checkpointFiles > 0 and ctx.filesSinceCheckpoint >= ctx.checkpointFiles) or
+                (ctx.checkpointSeconds > 0 and time.time() - ctx.lastCheckpointTime >= ctx.checkpointSeconds)):
+            writeCheckpoint(ctx)
+
+# The run has finished - it won't be resumed, so the checkpoint can go
+def removeCheckpoint(ctx):
+    if ctx.checkpointing:
+        shutil.rmtree(os.path.join(ctx.outputFolder, checkpointFolderName), ignore_errors=True)
+
+#
+# SHARDS
+#
+# A rebuild of the whole archive can be split across N machines (or N processes on one): each runs
+# with --shard i/N and reads only the data files whose path, relative to the input folder, hashes
+# to shard i.  Instead of the outputs, a shard run writes a bundle to shardBundleFolderName in its
+# output folder - its data rows in key order (the spill file format), and the sites, counts and
+# rejects the outputs need.  MergeStreamData.py merges the rows of the N bundles and writes the
+# outputs from them, just as a run over all the files does, so they come out the same.  The medians
+# and QC are left to the merge: they depend on the order of all of a site's readings, which may be
+# spread over several shards.
+
+# Parse a shard such as 2/4 - returns (2, 4), or None if it isn't one
+def parseShard(text):
+    m = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', text)
+    if m is None:
+        return None
+    index, count = int(m.group(1)), int(m.group(2))
+    if count < 1 or index < 1 or index > count:
+        return None
+    return index, count
+
+# The name of a data file for sharding - its path relative to the input folder with / separators,
+# the same on every machine that sees the input folder at the same place
+def shardName(inputFolder, path):
+    return os.path.relpath(path, inputFolder).replace(os.sep, '/')
+
+# Which of nShards shards (1 to nShards) a data file belongs to
+def shardOf(inputFolder, path, nShards):
+    return zlib.crc32(shardName(inputFolder, path).encode('utf-8')) % nShards + 1
+
+# The data files (all those found, in collectFiles order) that are the run's shard.  Records where
+# they come in the whole list, so the merge can put the rejects back in that order.
+def shardFiles(ctx, files):
+    index, count = ctx.shard
+    names = [shardName(ctx.inputFolder, path) for path in files]
+    ctx.filesFound = (len(files), zlib.crc32('\n'.join(names).encode('utf-8')))
+    ctx.fileOrder = dict((path, order) for order, (path, name) in enumerate(zip(files, names))
+                         if zlib.crc32(name.encode('utf-8')) % count + 1 == index)
+    ctx.statusCallback('Shard %d/%d: %d of the %d data files' % (index, count, len(ctx.fileOrder), len(files)))
+    return [path for path in files if path in ctx.fileOrder]
+
+# Write the run's shard bundle.  The state file is written last, so a bundle whose run was
+# stopped part way through has none and isn't taken for a complete one.
+def writeShardBundle(ctx):
+    bundleFolder = os.path.join(ctx.outputFolder, shardBundleFolderName)
+    statePath = os.path.join(bundleFolder, shardStateFileName)
+    if os.path.exists(statePath):
+        os.remove(statePath)
+    elif not os.path.isdir(bundleFolder):
+        os.makedirs(bundleFolder)
+
+    rowsPath = os.path.join(bundleFolder, shardRowsFileName)
+    with open(rowsPath, 'wb') as rowsFile:
+        for row in ctx.sortedRuns.merged():
+            pickle.dump(row, rowsFile, shardPickleProtocol)
+    ctx.metrics.outputWritten([rowsPath])
+    state = {'inputFolder': ctx.inputFolder, 'doTemperature': ctx.doTemperature, 'shard': ctx.shard,
+             'filesFound': ctx.filesFound, 'fileOrder': ctx.fileOrder,
+             'sites': dict((site, [tuple(siteData) for siteData in siteDataList]) for site, siteDataList in ctx.sites.items()),
+             'nFilesProcessed': ctx.nFilesProcessed, 'nFilesFailed': ctx.nFilesFailed, 'nDataRows': ctx.nDataRows,
+             'rejects': ctx.rejects, 'metrics': ctx.metrics.state()}
+    with open(statePath + '.tmp', 'wb') as stateFile:
+        pickle.dump(state, stateFile, shardPickleProtocol)
+    os.replace(statePath + '.tmp', statePath)
+    ctx.statusCallback('Shard %d/%d bundle written to %s - merge the bundles of all %d shards with MergeStreamData.py'
+                       % (ctx.shard[0], ctx.shard[1], bundleFolder, ctx.shard[1]))
+
+# Read the state of a shard bundle - folder is the bundle folder or the shard run's output folder.
+# Returns (path of the rows file, state).  Raises ValueError if there isn't a complete bundle there.
+def readShardBundle(folder):
+    if os.path.isdir(os.path.join(folder, shardBundleFolderName)):
+        folder = os.path.join(folder, shardBundleFolderName)
+    try:
+        with open(os.path.join(folder, shardStateFileName), 'rb') as stateFile:
+            state = pickle.load(stateFile)
+    except (IOError, EOFError, pickle.UnpicklingError) as e:
+        raise ValueError('%s is not a complete shard bundle: %s' % (folder, str(e)))
+    rowsPath = os.path.join(folder, shardRowsFileName)
+    if not os.path.isfile(rowsPath):
+        raise ValueError('%s is not a complete shard bundle: no %s file' % (folder, shardRowsFileName))
+    state['sites'] = dict((site, [SiteData(*siteData) for siteData in siteDataList]) for site, siteDataList in state['sites'].items())
+    return rowsPath, state
+
+# Open the log file.  Returns False if it couldn't be opened.  The output CSVs are written
+# once the data files have been read (see emitLogOutputs and emitTemperatureOutputs).
+def openOutputFiles(ctx):
+    outputFolder = ctx.outputFolder
+    inputFolder = ctx.inputFolder
+
+    # Open up log file - a resumed run carries on from where the checkpoint had got to
+    try:
+        logPath = os.path.join(outputFolder, "LogFile.txt")
+        if ctx.logOffset is not None:
+            ctx.outputLogFile = open(logPath, 'r+')
+            ctx.outputLogFile.truncate(ctx.logOffset)
+            ctx.outputLogFile.seek(ctx.logOffset)
+            ctx.outputLogFile.write('=== Resumed from checkpoint ===\n')
+        else:
+            ctx.outputLogFile = open(logPath, 'w')
+    except IOError as e:
+        ctx.statusCallback('Error opening '+logPath+': '+ str(e))
+        return False
+
+    if ctx.doTemperature:
+        # For temperature data - we emit per-site DoE summary files, as well as the
+        # aggregated file
+        outputSummaryPath = compressedPath(os.path.join(outputFolder, 'TemperatureData.CSV'), ctx.compression)
+        ctx.statusCallback('Processing Temperature file data in "'+ inputFolder+ '"...')
+        ctx.statusCallback('Writing to:\n'+outputSummaryPath+'\nand per-site DoE files named Xxxxx_Temperature_DoE.csv\n')
+    else:
+        # We emit two output files - Summary  which is an aggregated summary of all the data files
+        # we read, and DoESummary which is for input to the DoE site (the EIM database) in a format they prescribe.
+        outputSummaryPath = compressedPath(os.path.join(outputFolder, 'StreamData.CSV'), ctx.compression)
+        ctx.statusCallback('Processing LOG file data in "'+ inputFolder+ '"...')
+        ctx.statusCallback('Writing to "'+ outputSummaryPath+ '"...')
+
+    return True
+
+#
+# READING DATA FILES
+#
+# Each data file is read in a worker process of its own, so a corrupt file can't take the run down
+# with it: a file that takes longer than fileTimeoutSeconds has its worker killed, a worker only
+# gets fileMemoryLimit bytes of memory (where the OS lets us set that - not on Windows), and a file
+# that makes the reader raise an exception or crash the worker is just rejected.  Rejected files
+# are listed with the reason in rejectsFileName, and the run carries on with the rest.  fileWorkers
+# files are read at once; 0 reads them in the run's own thread, with no timeout or memory limit.
+fileWorkers = min(4, os.cpu_count() or 1)
+fileTimeoutSeconds = 300
+fileMemoryLimit = 2 << 30
+rejectsFileName = 'Rejects.CSV'
+
+# Data files range from a day's LOG file of a few dozen rows to a season's HOBO export of hundreds
+# of thousands, so the workers are handed the files expected to take longest first (and each takes
+# the next file as soon as it is free) - a big file found last no longer keeps the run going long
+# after the other workers have run out of files.  How long each file took is kept in
+# fileCostsFileName in the output folder, with the file's signature: a file read before and not
+# changed since is expected to take as long again.  Any other file is expected to take its size
+# times the seconds per byte files with its extension took last time, or defaultSecondsPerByte if
+# there were none.  The progress of a run (see RunProgress) is measured in these expected seconds
+# too, rather than in files.
+fileCostsFileName = 'FileCosts.json'
+defaultSecondsPerByte = {'.xls': 1e-6, '.xlsx': 2e-6, '.csv': 3e-6, '.txt': 3e-6}
+
+# A run can be given a parse cache folder (RunContext's parseCacheFolder), shared by any number of
+# runs, e.g. the jobs of ServeStreamData.py.  What was read from each data file - its sorted runs,
+# SiteData, data rows and log text, as a worker process sends them back - is kept there in a pickle
+# named by a hash of the file's content (sha256), its path (which is in every row) and how it was
+# read: the kind of data, the instrument layouts and parseCacheVersion, which goes up whenever the
+# readers change what they make of a file.  A data file already in the cache isn't read again.
+# Only files that were read are kept - a rejected one is tried again.  The folder is never cleaned
+# up, and can be emptied at any time.
+parseCacheVersion = 1
+
+# Progress of the data files being read, given to a RunContext's progressCallback after each file
+# (and every progressReportSeconds while workers are reading): files, expected seconds (see fileCostsFileName) and bytes done of those being read, data rows read
+# and seconds since the files started being read
+RunProgress = namedtuple('RunProgress', 'filesDone, filesTotal, costDone, costTotal, bytesDone, bytesTotal, dataRows, seconds')
+
+# ProgressMeter averages the rates over about this many seconds of reading
+progressSmoothingSeconds = 10.0
+# While files are being read in worker processes, progress is also reported this often, with
+# credit for the files part read (see workerProgress)
+progressReportSeconds = 1.0
+
+# Worker processes are started afresh on every OS, as they have to be on Windows, rather than
+# forked from a run that may have threads going (watch mode, the service, the compressor).  Pools
+# running whole jobs (BatchStreamData, ServeStreamData) use it too.
+workerContext = multiprocessing.get_context('spawn')
+
+# Read one data file, adding its rows to ctx.sortedRuns - returns False if it isn't in a format
+# we can read
+def readDataFile(ctx, path, xlrdLog):
+    if ctx.doTemperature:
+        return processTemperatureFile(ctx, path)
+    return processLogFile(ctx, path, xlrdLog)
+
+# Why reading a data file raised an exception, for the rejects list
+def rejectReason(e):
+    if isinstance(e, MemoryError):
+        return 'ran out of memory'
+    return '%s: %s' % (type(e).__name__, str(e))
+
+# Size of a data file - for a file in an archive, its uncompressed size
+def dataFileBytes(path):
+    archivePath, member = splitArchivePath(path)
+    try:
+        if member is None:
+            return os.path.getsize(path)
+        with zipfile.ZipFile(archivePath) as archive:
+            return archive.getinfo(member).file_size
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return 0
+
+# Count a data file read, or rejected if reason isn't None, and save a checkpoint if one is due.
+# fileFormat, nRows, seconds and nBytes are for the metrics and the file costs: the file's format
+# (None if it wasn't recognized), its data rows, how long it took to read and its size.
+def fileDone(ctx, path, reason, fileFormat=None, nRows=0, seconds=0.0, nBytes=0):
+    ctx.metrics.fileRead(fileFormat, nRows, seconds, nBytes)
+    if reason is None:
+        ctx.nFilesProcessed += 1
+    else:
+        ctx.outputLogFile.write('Error processing %s: %s\n' % (path, reason))
+        ctx.nFilesFailed += 1
+        ctx.rejects.append((path, reason))
+    fileRead(ctx, path)
+    ctx.fileCosts[path] = {'signature': ctx.filesRead[path], 'seconds': seconds, 'bytes': nBytes}
+
+# Count a data file of nBytes and nRows rows as read in ctx.progress.  The workers count each file
+# as soon as it is read, ahead of its result being added to ctx, and report it with workerProgress.
+def fileProgress(ctx, path, nBytes, nRows):
+    progress = ctx.progress
+    ctx.progress = progress._replace(filesDone=progress.filesDone + 1, costDone=progress.costDone + ctx.costEstimates.pop(path, 0.0),
+                                     bytesDone=progress.bytesDone + nBytes, dataRows=progress.dataRows + nRows,
+                                     seconds=time.time() - ctx.progressStartTime)
+
+#
+# FILE COSTS
+#
+# See fileCostsFileName.  The costs are indexed by path; each has the file's signature when it was
+# read, the seconds it took and its size in bytes.
+def loadFileCosts(outputFolder):
+    try:
+        with open(os.path.join(outputFolder, fileCostsFileName)) as costsFile:
+            return json.load(costsFile)['files']
+    except (IOError, ValueError, KeyError):
+        return {}
+
+# Save the costs of the files still there and unchanged since they were read - replaced in one step
+# like the manifest
+def saveFileCosts(ctx):
+    files = dict((path, cost) for path, cost in ctx.fileCosts.items() if fileSignature(path) == cost['signature'])
+    costsPath = os.path.join(ctx.outputFolder, fileCostsFileName)
+    with open(costsPath + '.tmp', 'w') as costsFile:
+        json.dump({'files': files}, costsFile, indent=1, sort_keys=True)
+    os.replace(costsPath + '.tmp', costsPath)
+
+def fileExtension(path):
+    return os.path.splitext(splitArchivePath(path)[1] or path)[1].lower()
+
+# The seconds each of files, of sizes bytes, is expected to take to read, from ctx.fileCosts
+def estimateFileCosts(ctx, files, sizes):
+    rates = {}      # extension -> [seconds, bytes] of the files read before
+    for path, cost in ctx.fileCosts.items():
+        rate = rates.setdefault(fileExtension(path), [0.0, 0])
+        rate[0] += cost['seconds']
+        rate[1] += cost['bytes']
+
+    estimates = []
+    for path, size in zip(files, sizes):
+        cost = ctx.fileCosts.get(path)
+        if cost is not None and cost['signature'] == fileSignature(path):
+            estimates.append(cost['seconds'])
+            continue
+        extension = fileExtension(path)
+        seconds, nBytes = rates.get(extension, (0.0, 0))
+        secondsPerByte = seconds / nBytes if seconds > 0 and nBytes > 0 else defaultSecondsPerByte.get(extension, 3e-6)
+        estimates.append(secondsPerByte * size)
+    return estimates
+
+#
+# PARSE CACHE
+#
+# See parseCacheVersion
+class ParseCache(object):
+
+    def __init__(self, ctx):
+        self.folder = ctx.parseCacheFolder
+        how = hashlib.sha256(json.dumps([parseCacheVersion, ctx.doTemperature]).encode('utf-8'))
+        if not ctx.doTemperature:
+            how.update(dataFileDigest(ctx.layoutFile).encode('ascii'))
+        self.how = how.hexdigest()
+        os.makedirs(self.folder, exist_ok=True)
+
+    # The path of a data file's entry - from its content as it is now, so it is worked out before the
+    # file is read.  None if the file can't be read.
+    def entryPath(self, path):
+        try:
+            digest = dataFileDigest(path)
+        except (OSError, KeyError, zipfile.BadZipFile):
+            return None
+        entryHash = hashlib.sha256('\n'.join((self.how, path, digest)).encode('utf-8'))
+        return os.path.join(self.folder, entryHash.hexdigest() + '.pickle')
+
+    # What was read from a data file, as readFileResult returns it, from its entry - None if it
+    # isn't in the cache
+    def load(self, entryPath):
+        if entryPath is None:
+            return None
+        try:
+            with open(entryPath, 'rb') as entryFile:
+                return pickle.load(entryFile)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    # Keep what was read from a data file as its entry, unless it was rejected.  The entry is
+    # written to a file of its own and renamed into place, so runs saving it at once don't mix.
+    def save(self, entryPath, result):
+        if entryPath is None or result[0] is not None:
+            return
+        handle, tempPath = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as entryFile:
+                pickle.dump(result, entryFile, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempPath, entryPath)
+        except OSError:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+# The sha256 of a data file's content, as hex - for a file in an archive, of the file unpacked
+def dataFileDigest(path):
+    fileHash = hashlib.sha256()
+    with openDataFile(path) as dataFile:
+        for chunk in iter(lambda: dataFile.read(1 << 20), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+# Start the progress of reading files (see RunProgress), which are expected to take costs seconds
+# and are sizes bytes
+def startProgress(ctx, files, costs, sizes):
+    ctx.costEstimates = dict(zip(files, costs))
+    ctx.progress = RunProgress(0, len(files), 0.0, math.fsum(costs), 0, sum(sizes), 0, 0.0)
+    ctx.progressStartTime = ctx.progressReportTime = time.time()
+    if ctx.progressCallback is not None:
+        ctx.progressCallback(ctx.progress)
+
+# Report progress with credit for the files the workers are part way through - the seconds each
+# has been reading, up to most of what its file is expected to take - so a big file being read
+# alongside the small ones doesn't look like no progress until it is done
+def workerProgress(ctx, workers, files):
+    now = time.time()
+    partRead = math.fsum(min(now - worker.startTime, 0.9 * ctx.costEstimates.get(files[worker.index], 0.0))
+                         for worker in workers if worker.index is not None)
+    ctx.progressReportTime = now
+    ctx.progressCallback(ctx.progress._replace(costDone=ctx.progress.costDone + partRead, seconds=now - ctx.progressStartTime))
+
+# Turns the RunProgress reports of a run into how far through it is, how fast it is going and how
+# long it has left, e.g. for the GUI's progress bar.  The rates are moving averages over about
+# progressSmoothingSeconds of reading, so a big file or a run of small ones doesn't swing the ETA
+# about, and the time left counts down between reports.  Reports can be given at any rate -
+# repeats of the last one are ignored.
+class ProgressMeter(object):
+    def __init__(self):
+        self.progress = None        # last report
+        self.reportTime = None      # when it was given
+        self.costRate = None        # expected seconds of reading done per second
+        self.rowRate = None         # data rows read per second
+
+    def update(self, progress):
+        last = self.progress
+        if last is not None and (progress.filesTotal != last.filesTotal or progress.filesDone < last.filesDone):
+            last = None             # a new batch of files (watch mode)
+            self.costRate = self.rowRate = None
+        if last is not None and progress.seconds <= last.seconds:
+            return
+        if last is not None:
+            elapsed = progress.seconds - last.seconds
+            costRate = (progress.costDone - last.costDone) / elapsed
+            rowRate = (progress.dataRows - last.dataRows) / elapsed
+            if self.costRate is None:
+                self.costRate, self.rowRate = costRate, rowRate
+            else:
+                weight = 1.0 - math.exp(-elapsed / progressSmoothingSeconds)
+                self.costRate += weight * (costRate - self.costRate)
+                self.rowRate += weight * (rowRate - self.rowRate)
+        self.progress = progress
+        self.reportTime = time.time()
+
+    # How much of the reading is done, 0 to 1 - by expected seconds, or bytes if there are none
+    def fraction(self):
+        progress = self.progress
+        if progress is None:
+            return 0.0
+        if progress.costTotal > 0:
+            return min(1.0, progress.costDone / progress.costTotal)
+        if progress.bytesTotal > 0:
+            return min(1.0, progress.bytesDone / float(progress.bytesTotal))
+        return progress.filesDone / float(progress.filesTotal) if progress.filesTotal > 0 else 0.0
+
+    # Whether all the files have been read - the outputs are written after that
+    def done(self):
+        return self.progress is not None and self.progress.filesDone >= self.progress.filesTotal
+
+    # Seconds of reading left, None until there is a rate to go on
+    def secondsLeft(self):
+        if self.costRate is None or self.costRate <= 0:
+            return None
+        left = (self.progress.costTotal - self.progress.costDone) / self.costRate
+        return max(0.0, left - (time.time() - self.reportTime))
+
+    # Data rows read per second, None until there is a rate to go on
+    def rowsPerSecond(self):
+        return self.rowRate
+
+# Read a batch of data files, adding their rows to ctx.sortedRuns.  Nothing of a file that is
+# rejected goes into the outputs - not even the rows read before it went wrong - so each file's
+# runs are kept to one side until it has been read, and its sites taken out again if it is rejected.  Returns False if any of them was
+# rejected.
+def readDataFiles(ctx, files):
+    nFailed = ctx.nFilesFailed
+    sizes = [dataFileBytes(path) for path in files]
+    costs = estimateFileCosts(ctx, files, sizes)
+    startProgress(ctx, files, costs, sizes)
+    if ctx.parseCache is not None:
+        readDataFilesCached(ctx, files, costs)
+    elif ctx.fileWorkers > 0 and len(files) > 0:
+        readDataFilesInWorkers(ctx, files, costs)
+    else:
+        xlrdLog = XlrdLogFileFilter(ctx.outputLogFile, xlrdWarningsToSkip)
+        for path in files:
+            ctx.outputLogFile.write("=== %s ===\n" % path)
+            ctx.fileFormat = None
+            nDataRows = ctx.nDataRows
+            nSiteData = dict((site, len(siteDataList)) for site, siteDataList in ctx.sites.items())
+            sortedRuns, ctx.sortedRuns = ctx.sortedRuns, CollectedRuns()
+            startTime = time.time()
+            try:
+                reason = None if readDataFile(ctx, path, xlrdLog) else notReadableReason
+            except Exception as e:
+                reason = rejectReason(e)
+            fileRuns, ctx.sortedRuns = ctx.sortedRuns.runs, sortedRuns
+            if reason is None:
+                for run in fileRuns:
+                    ctx.sortedRuns.addRun(run)
+            else:
+                for site in list(ctx.sites):
+                    if site in nSiteData:
+                        del ctx.sites[site][nSiteData[site]:]
+                    else:
+                        del ctx.sites[site]
+                ctx.nDataRows = nDataRows
+            nBytes = dataFileBytes(path)
+            fileDone(ctx, path, reason, ctx.fileFormat, ctx.nDataRows - nDataRows, time.time() - startTime, nBytes)
+            fileProgress(ctx, path, nBytes, ctx.nDataRows - nDataRows)
+            if ctx.progressCallback is not None:
+                ctx.progressCallback(ctx.progress)
+            time.sleep(0)     # yield
+    return ctx.nFilesFailed == nFailed
+
+notReadableReason = 'not in a format that can be read - see LogFile.txt'
+
+# Stands in for the message queue in a worker process - the messages go back with the file's rows
+class MessageList(list):
+    def put(self, msg):
+        self.append(msg)
+
+# What a worker process needs to know of a run to read its data files
+def readerSettings(ctx):
+    return {'inputFolder': ctx.inputFolder, 'doTemperature': ctx.doTemperature, 'verbose': ctx.verbose,
+            'layoutRegistry': ctx.layoutRegistry, 'memoryLimit': ctx.fileMemoryLimit}
+
+# A RunContext for reading data files with readFileResult, from readerSettings
+def readerContext(settings):
+    ctx = RunContext('', settings['inputFolder'], settings['doTemperature'], False, settings['verbose'], MessageList(),
+                     checkpointFiles=0, checkpointSeconds=0, fileWorkers=0)
+    ctx.layoutRegistry = settings['layoutRegistry']
+    return ctx
+
+# Read a data file with a readerContext.  Returns what it added to the context: (reason it was
+# rejected or None, sorted runs, {site: [SiteData as tuples]}, data rows, log text, status
+# messages, file format, seconds taken, bytes).  A rejected file gives no runs, sites or data rows.
+def readFileResult(ctx, path):
+    messages = ctx.messageQueue
+    ctx.sortedRuns = CollectedRuns()
+    ctx.outputLogFile = io.StringIO()
+    ctx.nDataRows = 0
+    ctx.fileFormat = None
+    nSiteData = dict((site, len(siteDataList)) for site, siteDataList in ctx.sites.items())
+    startTime = time.time()
+    try:
+        reason = None if readDataFile(ctx, path, XlrdLogFileFilter(ctx.outputLogFile, xlrdWarningsToSkip)) else notReadableReason
+    except Exception as e:
+        reason = rejectReason(e)
+    newSites = dict((site, [tuple(siteData) for siteData in siteDataList[nSiteData.get(site, 0):]])
+                    for site, siteDataList in ctx.sites.items() if len(siteDataList) > nSiteData.get(site, 0))
+    if reason is None:
+        result = (reason, ctx.sortedRuns.runs, newSites, ctx.nDataRows)
+    else:
+        result = (reason, [], {}, 0)
+    result += (ctx.outputLogFile.getvalue(), list(messages), ctx.fileFormat, time.time() - startTime, dataFileBytes(path))
+    del messages[:]
+    return result
+
+# Worker process for readDataFilesInWorkers - reads the data files it is sent over conn, and sends
+# back what each one added to its RunContext (see readFileResult).  None tells it to stop.
+def fileWorkerMain(conn, settings):
+    if resource is not None and settings['memoryLimit'] > 0:
+        try:
+            softLimit, hardLimit = resource.getrlimit(resource.RLIMIT_AS)
+            limit = settings['memoryLimit'] if hardLimit == resource.RLIM_INFINITY else min(settings['memoryLimit'], hardLimit)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hardLimit))
+        except (ValueError, OSError):
+            pass
+    ctx = readerContext(settings)
+
+    while True:
+        path = conn.recv()
+        if path is None:
+            break
+        conn.send(readFileResult(ctx, path))
+
+# Read data files through ctx.parseCache: those in the cache are added from it, and the rest are
+# read - in worker processes if the run has any, otherwise one at a time here - and saved to it
+def readDataFilesCached(ctx, files, costs):
+    entryPaths = [ctx.parseCache.entryPath(path) for path in files]
+    cached = {}         # results from the cache, indexed by file
+    for index, entryPath in enumerate(entryPaths):
+        result = ctx.parseCache.load(entryPath)
+        if result is not None:
+            cached[index] = result
+    if len(cached) > 0:
+        ctx.statusCallback('%d of the %d data files were read before - taken from the parse cache' % (len(cached), len(files)))
+    if ctx.fileWorkers > 0 and len(cached) < len(files):
+        readDataFilesInWorkers(ctx, files, costs, cached, entryPaths)
+        return
+
+    reader = None
+    for index, path in enumerate(files):
+        result = cached.get(index)
+        if result is None:
+            if reader is None:
+                reader = readerContext(readerSettings(ctx))
+            result = readFileResult(reader, path)
+            ctx.parseCache.save(entryPaths[index], result)
+        fileProgress(ctx, path, result[8], result[3])
+        addFileResult(ctx, path, result)
+        if ctx.progressCallback is not None:
+            ctx.progressCallback(ctx.progress)
+
+# Keeps the sorted runs of a file read by a worker process, to send back
+class CollectedRuns(object):
+    def __init__(self):
+        self.runs = []
+
+    def addRun(self, rows):
+        self.runs.append(rows)
+
+# A worker process for readDataFilesInWorkers and the file it is reading
+class FileWorker(object):
+    def __init__(self, settings):
+        self.conn, workerConn = workerContext.Pipe()
+        self.process = workerContext.Process(target=fileWorkerMain, args=(workerConn, settings), daemon=True)
+        self.process.start()
+        workerConn.close()
+        self.index = None       # index of the file being read, None when idle
+        self.deadline = None
+        self.startTime = None
+
+    def start(self, index, path, timeout):
+        self.index = index
+        self.startTime = time.time()
+        self.deadline = time.time() + timeout if timeout > 0 else None
+        self.conn.send(path)
+
+    # Stop the worker - one still reading a file is killed
+    def stop(self):
+        try:
+            if self.index is None:
+                self.conn.send(None)
+                self.process.join(1)
+        except (OSError, ValueError):
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+# Read a batch of data files in fileWorkers worker processes, expected to take costs seconds each
+# (see fileCostsFileName) - the most costly are started first.  The results are added to ctx in the
+# same order as the files, so the log comes out the same however long each file takes.  If results
+# of more than sortBufferRows rows are waiting for a file that hasn't been started, it is started
+# next, so they don't pile up.
+def readDataFilesInWorkers(ctx, files, costs, cached=None, entryPaths=None):
+    settings = readerSettings(ctx)
+    workers = []
+    results = dict(cached or {})    # results not yet added to ctx, indexed by file
+    waitingRows = 0                 # data rows in results
+    order = sorted(range(len(files)), key=lambda index: -costs[index])     # most costly first
+    started = [index in results for index in range(len(files))]
+    nStarted = len(results)
+    for index, result in results.items():
+        waitingRows += result[3]
+        fileProgress(ctx, files[index], result[8], result[3])
+    nextOrder = 0       # next in order that may not have been started
+    nextResult = 0      # next file whose result is added to ctx
+    try:
+        workers = [FileWorker(settings) for _ in range(min(ctx.fileWorkers, len(files) - nStarted))]
+        while nextResult < len(files):
+            for worker in workers:
+                if worker.index is None and nStarted < len(files):
+                    if waitingRows >= sortBufferRows and not started[nextResult]:
+                        index = nextResult
+                    else:
+                        while started[order[nextOrder]]:
+                            nextOrder += 1
+                        index = order[nextOrder]
+                    started[index] = True
+                    nStarted += 1
+                    worker.start(index, files[index], ctx.fileTimeout)
+            busy = [worker for worker in workers if worker.index is not None]
+            deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+            wait = max(0, min(deadlines) - time.time()) if len(deadlines) > 0 else None
+            if ctx.progressCallback is not None:
+                wait = min(wait, progressReportSeconds) if wait is not None else progressReportSeconds
+            ready = multiprocessing.connection.wait([worker.conn for worker in busy], wait)
+            nFilesDone = ctx.progress.filesDone
+
+            for i, worker in enumerate(workers):
+                if worker.index is None:
+                    continue
+                if worker.conn in ready:
+                    try:
+                        result = results[worker.index] = worker.conn.recv()
+                        if entryPaths is not None:
+                            ctx.parseCache.save(entryPaths[worker.index], result)
+                        waitingRows += result[3]
+                        fileProgress(ctx, files[worker.index], result[8], result[3])
+                        worker.index = None
+                        continue
+                    except (EOFError, OSError):     # the worker died
+                        worker.process.join(5)
+                        reason = 'worker process crashed (exit code %s)' % worker.process.exitcode
+                elif worker.deadline is not None and time.time() >= worker.deadline:
+                    reason = 'took longer than %g seconds' % ctx.fileTimeout
+                else:
+                    continue
+                # Nothing came back from the worker - reject the file and start a new worker
+                results[worker.index] = (reason, [], {}, 0, '', [], None, time.time() - worker.startTime,
+                                         dataFileBytes(files[worker.index]))
+                fileProgress(ctx, files[worker.index], results[worker.index][8], 0)
+                worker.stop()
+                workers[i] = FileWorker(settings)
+
+            if ctx.progressCallback is not None and (ctx.progress.filesDone > nFilesDone or
+                                                     time.time() - ctx.progressReportTime >= progressReportSeconds):
+                workerProgress(ctx, workers, files)
+
+            while nextResult in results:
+                result = results.pop(nextResult)
+                waitingRows -= result[3]
+                addFileResult(ctx, files[nextResult], result)
+                nextResult += 1
+    finally:
+        for worker in workers:
+            worker.stop()
+
+# Add what was read from a data file (see readFileResult) to ctx
+def addFileResult(ctx, path, result):
+    reason, runs, sites, nDataRows, logText, messages, fileFormat, seconds, nBytes = result
+    for msg in messages:
+        ctx.statusCallback(msg)
+    ctx.outputLogFile.write("=== %s ===\n" % path)
+    ctx.outputLogFile.write(logText)
+    for run in runs:
+        ctx.sortedRuns.addRun(run)
+    for site, siteDataList in sites.items():
+        ctx.sites.setdefault(site, []).extend(SiteData(*siteData) for siteData in siteDataList)
+    ctx.nDataRows += nDataRows
+    fileDone(ctx, path, reason, fileFormat, nDataRows, seconds, nBytes)
+
+# Write the list of rejected data files and why they were rejected
+def writeRejects(ctx):
+    rejectsPath = compressedPath(os.path.join(ctx.outputFolder, rejectsFileName), ctx.compression)
+    ctx.outputPaths.append(rejectsPath)
+    with openOutputText(rejectsPath, ctx.compression) as rejectsFile:
+        writer = csv.writer(rejectsFile, lineterminator='\n')
+        writer.writerow(['File', 'Reason'])
+        writer.writerows(ctx.rejects)
+
+# Process a batch of data files - their rows are added to ctx.sortedRuns and the outputs (and the
+# coverage report and rejects list) are written again from all the runs so far.  A shard run
+# writes its bundle instead.
+def processFiles(ctx, files, keepSites=False):
+    nSiteData = dict((site, len(siteDataList)) for site, siteDataList in ctx.sites.items())
+    if not readDataFiles(ctx, files):
+        ctx.statusCallback("Some files could not be read - they are listed in %s\n" % rejectsFileName)
+    if len(files) > 0:
+        saveFileCosts(ctx)
+    if ctx.shard is not None:
+        writeShardBundle(ctx)
+    else:
+        # Sites none of the files were for have the same rows as when the outputs were last written
+        keptSites = set()
+        if keepSites:
+            keptSites = set(site for site, siteDataList in ctx.sites.items() if len(siteDataList) == nSiteData.get(site, 0))
+        writeOutputs(ctx, keptSites)
+    writeMetrics(ctx)
+
+# Write the outputs, the coverage report and the rejects list from the sorted runs.  The per-site
+# outputs of keptSites - their temperature EIM files and rollups - already written by this process
+# are kept as they are (see watchLoop).
+def writeOutputs(ctx, keptSites=()):
+    ctx.outputPaths = []
+    if ctx.doTemperature:
+        emitTemperatureOutputs(ctx, keptSites)
+    else:
+        emitLogOutputs(ctx, keptSites)
+    writeCoverageReport(ctx)
+    writeRejects(ctx)
+    ctx.metrics.outputWritten(ctx.outputPaths)
+
+# Report on the run once its output files are closed, and let go of the data it accumulated
+def finishRun(ctx):
 
-    if messageQueue is not None:
-        messageQueue.put(string)
-    else:       # command line
-        print(string)
+    writeMetrics(ctx, True)
+    if ctx.qualityChecker.nFlagged > 0:
+        ctx.statusCallback('QC: %d values outside the rolling median +/- %g MAD window were flagged "%s"' % (ctx.qualityChecker.nFlagged, ctx.qcThreshold, qcQualifier))
+    ctx.qualityChecker = None
+
+    # Dump out collected per-site data
+    if not ctx.doTemperature:
+        for site in ctx.sites:
+            ctx.statusCallback('For "' + site +'"')
+            for item in ctx.sites[site]:
+                ctx.statusCallback('\tData from %s to %s' % (str(item.minDate), str(item.maxDate)))
+                ctx.statusCallback('\t%d records from: %s' % (item.numRecs, item.filePath))
+            ctx.statusCallback('-'*50)
+    ctx.statusCallback(DONE_MESSAGE)
 
 # Main entry point - called from GUI or from main below if run from the command line
-def FormatStreamData(outputFolder, inputFolder, doTemperature, DoE_Temperature, Verbosity, msgQueue):
+def FormatStreamData(outputFolder, inputFolder, doTemperature, DoE_Temperature, Verbosity, msgQueue, **options):
     """This function is called by the GUI in a thread of execution to format the desired raw data files. User-selected
     options on the GUI are passed here as parameters. TempOrHI9829 indicates whether HOBO data files or HI9829 LOG files
     will be formatted (defualt is for HI9829 LOG files). EcologyOutput indicates whether or not this script should create
-    files formatted for the Department of Ecology EIM (default is not to create EIM files)."""
-
-    global verbose
-    global outputCSVSummary
-    global outputCSVDoE
-    global sites
-    global DoEOutputOption
-    global messageQueue
-    
-    messageQueue = msgQueue
+    files formatted for the Department of Ecology EIM (default is not to create EIM files). Any other options
+    (e.g. qcThreshold) are passed on to the RunContext for the run."""
 
-    verbose = Verbosity
-    DoEOutputOption = DoE_Temperature
-    
-    # Only supporting Windows for now..
-    if (platform.system() != 'Windows'):
-        statusCallback('Sorry, this script is supported only on Windows for now... bug Mike')
-        sys.exit(2)
-   
-    if inputFolder == '' or not os.path.isdir(inputFolder):
-        statusCallback(inputFolder+' is not a folder containing data files.')
+    ctx = RunContext(outputFolder, inputFolder, doTemperature, DoE_Temperature, Verbosity, msgQueue, **options)
+    if not runStreamData(ctx):
         return None
+    return "<<DONE>>"
+
+# Do a complete run for ctx - returns False if the run couldn't be started.  The counts in
+# ctx (nFilesProcessed etc.) say how it went.
+def runStreamData(ctx):
+    if not startRun(ctx):
+        return False
 
-    # Open up log file        
     try:
-        logPath = os.path.join(outputFolder, "LogFile.txt")
-        outputLogFile = open(logPath, 'w')
-    except IOError as e:
-        statusCallback('Error opening '+logPath+': '+ str(e))
-        return None
+        if not openOutputFiles(ctx):
+            return False
+   
+        # Get list of files to process - either temperature or logger files - or the shard's share
+        # of them.  When resuming, the files read before the checkpoint are already in the sorted runs.
+        files = collectFiles(ctx, ctx.inputFolder, ctx.doTemperature)
+        if ctx.shard is not None:
+            files = shardFiles(ctx, files)
+        files = [path for path in files if path not in ctx.filesRead]
+
+        if ctx.verbose:
+            ctx.statusCallback('Back from collectFiles')
 
+        processFiles(ctx, files)
+    finally:
+        ctx.close()
 
-    if doTemperature:
-        # For temperature data - we just emit per-site DoE summary files, not
-        # an aggregated file as we do for loggers
-        outputSummaryPath = os.path.join(outputFolder, 'TemperatureData.CSV')
+    removeCheckpoint(ctx)
+    finishRun(ctx)
+    return True
 
+#
+# METRICS
+#
+# Counts for monitoring scheduled runs - files read and rejected, rows by data file format and by
+# site, how long each file took to read, bytes read and written - written to the output folder in
+# Prometheus text format (metricsPrometheusFileName, e.g. for node_exporter's textfile collector)
+# and as JSON (metricsJSONFileName) whenever the outputs are written: at the end of a run, and in
+# watch mode after each batch of new files and each poll.  Each file is replaced in one step, so
+# whatever reads it never sees half of it.
+metricsPrometheusFileName = 'Metrics.prom'
+metricsJSONFileName = 'Metrics.json'
+parseSecondsBuckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+# What the metrics add up from each data file read and each time the outputs are written.  The
+# file and row counts, the rows per site and the QC flags are taken from the RunContext itself.
+class RunMetrics(object):
+
+    def __init__(self):
+        self.formatFiles = {}       # data files read by format (instrument layout or HOBO flavor)
+        self.formatRows = {}        # data rows read by format
+        self.parseCounts = [0] * (len(parseSecondsBuckets) + 1)    # files by parseSecondsBuckets bucket, the last for longer
+        self.parseSeconds = 0.0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+    def fileRead(self, fileFormat, nRows, seconds, nBytes):
+        if fileFormat is not None:
+            self.formatFiles[fileFormat] = self.formatFiles.get(fileFormat, 0) + 1
+            self.formatRows[fileFormat] = self.formatRows.get(fileFormat, 0) + nRows
+        self.parseCounts[bisect_left(parseSecondsBuckets, seconds)] += 1
+        self.parseSeconds += seconds
+        self.bytesRead += nBytes
+
+    def outputWritten(self, paths):
+        for path in paths:
+            try:
+                self.bytesWritten += os.path.getsize(path)
+            except OSError:
+                pass
+
+    # The metrics as plain values, for checkpoints and shard bundles, and back
+    def state(self):
+        return dict(vars(self))
+
+    def restore(self, state):
+        self.__dict__.update(state)
+
+    # Add in the metrics of another run - e.g. of a shard, for the merge
+    def add(self, other):
+        for fileFormat, nFiles in other.formatFiles.items():
+            self.formatFiles[fileFormat] = self.formatFiles.get(fileFormat, 0) + nFiles
+        for fileFormat, nRows in other.formatRows.items():
+            self.formatRows[fileFormat] = self.formatRows.get(fileFormat, 0) + nRows
+        self.parseCounts = [count + otherCount for count, otherCount in zip(self.parseCounts, other.parseCounts)]
+        self.parseSeconds += other.parseSeconds
+        self.bytesRead += other.bytesRead
+        self.bytesWritten += other.bytesWritten
+
+# The metrics of the run so far, as written to metricsJSONFileName
+def metricsValues(ctx, finished=False):
+    metrics = ctx.metrics
+    rowsBySite = dict((site, sum(siteData.numRecs for siteData in siteDataList)) for site, siteDataList in ctx.sites.items())
+    buckets = []
+    count = 0
+    for le, bucketCount in zip(parseSecondsBuckets + ['+Inf'], metrics.parseCounts):
+        count += bucketCount
+        buckets.append([le, count])
+    return {'inputFolder': ctx.inputFolder, 'outputFolder': ctx.outputFolder,
+            'kind': 'temperature' if ctx.doTemperature else 'logger',
+            'shard': '%d/%d' % ctx.shard if ctx.shard is not None else None,
+            'startTime': ctx.startTime, 'updateTime': time.time(), 'seconds': time.time() - ctx.startTime,
+            'finished': finished, 'filesProcessed': ctx.nFilesProcessed, 'filesFailed': ctx.nFilesFailed,
+            'dataRows': ctx.nDataRows, 'qcFlagged': ctx.qualityChecker.nFlagged if ctx.qualityChecker is not None else 0,
+            'filesByFormat': metrics.formatFiles, 'rowsByFormat': metrics.formatRows, 'rowsBySite': rowsBySite,
+            'parseSeconds': {'buckets': buckets, 'sum': metrics.parseSeconds, 'count': count},
+            'bytesRead': metrics.bytesRead, 'bytesWritten': metrics.bytesWritten}
+
+# A Prometheus label value, with \, " and newlines escaped
+def prometheusLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# metricsValues in Prometheus text format
+def prometheusText(values):
+    lines = []
+
+    def sample(name, labels, value):
+        labelText = ','.join('%s="%s"' % (label, prometheusLabel(labelValue)) for label, labelValue in labels)
+        lines.append('%s%s %s' % (name, '{%s}' % labelText if labelText else '', repr(float(value)) if isinstance(value, float) else value))
+
+    def metric(name, kind, helpText, samples):
+        lines.append('# HELP %s %s' % (name, helpText))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            sample(name, labels, value)
+
+    metric('streamdata_run_info', 'gauge', 'The run the metrics are for.',
+           [([('input_folder', values['inputFolder']), ('output_folder', values['outputFolder']),
+              ('kind', values['kind']), ('shard', values['shard'] or '')], 1)])
+    metric('streamdata_run_start_time_seconds', 'gauge', 'When the run started, in seconds since the epoch.', [([], values['startTime'])])
+    metric('streamdata_last_update_time_seconds', 'gauge', 'When these metrics were written, in seconds since the epoch.', [([], values['updateTime'])])
+    metric('streamdata_run_duration_seconds', 'gauge', 'Seconds since the run started.', [([], values['seconds'])])
+    metric('streamdata_run_finished', 'gauge', '1 once the run has finished.', [([], int(values['finished']))])
+    metric('streamdata_files_processed_total', 'counter', 'Data files read.', [([], values['filesProcessed'])])
+    metric('streamdata_files_failed_total', 'counter', 'Data files that could not be read.', [([], values['filesFailed'])])
+    metric('streamdata_data_rows_total', 'counter', 'Data rows read.', [([], values['dataRows'])])
+    metric('streamdata_qc_flagged_total', 'counter', 'Values flagged by QA/QC.', [([], values['qcFlagged'])])
+    metric('streamdata_format_files_total', 'counter', 'Data files read by format (instrument layout or HOBO flavor).',
+           [([('format', fileFormat)], nFiles) for fileFormat, nFiles in sorted(values['filesByFormat'].items())])
+    metric('streamdata_format_rows_total', 'counter', 'Data rows read by format (instrument layout or HOBO flavor).',
+           [([('format', fileFormat)], nRows) for fileFormat, nRows in sorted(values['rowsByFormat'].items())])
+    metric('streamdata_site_rows', 'gauge', 'Data rows for each site.',
+           [([('site', site)], nRows) for site, nRows in sorted(values['rowsBySite'].items())])
+    parseSeconds = values['parseSeconds']
+    metric('streamdata_file_parse_seconds', 'histogram', 'Seconds taken to read each data file.', [])
+    for le, count in parseSeconds['buckets']:
+        sample('streamdata_file_parse_seconds_bucket', [('le', le)], count)
+    sample('streamdata_file_parse_seconds_sum', [], float(parseSeconds['sum']))
+    sample('streamdata_file_parse_seconds_count', [], parseSeconds['count'])
+    metric('streamdata_bytes_read_total', 'counter', 'Bytes of data files read.', [([], values['bytesRead'])])
+    metric('streamdata_bytes_written_total', 'counter', 'Bytes of output files written (not counting the log).', [([], values['bytesWritten'])])
+    return '\n'.join(lines) + '\n'
+
+# Write the metrics files to the output folder - finished is True at the end of the run
+def writeMetrics(ctx, finished=False):
+    values = metricsValues(ctx, finished)
+    for fileName, text in [(metricsJSONFileName, json.dumps(values, indent=1, sort_keys=True) + '\n'),
+                           (metricsPrometheusFileName, prometheusText(values))]:
+        path = os.path.join(ctx.outputFolder, fileName)
         try:
-            outputCSVSummary = open(outputSummaryPath, 'w')
-        except IOError as e:
-            statusCallback('Error opening '+outputSummaryPath,': ')
-            raise
+            with open(path + '.tmp', 'w', newline='\n') as metricsFile:
+                metricsFile.write(text)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            ctx.statusCallback('Error writing %s: %s' % (path, str(e)))
 
-        statusCallback('Processing Temperature file data in "'+ inputFolder+ '"...')
-        statusCallback('Writing to:\n'+outputSummaryPath+'\nand per-site DoE files named Xxxxx_Temperature_DoE.csv\n')
-    else:
-        # We emit two output files - Summary  which is an aggregated summary of all the data files
-        # we read, and DoESummary which is for input to the DoE site (the EIM database) in a format they prescribe.
-        outputSummaryPath = os.path.join(outputFolder, 'StreamData.CSV')
-        if DoEOutputOption:
-            todaysDate = time.strftime("%m/%d/%Y")
-            outputDoESummaryPath = os.path.join(outputFolder, 'HI-9829_EIM_'+todaysDate+'.CSV')
-        
+#
+# WATCH MODE
+#
+# Finds the data files under a folder like collectFiles, but remembers each directory's
+# modification time and contents.  A directory's modification time changes when files are
+# added to, removed from or renamed in it, so on the next scan only directories whose time
+# changed are listed again - an idle scan is one stat() per directory.
+class FolderScanner(object):
+
+    def __init__(self, inputFolder, doTemp):
+        self.inputFolder = inputFolder
+        self.logFilePattern = logFilePatternFor(doTemp)
+        self.dirs = {}      # indexed by directory path: (mtime, [subdirectories], [data files], [archives])
+        self.archives = {}  # indexed by archive path: (signature, [data files in it])
+
+    def scan(self):
+        found = []
+        seen = set()
+        self.scanDir(self.inputFolder, found, seen)
+        # Forget directories and archives that have gone away
+        for cache in (self.dirs, self.archives):
+            for path in list(cache.keys()):
+                if path not in seen:
+                    del cache[path]
+        return found
+
+    # An archive's list of data files is re-read when its size or modification time changes - one
+    # that can't be read yet (e.g. it is still being copied) is tried again on the next scan
+    def scanArchive(self, path, found, seen):
+        signature = fileSignature(path)
+        seen.add(path)
+        cached = self.archives.get(path)
+        if cached is None or cached[0] != signature:
             try:
-                outputCSVDoE = open(outputDoESummaryPath, 'w')
-            except IOError as e:
-                statusCallback('Error opening '+outputDoESummaryPath,': ')
-                raise
+                cached = self.archives[path] = (signature, archiveMembers(path, self.logFilePattern))
+            except (zipfile.BadZipFile, OSError):
+                self.archives.pop(path, None)
+                return
+        found.extend(cached[1])
 
+    def scanDir(self, path, found, seen):
         try:
-            outputCSVSummary = open(outputSummaryPath, 'w')
-        except IOError as e:
-            statusCallback('Error opening '+outputSummaryPath,': ')
-            raise
-    
-        statusCallback('Processing LOG file data in "'+ inputFolder+ '"...')
-        statusCallback('Writing to "'+ outputSummaryPath+ '"...')
-   
-    # Get list of files to process - either temperature or logger files
-    files = collectFiles(inputFolder, outputFolder, doTemperature)
-
-    if verbose:
-        statusCallback('Back from collectFiles')
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        seen.add(path)
+        cached = self.dirs.get(path)
+        if cached is None or cached[0] != mtime:
+            subdirs = []
+            files = []
+            archives = []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.path)
+                        elif entry.name not in filesToExclude and re.match(self.logFilePattern, entry.name):
+                            files.append(entry.path)
+                        elif isArchiveName(entry.name):
+                            archives.append(entry.path)
+            except OSError:
+                return
+            cached = self.dirs[path] = (mtime, sorted(subdirs), sorted(files), sorted(archives))
+        found.extend(cached[2])
+        for archive in cached[3]:
+            self.scanArchive(archive, found, seen)
+        for subdir in cached[1]:
+            self.scanDir(subdir, found, seen)
+
+# The manifest of processed files kept in the output folder in watch mode - indexed by
+# path, each file has the size and modification time it had when it was processed
+def loadManifest(outputFolder):
+    try:
+        with open(os.path.join(outputFolder, manifestFileName)) as manifestFile:
+            return json.load(manifestFile)
+    except (IOError, ValueError):
+        return { 'files' : {} }
+
+def saveManifest(outputFolder, manifest):
+    manifestPath = os.path.join(outputFolder, manifestFileName)
+    with open(manifestPath + '.tmp', 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=1, sort_keys=True)
+    os.replace(manifestPath + '.tmp', manifestPath)
+
+# Size and modification time of a file, None if it has gone away
+def fileSignature(path):
+    try:
+        st = os.stat(splitArchivePath(path)[0])     # a file in an archive has the archive's signature
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+# Watch mode entry point - does a full run, then keeps polling inputFolder for new data files
+# and processes them as they land: the new files' rows are merged with the sorted runs kept from
+# the files already read and the outputs are written again.  Runs until stopEvent (a threading.Event) is set or, from the
+# command line, until Ctrl-C.
+def watchStreamData(outputFolder, inputFolder, doTemperature, DoE_Temperature, Verbosity, msgQueue,
+                    stopEvent=None, pollSeconds=None, settleSeconds=None, **options):
+    if pollSeconds is None:
+        pollSeconds = watchPollSeconds
+    if settleSeconds is None:
+        settleSeconds = watchSettleSeconds
+
+    ctx = RunContext(outputFolder, inputFolder, doTemperature, DoE_Temperature, Verbosity, msgQueue, **options)
+    # The checkpoint is saved after each batch rather than every so many files, and is only picked
+    # up if the manifest says it is from watching the same folder
+    manifest = loadManifest(ctx.outputFolder)
+    ctx.checkpointing = True
+    ctx.checkpointFiles = ctx.checkpointSeconds = 0
+    ctx.resume = manifest.get('inputFolder') == ctx.inputFolder and manifest.get('temperature') == doTemperature
+    if not startRun(ctx):
+        return None
 
-    
-    if doTemperature:
-        processTemperatureFiles(files, outputLogFile, outputFolder)
-    else:
-        if not processLogFiles(outputLogFile, files):
-            statusCallback("Something went wrong, check the error log\n")
-        
-    outputCSVSummary.close()
-    outputLogFile.close()
+    try:
+        if not openOutputFiles(ctx):
+            return None
+        watchLoop(ctx, manifest, stopEvent, pollSeconds, settleSeconds)
+    finally:
+        ctx.close()
 
-    # Dump out collected per-site data
-    if not doTemperature:
-        for site in sites:
-            statusCallback('For "' + site +'"')
-            for item in sites[site]:
-                statusCallback('\tData from %s to %s' % (str(item.minDate), str(item.maxDate)))
-                statusCallback('\t%d records from: %s' % (item.numRecs, item.filePath))
-            statusCallback('-'*50)
-    statusCallback(DONE_MESSAGE)
+    finishRun(ctx)
     return "<<DONE>>"
 
+# Poll for new files until stopped - see watchStreamData.  manifest is the one left by the last
+# time watch mode ran.
+def watchLoop(ctx, manifest, stopEvent, pollSeconds, settleSeconds):
+    inputFolder = ctx.inputFolder
+    outputFolder = ctx.outputFolder
+    doTemperature = ctx.doTemperature
+    scanner = FolderScanner(inputFolder, doTemperature)
+    # The files processed are those in the kept runs - none if the checkpoint couldn't be used, in
+    # which case the outputs are rebuilt from scratch
+    manifest = { 'inputFolder' : inputFolder, 'temperature' : doTemperature, 'files' : dict(ctx.filesRead) }
+    pending = {}        # new files waiting to settle, indexed by path: signature last seen
+
+    try:
+        firstPass = True
+        while True:
+            found = scanner.scan()
+            ready = []
+            for path in found:
+                signature = fileSignature(path)
+                if signature is None:
+                    continue
+                if path in manifest['files']:
+                    if signature != manifest['files'][path] and path not in pending:
+                        ctx.statusCallback('%s changed after it was processed - restart watch mode to pick up the change' % path)
+                        pending[path] = signature   # only warn once
+                    continue
+                # The first pass processes everything there, like a normal run - after that a
+                # file has to sit unchanged for a poll and be settleSeconds old
+                if firstPass or (pending.get(path) == signature and time.time() - signature[1] >= settleSeconds):
+                    ready.append(path)
+                    pending.pop(path, None)
+                else:
+                    pending[path] = signature
+
+            if len(ready) > 0:
+                ctx.statusCallback('Processing %d new file(s)' % len(ready))
+                processFiles(ctx, ready, keepSites=not firstPass)
+                writeCheckpoint(ctx)
+                manifest['files'] = dict(ctx.filesRead)
+                saveManifest(outputFolder, manifest)
+                ctx.outputLogFile.flush()
+                ctx.statusCallback('Outputs updated - watching "%s" for new files...' % inputFolder)
+            elif firstPass:
+                processFiles(ctx, [])       # outputs from the kept runs, or with just the headers
+                writeCheckpoint(ctx)
+                saveManifest(outputFolder, manifest)
+                ctx.statusCallback('Watching "%s" for new files...' % inputFolder)
+            else:
+                writeMetrics(ctx)           # nothing new, but the metrics show watch mode is still going
+            firstPass = False
+
+            if stopEvent is not None:
+                if stopEvent.wait(pollSeconds):
+                    break
+            else:
+                time.sleep(pollSeconds)
+    except KeyboardInterrupt:
+        ctx.statusCallback('Stopping watch mode')
+
+# Parse a byte count such as 500000, 900K or 50M - returns None if it isn't one
+def parseByteCount(text):
+    multipliers = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    text = text.strip().upper().rstrip('B')
+    multiplier = 1
+    if text[-1:] in multipliers:
+        multiplier = multipliers[text[-1]]
+        text = text[:-1]
+    try:
+        count = int(float(text) * multiplier)
+    except ValueError:
+        return None
+    return count if count >= 0 else None
+
 def helpMessage():
     print('Usage:')
     print('FormatStreamData.py [-t] [-h] [-v] [-e] [-o <outputFolder>] -i <inputFolder>')
@@ -980,28 +3554,49 @@ def helpMessage():
     print('    -e   - output WA Department of Ecology EIM-formatted .csv files')
     print('    -h   - print this help message')
     print('    -v   - verbose output (for debugging the tool)')
+    print('    -k   - QC threshold - flag values more than this many MADs from the rolling median (default %g, 0 = off)' % qcThreshold)
+    print('    --qc-window=<n> - number of previous values per site/parameter in the QC rolling window (default %d)' % qcWindowSize)
+    print('    -w   - watch mode: after processing, keep watching <inputFolder> and process new files as they arrive (Ctrl-C to stop)')
+    print('           started again, only the files new since the last time are read - each batch re-writes the summary')
+    print('           CSV, and the per-site outputs of the sites it has data for')
+    print('    --poll=<seconds> - watch mode: how often to check for new files (default %d)' % watchPollSeconds)
+    print('    --settle=<seconds> - watch mode: how long a new file must be unchanged before it is processed (default %d)' % watchSettleSeconds)
+    print('    --eim-max-rows=<n> - split EIM files into parts of at most n data rows (default 0 = no limit)')
+    print('    --eim-max-bytes=<n> - split EIM files into parts of at most n bytes, K and M suffixes allowed (default 0 = no limit)')
+    print('    --layouts=<file> - HI-9829 column layouts file (default %s next to this script)' % layoutRegistryFileName)
+    print('    -z   - gzip-compress the output CSVs (not the log file)')
+    print('    --compress=<type> - compress the output CSVs with one of: %s' % ', '.join(availableCompressions()))
+    print('    --resume - carry on an interrupted run from its last checkpoint in <outputFolder>')
+    print('    --checkpoint-files=<n> - save a checkpoint every n data files (default %d, 0 = off)' % checkpointEveryFiles)
+    print('    --checkpoint-seconds=<n> - save a checkpoint every n seconds (default %d, 0 = off)' % checkpointEverySeconds)
+    print('    -j, --file-workers=<n> - worker processes reading data files (default %d, 0 = read them in this process)' % fileWorkers)
+    print('    --file-timeout=<seconds> - reject a data file that takes longer than this to read (default %g, 0 = no limit)' % fileTimeoutSeconds)
+    print('    --file-memory=<n> - memory limit for reading a data file, K, M and G suffixes allowed (default %dM, 0 = no limit, not on Windows)' % (fileMemoryLimit >> 20))
+    print('    --sketch=<k> - keep KLL sketches of size k in the rollups instead of all the rounded readings (default 0 = off, 200 is a good size)')
+    print('    --shard=<i/N> - read only shard i of N of the data files and write a shard bundle, not the outputs (see MergeStreamData.py)')
     sys.exit(2)
 
 
 def main(argv):
 
-    global verbose
-
-    # Only supporting Windows for now...
-    if (platform.system() != 'Windows'):
-        print('Sorry, this script is supported only on Windows for now... bug Evan')
-        sys.exit(2)
-
     # Defaults for output folder, input folder and whether we are processing logger or
     # temperature files
     outputFolder = 'ProcessedStreamData'
     inputFolder = '.'
     doTemperature = False
     DoEOutputOption = False
+    verbose = False
+    options = {}
+    watch = False
+    pollSeconds = watchPollSeconds
+    settleSeconds = watchSettleSeconds
 
     # Arguments passed on command line are in the "argv" list
     try:
-        opts, args = getopt.getopt(argv,"vhi:o:te",["verbose", "help", "input=", "help", "output=", "temp", "ecology"])
+        opts, args = getopt.getopt(argv,"vhi:o:tek:wzj:",["verbose", "help", "input=", "help", "output=", "temp", "ecology", "qc-threshold=", "qc-window=",
+                                                     "watch", "poll=", "settle=", "eim-max-rows=", "eim-max-bytes=",
+                                                     "compress=", "layouts=", "resume", "checkpoint-files=", "checkpoint-seconds=",
+                                                     "file-workers=", "file-timeout=", "file-memory=", "shard=", "sketch="])
     except getopt.GetoptError:
         helpMessage()
     for opt, arg in opts:
@@ -1017,8 +3612,101 @@ def main(argv):
             doTemperature = True
         elif opt in ("-e", "--ecology"):
             DoEOutputOption = True
-
-    FormatStreamData(outputFolder, inputFolder, doTemperature, DoEOutputOption, verbose, None)
+        elif opt in ("-k", "--qc-threshold"):
+            try:
+                options['qcThreshold'] = float(arg)
+            except ValueError:
+                helpMessage()
+        elif opt == "--qc-window":
+            try:
+                options['qcWindowSize'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['qcWindowSize'] < 1:
+                helpMessage()
+        elif opt in ("-w", "--watch"):
+            watch = True
+        elif opt in ("--poll", "--settle"):
+            try:
+                seconds = float(arg)
+            except ValueError:
+                helpMessage()
+            if opt == "--poll":
+                pollSeconds = seconds
+            else:
+                settleSeconds = seconds
+        elif opt == "--eim-max-rows":
+            try:
+                options['eimMaxRows'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['eimMaxRows'] < 0:
+                helpMessage()
+        elif opt == "--eim-max-bytes":
+            options['eimMaxBytes'] = parseByteCount(arg)
+            if options['eimMaxBytes'] is None:
+                helpMessage()
+        elif opt == "-z":
+            options['compression'] = 'gzip'
+        elif opt == "--compress":
+            if arg not in availableCompressions():
+                print('--compress must be one of: %s' % ', '.join(availableCompressions()))
+                sys.exit(2)
+            options['compression'] = arg
+        elif opt == "--layouts":
+            options['layoutFile'] = arg
+        elif opt == "--resume":
+            options['resume'] = True
+        elif opt in ("--checkpoint-files", "--checkpoint-seconds"):
+            try:
+                count = float(arg)
+            except ValueError:
+                helpMessage()
+            if count < 0:
+                helpMessage()
+            if opt == "--checkpoint-files":
+                options['checkpointFiles'] = int(count)
+            else:
+                options['checkpointSeconds'] = count
+        elif opt in ("-j", "--file-workers"):
+            try:
+                options['fileWorkers'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['fileWorkers'] < 0:
+                helpMessage()
+        elif opt == "--file-timeout":
+            try:
+                options['fileTimeout'] = float(arg)
+            except ValueError:
+                helpMessage()
+            if options['fileTimeout'] < 0:
+                helpMessage()
+        elif opt == "--file-memory":
+            options['fileMemoryLimit'] = parseByteCount(arg)
+            if options['fileMemoryLimit'] is None:
+                helpMessage()
+        elif opt == "--sketch":
+            try:
+                options['rollupSketch'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['rollupSketch'] < 0 or 0 < options['rollupSketch'] < 8:
+                helpMessage()
+        elif opt == "--shard":
+            options['shard'] = parseShard(arg)
+            if options['shard'] is None:
+                print('--shard must be i/N, with i from 1 to N')
+                sys.exit(2)
+
+    if watch and 'shard' in options:
+        print('Watch mode can\'t be used with --shard')
+        sys.exit(2)
+    if watch:
+        watchStreamData(outputFolder, inputFolder, doTemperature, DoEOutputOption, verbose, None,
+                        pollSeconds=pollSeconds, settleSeconds=settleSeconds, **options)
+    else:
+        FormatStreamData(outputFolder, inputFolder, doTemperature, DoEOutputOption, verbose, None, **options)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
@@ -16,8 +16,36 @@ from tkinter import ttk
 import tkinter.scrolledtext as tkst
 import threading as thd
 import FormatStreamData
+import PreviewStreamData
 import os
+import sys
 import queue
+import time
+import subprocess
+import multiprocessing
+
+
+# How often the progress bar, ETA and rows/sec are brought up to date while a run is going
+ProgressRefreshSeconds = 0.5
+# How far the bar moves at each refresh while the outputs are being written (the bar is 0 to 100)
+ProgressStepSize = 5
+
+
+# A number of seconds as e.g. "45 s", "3 min 20 s" or "1 h 05 min", for the ETA
+def FormatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%d s" % seconds
+    if seconds < 3600:
+        return "%d min %02d s" % (seconds // 60, seconds % 60)
+    return "%d h %02d min" % (seconds // 3600, seconds % 3600 // 60)
+
+
+# The icon and welcome message are next to this script (or the frozen .exe), wherever it is run from
+if getattr(sys, 'frozen', False):
+    ResourceFolder = os.path.dirname(sys.executable)
+else:
+    ResourceFolder = os.path.dirname(os.path.abspath(__file__))
 
 
 class KCStreamDataApp():
@@ -26,7 +54,10 @@ class KCStreamDataApp():
         self.window = tk.Tk()
         #self.window.configure(background = "SystemAppWorkspace")
         self.window.wm_title("KC Monitoring Data Formatter")
-        self.window.iconbitmap("KC_GUI.ico")
+        try:
+            self.window.iconbitmap(os.path.join(ResourceFolder, "KC_GUI.ico"))
+        except tk.TclError:
+            pass    # .ico icons are only supported on Windows
         
         self.Verbosity = True
         
@@ -107,6 +138,12 @@ class KCStreamDataApp():
         chkbtn_Verbose = ttk.Checkbutton(Frm_Choices, text = "Debug Output", 
                                           variable = self.Verbose) #, onvalue = "True", offvalue = "False")
         chkbtn_Verbose.grid(row = 2, column = 3, pady = 5, ipadx = 7, ipady = 3, sticky=tk.E)
+
+        #Create checkbutton to carry on a run that was interrupted (e.g. the window was closed) from its last checkpoint
+        self.Resume = tk.IntVar()
+        chkbtn_Resume = ttk.Checkbutton(Frm_Choices, text = "Resume interrupted run",
+                                          variable = self.Resume)
+        chkbtn_Resume.grid(row = 2, column = 1, pady = 5, ipadx = 7, ipady = 3, sticky=tk.W)
         
         #Rows and Columns configurations (deals with resizing window)
         Frm_Choices.rowconfigure(1, weight = 1)
@@ -126,10 +163,20 @@ class KCStreamDataApp():
         self.txt_Output = tkst.ScrolledText(Frm_Output, wrap = tk.WORD, width  = 70, height = 8, font = ('Calibri',12))
         self.txt_Output.grid(row = 2, column = 1, ipadx = 10, ipady = 10, padx = 10, pady = 10)
         
-        msg_Welcome = open("GUI_Welcome_Message.txt", "r")
+        msg_Welcome = open(os.path.join(ResourceFolder, "GUI_Welcome_Message.txt"), "r")
         for aline in msg_Welcome:
             self.txt_Output.insert(tk.INSERT, aline)
         msg_Welcome.close()
+
+        # Progress bar for the data files being read, with how long is left and how fast it is going
+        self.ProgressValue = tk.DoubleVar()
+        self.progbar_Run = ttk.Progressbar(Frm_Output, orient = tk.HORIZONTAL, mode = "determinate",
+                                           maximum = 100, variable = self.ProgressValue)
+        self.progbar_Run.grid(row = 3, column = 1, padx = 10, sticky = tk.E + tk.W)
+
+        self.str_Progress = tk.StringVar()
+        lbl_Progress = ttk.Label(Frm_Output, textvariable = self.str_Progress)
+        lbl_Progress.grid(row = 4, column = 1, padx = 10, pady = 3, sticky = tk.W)
         
         Frm_Output.rowconfigure(1, weight = 1)
         Frm_Output.columnconfigure(1, weight = 1)
@@ -144,16 +191,19 @@ class KCStreamDataApp():
         btn_Run = ttk.Button(Frm_RunQuit, text = "Run", command = self.BtnPress_Run)
         btn_QuitWin = ttk.Button(Frm_RunQuit, text = "Quit", command = self.QuitWin)
         btn_SeeFormattedFiles = ttk.Button(Frm_RunQuit, text = "See Formatted Files", command = self.BtnPress_SeeFormattedFiles)
+        btn_Preview = ttk.Button(Frm_RunQuit, text = "Preview Results", command = self.BtnPress_Preview)
         
         btn_QuitWin.grid(row = 1, column = 1, pady = 10, ipadx = 7, ipady = 3, sticky=tk.W)
         btn_SeeFormattedFiles.grid(row = 1, column = 2, pady = 10, ipadx = 7, ipady = 3)
-        btn_Run.grid(row = 1, column = 3, pady = 10, ipadx = 7, ipady = 3, sticky=tk.E)
+        btn_Preview.grid(row = 1, column = 3, pady = 10, ipadx = 7, ipady = 3)
+        btn_Run.grid(row = 1, column = 4, pady = 10, ipadx = 7, ipady = 3, sticky=tk.E)
         
         
         Frm_RunQuit.rowconfigure(1, weight = 1)
         Frm_RunQuit.columnconfigure(1, weight = 1)
         Frm_RunQuit.columnconfigure(2, weight = 1)
         Frm_RunQuit.columnconfigure(3, weight = 1)
+        Frm_RunQuit.columnconfigure(4, weight = 1)
     
     
     def BtnPress_Run(self):
@@ -190,16 +240,22 @@ class KCStreamDataApp():
             StatusQ = queue.Queue()
             
             self.StatusUpdate("<< Working on it... >>", ClearText = True)
-            self.LoggerOutput = thd.Thread(target = FormatStreamData.FormatStreamData, args = (OutputFiles, InputFiles, doTemperature, DoE_Temperature, self.Verbosity, StatusQ))
+            self.LatestProgress = None
+            self.ProgressMeter = FormatStreamData.ProgressMeter()
+            self.StartProgress()
+            self.LoggerOutput = thd.Thread(target = FormatStreamData.FormatStreamData, args = (OutputFiles, InputFiles, doTemperature, DoE_Temperature, self.Verbosity, StatusQ),
+                                           kwargs = {'resume' : self.Resume.get() == 1, 'progressCallback' : self.ProgressReport})
             self.LoggerOutput.daemon = True
             self.LoggerOutput.start()
             
             # Creating queue for status updates from FormatStreamData to be placed which can then be read by GUI
+            startTime = time.time()
+            nextRefresh = startTime
             while True:
                 self.window.update_idletasks()
                 # This will block the GUI thread from running until there is something to take from the Queue
                 try:
-                    item = str(StatusQ.get(block = True, timeout = 1))
+                    item = str(StatusQ.get(block = True, timeout = ProgressRefreshSeconds))
                     print("popped off the queue %s" % item)
                     self.StatusUpdate(item)
                     if item == FormatStreamData.DONE_MESSAGE:
@@ -207,7 +263,12 @@ class KCStreamDataApp():
                     
                 except queue.Empty:
                     pass
+
+                if time.time() >= nextRefresh:
+                    self.ShowProgress()
+                    nextRefresh = time.time() + ProgressRefreshSeconds
             
+            self.FinishProgress(time.time() - startTime)
             print("Done with the queue")
             self.window.update_idletasks()
         except Exception as e:
@@ -216,6 +277,56 @@ class KCStreamDataApp():
         self.window.update_idletasks()
     
     
+    def ProgressReport(self, progress):
+        """Called by FormatStreamData (in its thread) after each data file is read - just keeps the
+            latest report for ShowProgress, so it costs the run nothing"""
+        self.LatestProgress = progress
+
+
+    def StartProgress(self):
+        """Reset the progress bar for a new run"""
+        self.progbar_Run.configure(mode = "determinate")
+        self.ProgressValue.set(0)
+        self.str_Progress.set("Looking for data files...")
+
+
+    def ShowProgress(self):
+        """Bring the progress bar, ETA and rows/sec up to date from the latest report - called every
+            ProgressRefreshSeconds while a run is going"""
+        progress = self.LatestProgress
+        if progress is None:
+            return
+        self.ProgressMeter.update(progress)
+
+        if self.ProgressMeter.done():
+            # All the files are read - the outputs are being written, which the reports don't measure.
+            # The bar is stepped here rather than start()ed: its timer would need the event loop,
+            # and BtnPress_Run only lets the window redraw.
+            if str(self.progbar_Run.cget("mode")) != "indeterminate":
+                self.progbar_Run.configure(mode = "indeterminate")
+                self.ProgressValue.set(0)
+            self.progbar_Run.step(ProgressStepSize)
+            self.str_Progress.set("Writing the output files - %s data rows read from %d files" % ("{:,}".format(progress.dataRows), progress.filesTotal))
+            return
+
+        self.ProgressValue.set(100 * self.ProgressMeter.fraction())
+        text = "%d of %d files read" % (progress.filesDone, progress.filesTotal)
+        secondsLeft = self.ProgressMeter.secondsLeft()
+        if secondsLeft is not None:
+            text += " - about %s left" % FormatDuration(secondsLeft)
+        rowsPerSecond = self.ProgressMeter.rowsPerSecond()
+        if rowsPerSecond is not None:
+            text += " - %s rows/sec" % "{:,.0f}".format(rowsPerSecond)
+        self.str_Progress.set(text)
+
+
+    def FinishProgress(self, seconds):
+        """Fill the progress bar once the run is over"""
+        self.progbar_Run.configure(mode = "determinate")
+        self.ProgressValue.set(100)
+        self.str_Progress.set("Finished in %s" % FormatDuration(seconds))
+
+
     def StatusUpdate(self, StatusString, ClearText=False):
         """Given status strings (e.g. from the FormatStreamData thread),
             update the GUI progress window"""
@@ -252,10 +363,31 @@ class KCStreamDataApp():
     
     
     def BtnPress_SeeFormattedFiles(self):
-        """Opens the Windows file explorer to the user-selected output folder directory"""
+        """Opens the file explorer (Finder etc. on other systems) to the user-selected output folder directory"""
         
         OutputFilesPath = self.entry_OutputFiles.get()
-        os.startfile(OutputFilesPath)
+        if sys.platform == 'win32':
+            os.startfile(OutputFilesPath)
+        elif sys.platform == 'darwin':
+            subprocess.Popen(['open', OutputFilesPath])
+        else:
+            subprocess.Popen(['xdg-open', OutputFilesPath])
+        
+        
+    def BtnPress_Preview(self):
+        """Opens a preview window plotting the results in the output folder, for the data type chosen"""
+        
+        PreviewFile = PreviewStreamData.findPreviewFile(self.str_OutputFiles.get(), self.HOBOorHI9829.get() == 1)
+        if PreviewFile is None:
+            messagebox.showerror("Error", "There are no results to preview in the output folder - press Run first")
+            return
+        
+        try:
+            Preview = PreviewStreamData.SeriesPreview(PreviewFile)
+        except (ValueError, IOError) as e:
+            messagebox.showerror("Error", str(e))
+            return
+        PreviewWindow(self.window, Preview)
         
         
     def QuitWin(self):
@@ -264,5 +396,222 @@ class KCStreamDataApp():
         quit()
         
 
-program = KCStreamDataApp()
-program.window.mainloop()
\ No newline at end of file
+class PreviewWindow():
+    """Plots a site's parameter from a run's results, downsampled to about PreviewStreamData.defaultPreviewPoints
+        points so large series draw quickly.  Drag across the plot to zoom in on those dates, or use the
+        mouse wheel; each zoom fetches the readings in view again, so zooming in shows more detail."""
+    
+    # Space around the plot for the axis labels, in pixels
+    MarginLeft = 70
+    MarginRight = 20
+    MarginTop = 15
+    MarginBottom = 30
+    
+    def __init__(self, parent, Preview):
+        self.Preview = Preview
+        self.window = tk.Toplevel(parent)
+        self.window.wm_title("Preview - " + Preview.csvPath)
+        
+        self.Times = []             # points being drawn
+        self.Values = []
+        self.ViewStart = None       # part of the series in view, in seconds - None is the whole series
+        self.ViewEnd = None
+        self.SeriesStart = None     # the whole series
+        self.SeriesEnd = None
+        self.DragStartX = None
+        
+        self.CreateWidgets()
+        if len(Preview.sites) > 0:
+            self.str_Site.set(Preview.sites[0])
+            self.str_Parameter.set(Preview.parameters[0])
+            self.ShowSeries()
+        
+    def CreateWidgets(self):
+        """Called by __init__ to build and position the widgets of the preview window"""
+        
+        self.window.rowconfigure(2, weight = 1)
+        self.window.columnconfigure(1, weight = 1)
+        
+        # ---------------------------------------------------------------------
+        # Site and parameter to plot
+        Frm_Choose = ttk.Frame(self.window, padding = 6)
+        Frm_Choose.grid(row = 1, column = 1, sticky = tk.E + tk.W)
+        
+        lbl_Site = ttk.Label(Frm_Choose, text = "Site")
+        lbl_Site.grid(row = 1, column = 1, padx = 5)
+        self.str_Site = tk.StringVar()
+        combo_Site = ttk.Combobox(Frm_Choose, textvariable = self.str_Site, values = self.Preview.sites, state = "readonly")
+        combo_Site.grid(row = 1, column = 2, padx = 5)
+        combo_Site.bind("<<ComboboxSelected>>", self.ShowSeries)
+        
+        lbl_Parameter = ttk.Label(Frm_Choose, text = "Parameter")
+        lbl_Parameter.grid(row = 1, column = 3, padx = 5)
+        self.str_Parameter = tk.StringVar()
+        combo_Parameter = ttk.Combobox(Frm_Choose, textvariable = self.str_Parameter, values = self.Preview.parameters, state = "readonly")
+        combo_Parameter.grid(row = 1, column = 4, padx = 5)
+        combo_Parameter.bind("<<ComboboxSelected>>", self.ShowSeries)
+        
+        btn_WholeSeries = ttk.Button(Frm_Choose, text = "Whole Series", command = self.ShowSeries)
+        btn_WholeSeries.grid(row = 1, column = 5, padx = 5, ipadx = 5)
+        
+        # Number of points drawn and readings in view
+        self.str_Status = tk.StringVar()
+        lbl_Status = ttk.Label(Frm_Choose, textvariable = self.str_Status)
+        lbl_Status.grid(row = 1, column = 6, padx = 10, sticky = tk.E)
+        Frm_Choose.columnconfigure(6, weight = 1)
+        
+        # ---------------------------------------------------------------------
+        # The plot
+        self.canvas_Plot = tk.Canvas(self.window, width = 900, height = 400, background = "white")
+        self.canvas_Plot.grid(row = 2, column = 1, padx = 6, pady = 6, sticky = tk.E + tk.W + tk.N + tk.S)
+        self.canvas_Plot.bind("<Configure>", self.Redraw)
+        self.canvas_Plot.bind("<ButtonPress-1>", self.DragStart)
+        self.canvas_Plot.bind("<B1-Motion>", self.DragMove)
+        self.canvas_Plot.bind("<ButtonRelease-1>", self.DragEnd)
+        self.canvas_Plot.bind("<MouseWheel>", self.Wheel)       # Windows
+        self.canvas_Plot.bind("<Button-4>", self.Wheel)         # X11
+        self.canvas_Plot.bind("<Button-5>", self.Wheel)
+        
+    def ShowSeries(self, event = None):
+        """Shows the whole of the chosen site's parameter"""
+        
+        self.ViewStart = None
+        self.ViewEnd = None
+        self.FetchView()
+        self.SeriesStart = self.ViewStart
+        self.SeriesEnd = self.ViewEnd
+        
+    def FetchView(self):
+        """Fetches the downsampled points for the part of the series in view and draws them"""
+        
+        self.window.config(cursor = "watch")
+        self.window.update_idletasks()
+        try:
+            self.Times, self.Values, NumReadings = self.Preview.window(self.str_Site.get(), self.str_Parameter.get(),
+                                                                       self.ViewStart, self.ViewEnd)
+        except (ValueError, IOError) as e:
+            self.Times, self.Values, NumReadings = [], [], 0
+            messagebox.showerror("Error", str(e), parent = self.window)
+        finally:
+            self.window.config(cursor = "")
+        
+        if self.ViewStart is None and len(self.Times) > 0:
+            self.ViewStart = self.Times[0]
+            self.ViewEnd = self.Times[-1]
+        self.str_Status.set("%d points shown of %d readings" % (len(self.Times), NumReadings))
+        self.Redraw()
+        
+    def PlotArea(self):
+        """Returns the left, top, right and bottom of the plot on the canvas"""
+        
+        return (self.MarginLeft, self.MarginTop,
+                max(self.canvas_Plot.winfo_width() - self.MarginRight, self.MarginLeft + 1),
+                max(self.canvas_Plot.winfo_height() - self.MarginBottom, self.MarginTop + 1))
+        
+    def ViewRange(self):
+        """Returns the start and end of the view in seconds, widened if it is a single time"""
+        
+        if self.ViewEnd - self.ViewStart > 0:
+            return self.ViewStart, self.ViewEnd
+        return self.ViewStart - 1800, self.ViewEnd + 1800
+        
+    def Redraw(self, event = None):
+        """Draws the points fetched, with the date and value axes"""
+        
+        canvas = self.canvas_Plot
+        canvas.delete("all")
+        left, top, right, bottom = self.PlotArea()
+        canvas.create_rectangle(left, top, right, bottom, outline = "gray")
+        if len(self.Times) == 0:
+            canvas.create_text((left + right) / 2, (top + bottom) / 2, text = "No readings")
+            return
+        
+        start, end = self.ViewRange()
+        lowest, highest = min(self.Values), max(self.Values)
+        if highest == lowest:
+            lowest -= 1
+            highest += 1
+        xScale = (right - left) / (end - start)
+        yScale = (bottom - top) / (highest - lowest)
+        
+        Points = []
+        for seconds, value in zip(self.Times, self.Values):
+            Points.append(left + (seconds - start) * xScale)
+            Points.append(bottom - (value - lowest) * yScale)
+        if len(Points) > 2:
+            canvas.create_line(Points, fill = "navy")
+        else:
+            canvas.create_oval(Points[0] - 2, Points[1] - 2, Points[0] + 2, Points[1] + 2, fill = "navy")
+        
+        # Five labels on each axis - dates get a time of day once the view is a few days or less
+        DateFormat = "%Y-%m-%d" if end - start > 5 * 86400 else "%m-%d %H:%M"
+        for tick in range(5):
+            fraction = tick / 4
+            y = bottom - fraction * (bottom - top)
+            canvas.create_text(left - 5, y, text = "%.4g" % (lowest + fraction * (highest - lowest)), anchor = tk.E)
+            x = left + fraction * (right - left)
+            Label = PreviewStreamData.previewDateTime(start + fraction * (end - start)).strftime(DateFormat)
+            canvas.create_text(x, bottom + 5, text = Label, anchor = tk.N + (tk.W if tick == 0 else tk.E if tick == 4 else ""))
+        
+    def SecondsAt(self, x):
+        """Returns the time in seconds at x on the canvas"""
+        
+        left, top, right, bottom = self.PlotArea()
+        start, end = self.ViewRange()
+        x = min(max(x, left), right)
+        return start + (x - left) * (end - start) / (right - left)
+        
+    def ZoomTo(self, start, end):
+        """Shows start to end (in seconds), kept within the series"""
+        
+        if self.SeriesStart is None:
+            return
+        self.ViewStart = max(start, self.SeriesStart)
+        self.ViewEnd = min(end, self.SeriesEnd)
+        if self.ViewEnd <= self.ViewStart:
+            self.ViewStart, self.ViewEnd = self.SeriesStart, self.SeriesEnd
+        self.FetchView()
+        
+    def DragStart(self, event):
+        """Starts marking the dates to zoom in on"""
+        
+        self.DragStartX = event.x
+        
+    def DragMove(self, event):
+        """Shows the dates marked so far"""
+        
+        if self.DragStartX is None:
+            return
+        left, top, right, bottom = self.PlotArea()
+        self.canvas_Plot.delete("drag")
+        self.canvas_Plot.create_rectangle(self.DragStartX, top, event.x, bottom, outline = "orange", tags = "drag")
+        
+    def DragEnd(self, event):
+        """Zooms in on the dates marked"""
+        
+        if self.DragStartX is None or self.SeriesStart is None:
+            return
+        self.canvas_Plot.delete("drag")
+        if abs(event.x - self.DragStartX) > 5:
+            start, end = sorted([self.SecondsAt(self.DragStartX), self.SecondsAt(event.x)])
+            self.ZoomTo(start, end)
+        self.DragStartX = None
+        
+    def Wheel(self, event):
+        """Zooms in (wheel forward) or out around the mouse"""
+        
+        if self.SeriesStart is None:
+            return
+        Factor = 0.5 if event.num == 4 or event.delta > 0 else 2.0
+        start, end = self.ViewRange()
+        centre = self.SecondsAt(event.x)
+        self.ZoomTo(centre - (centre - start) * Factor, centre + (end - centre) * Factor)
+        
+
+
+# The data files are read in worker processes (see FormatStreamData.fileWorkers), which import this
+# script again - so only open the window when it is run, and let the frozen build start the workers
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    program = KCStreamDataApp()
+    program.window.mainloop()
\ No newline at end of file
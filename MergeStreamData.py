@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Merge the shard bundles of a run split across several machines (or
+processes) with FormatStreamData.py --shard i/N into the run's outputs -
+StreamData.CSV or TemperatureData.CSV, the EIM files, the site coverage
+report and the rejects list - the same as a run over all the data files on
+one machine would write.
+
+Each bundle has its shard's data rows in key order, so they are merged as
+they are read, and the medians and QC are worked out from the merged rows
+exactly as in a single run.
+
+"""
+import os
+import sys
+import getopt
+
+import FormatStreamData
+
+
+# Read the shard bundles in bundleFolders and check they are the N shards of one run.  Returns
+# [(folder, rows path, state)] in shard order.  Raises ValueError if they aren't.
+def readShardBundles(bundleFolders):
+    bundles = []
+    for folder in bundleFolders:
+        rowsPath, state = FormatStreamData.readShardBundle(folder)
+        bundles.append((folder, rowsPath, state))
+    if len(bundles) == 0:
+        raise ValueError('No shard bundles to merge')
+    bundles.sort(key=lambda bundle: bundle[2]['shard'])
+
+    first = bundles[0][2]
+    nShards = first['shard'][1]
+    for folder, _, state in bundles:
+        if state['shard'][1] != nShards:
+            raise ValueError('%s is shard %d/%d, not one of %d shards' % ((folder,) + state['shard'] + (nShards,)))
+        if state['inputFolder'] != first['inputFolder'] or state['doTemperature'] != first['doTemperature']:
+            raise ValueError('%s is a shard of a different run (%s)' % (folder, state['inputFolder']))
+        # Every shard should have found the same data files, or some may have been read twice or not at all
+        if state['filesFound'] != first['filesFound']:
+            raise ValueError('%s found different data files from %s - were files added during the run?' % (folder, bundles[0][0]))
+
+    shards = [state['shard'][0] for _, _, state in bundles]
+    if len(set(shards)) != len(shards):
+        raise ValueError('Shard %d/%d is given more than once' % (next(i for i in shards if shards.count(i) > 1), nShards))
+    missing = [str(i) for i in range(1, nShards + 1) if i not in shards]
+    if len(missing) > 0:
+        raise ValueError('Missing shard(s) %s of %d' % (', '.join(missing), nShards))
+    return bundles
+
+
+# Write the outputs of the run whose shard bundles are in bundleFolders to outputFolder.  options
+# are those of the outputs (qcThreshold, eimMaxRows, compression etc.) as for FormatStreamData.
+# Returns the RunContext of the merge, whose counts say how the run went.  Raises ValueError if
+# the bundles aren't all the shards of one run.
+def mergeShards(outputFolder, bundleFolders, DoEOutputOption=False, msgQueue=None, **options):
+    bundles = readShardBundles(bundleFolders)
+    first = bundles[0][2]
+    ctx = FormatStreamData.RunContext(outputFolder, first['inputFolder'], first['doTemperature'], DoEOutputOption,
+                                      False, msgQueue, **options)
+    if not os.path.isdir(ctx.outputFolder):
+        os.makedirs(ctx.outputFolder)
+
+    try:
+        ctx.outputLogFile = open(os.path.join(ctx.outputFolder, 'LogFile.txt'), 'w')
+        ctx.statusCallback('Merging %d shards of "%s" into "%s"' % (len(bundles), ctx.inputFolder, ctx.outputFolder))
+
+        # The sites and rejects are put back in the order of the data files, as a single run has them
+        siteFiles = []
+        rejects = []
+        for folder, rowsPath, state in bundles:
+            ctx.outputLogFile.write('=== Shard %d/%d from %s: %d files read, %d could not be read, %d data rows ===\n'
+                                    % (state['shard'] + (folder, state['nFilesProcessed'], state['nFilesFailed'], state['nDataRows'])))
+            ctx.sortedRuns.addSortedFile(rowsPath)
+            fileOrder = state['fileOrder']
+            for site, siteDataList in state['sites'].items():
+                siteFiles.extend((fileOrder.get(siteData.filePath, -1), site, siteData) for siteData in siteDataList)
+            rejects.extend((fileOrder.get(path, -1), path, reason) for path, reason in state['rejects'])
+            ctx.nFilesProcessed += state['nFilesProcessed']
+            ctx.nFilesFailed += state['nFilesFailed']
+            ctx.nDataRows += state['nDataRows']
+            shardMetrics = FormatStreamData.RunMetrics()
+            shardMetrics.restore(state.get('metrics', {}))
+            ctx.metrics.add(shardMetrics)
+        for _, site, siteData in sorted(siteFiles, key=lambda siteFile: siteFile[0]):
+            ctx.sites.setdefault(site, []).append(siteData)
+        ctx.rejects = [(path, reason) for _, path, reason in sorted(rejects, key=lambda reject: reject[0])]
+
+        FormatStreamData.writeOutputs(ctx)
+    finally:
+        ctx.close()
+
+    FormatStreamData.finishRun(ctx)
+    return ctx
+
+
+def helpMessage():
+    print('Usage:')
+    print('MergeStreamData.py [-h] [-e] [-o <outputFolder>] <shard folder> <shard folder>...')
+    print('Writes the outputs of a run split into shards with FormatStreamData.py --shard=i/N from the shard bundles')
+    print('Each shard folder is the output folder of one shard run (or the %s folder in it) - all N are needed' % FormatStreamData.shardBundleFolderName)
+    print('Output goes to specified output folder, default is ProcessedStreamData')
+    print('Optional parameters:')
+    print('    -e   - output WA Department of Ecology EIM-formatted .csv files')
+    print('    -k, --qc-window=<n>, --eim-max-rows=<n>, --eim-max-bytes=<n>, -z, --compress=<type>, --sketch=<k> - as for FormatStreamData.py')
+    print('    -h   - print this help message')
+    sys.exit(2)
+
+
+def main(argv):
+    outputFolder = 'ProcessedStreamData'
+    DoEOutputOption = False
+    options = {}
+
+    try:
+        opts, args = getopt.getopt(argv, "heo:k:z", ["help", "ecology", "output=", "qc-threshold=", "qc-window=",
+                                                     "eim-max-rows=", "eim-max-bytes=", "compress=", "sketch="])
+    except getopt.GetoptError:
+        helpMessage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            helpMessage()
+        elif opt in ("-e", "--ecology"):
+            DoEOutputOption = True
+        elif opt in ("-o", "--output"):
+            outputFolder = arg
+        elif opt in ("-k", "--qc-threshold"):
+            try:
+                options['qcThreshold'] = float(arg)
+            except ValueError:
+                helpMessage()
+        elif opt == "--qc-window":
+            try:
+                options['qcWindowSize'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['qcWindowSize'] < 1:
+                helpMessage()
+        elif opt == "--eim-max-rows":
+            try:
+                options['eimMaxRows'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['eimMaxRows'] < 0:
+                helpMessage()
+        elif opt == "--eim-max-bytes":
+            options['eimMaxBytes'] = FormatStreamData.parseByteCount(arg)
+            if options['eimMaxBytes'] is None:
+                helpMessage()
+        elif opt == "-z":
+            options['compression'] = 'gzip'
+        elif opt == "--compress":
+            if arg not in FormatStreamData.availableCompressions():
+                print('--compress must be one of: %s' % ', '.join(FormatStreamData.availableCompressions()))
+                sys.exit(2)
+            options['compression'] = arg
+        elif opt == "--sketch":
+            try:
+                options['rollupSketch'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['rollupSketch'] < 0 or 0 < options['rollupSketch'] < 8:
+                helpMessage()
+
+    if len(args) == 0:
+        helpMessage()
+
+    try:
+        mergeShards(outputFolder, args, DoEOutputOption, **options)
+    except (ValueError, IOError) as e:
+        print(str(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
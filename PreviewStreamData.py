@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+The data behind the GUI's preview of a run's results: any site's parameter
+from TemperatureData.CSV or StreamData.CSV, cut down to a couple of thousand
+points with Largest-Triangle-Three-Buckets (LTTB) downsampling, so a
+multi-year series can be drawn and zoomed at interactive speed.
+
+Opening a preview only finds where each site's rows are in the file (the
+outputs are sorted by site).  A site's readings are read when it is first
+shown, and each zoom downsamples just the readings in view - zoomed in far
+enough, every reading is drawn.  NumPy is used for the downsampling when it
+is installed; otherwise plain Python is used.
+
+"""
+import os
+import io
+import csv
+import bisect
+import locale
+import datetime
+import itertools
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import FormatStreamData
+import ResampleStreamData
+
+# Number of points drawn for the part of a series in view
+defaultPreviewPoints = 2000
+
+# The output CSV previewed for each kind of run - True for temperature (HOBO) data
+previewFileNames = {False: 'StreamData.CSV', True: 'TemperatureData.CSV'}
+
+
+# The output CSV of a run in outputFolder, compressed or not - None if there isn't one
+def findPreviewFile(outputFolder, doTemperature):
+    return FormatStreamData.existingOutputPath(os.path.join(outputFolder, previewFileNames[doTemperature]))
+
+
+# A preview time (seconds since ResampleStreamData.bucketOrigin) as a datetime
+def previewDateTime(seconds):
+    return ResampleStreamData.bucketOrigin + datetime.timedelta(seconds=seconds)
+
+
+# Pick threshold of the points (times, values) that keep the shape of the series when drawn -
+# Largest-Triangle-Three-Buckets (Steinarsson 2013).  The first and last points are kept and the
+# rest are split into threshold - 2 buckets; from each bucket the point making the largest
+# triangle with the point kept from the bucket before and the average of the bucket after is
+# kept, so peaks and dips survive.  Returns the indexes of the points kept, in order.
+def downsampleLTTB(times, values, threshold, useNumpy=True):
+    if threshold >= len(times) or threshold < 3:
+        return list(range(len(times)))
+    if useNumpy and numpy is not None:
+        return downsampleNumpy(times, values, threshold)
+    return downsamplePython(times, values, threshold)
+
+# Where the LTTB buckets start - bucket i is points edges[i] to edges[i + 1] - 1.  The last
+# bucket is just the last point.
+def bucketEdges(n, threshold):
+    bucketSize = (n - 2) / (threshold - 2)
+    return [int(i * bucketSize) + 1 for i in range(threshold - 2)] + [n - 1, n]
+
+# LTTB with a numpy pass over each bucket
+def downsampleNumpy(times, values, threshold):
+    times = numpy.asarray(times, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    edges = bucketEdges(len(times), threshold)
+    counts = numpy.diff(edges)
+    averageTimes = numpy.add.reduceat(times, edges[:-1]) / counts
+    averageValues = numpy.add.reduceat(values, edges[:-1]) / counts
+
+    kept = [0]
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        keptTime, keptValue = times[kept[-1]], values[kept[-1]]
+        areas = numpy.abs((keptTime - averageTimes[i + 1]) * (values[start:end] - keptValue) -
+                          (keptTime - times[start:end]) * (averageValues[i + 1] - keptValue))
+        kept.append(start + int(numpy.argmax(areas)))
+    kept.append(len(times) - 1)
+    return kept
+
+# LTTB in plain Python, picking the same points as downsampleNumpy
+def downsamplePython(times, values, threshold):
+    edges = bucketEdges(len(times), threshold)
+    kept = [0]
+    for i in range(threshold - 2):
+        start, end, nextEnd = edges[i], edges[i + 1], edges[i + 2]
+        averageTime = sum(itertools.islice(times, end, nextEnd)) / (nextEnd - end)
+        averageValue = sum(itertools.islice(values, end, nextEnd)) / (nextEnd - end)
+        keptTime, keptValue = times[kept[-1]], values[kept[-1]]
+        largest = -1.0
+        for index in range(start, end):
+            area = abs((keptTime - averageTime) * (values[index] - keptValue) -
+                       (keptTime - times[index]) * (averageValue - keptValue))
+            if area > largest:
+                largest = area
+                largestIndex = index
+        kept.append(largestIndex)
+    kept.append(len(times) - 1)
+    return kept
+
+
+# A preview of one output CSV (TemperatureData.CSV or StreamData.CSV, compressed or not).
+# Opening it reads through the file once for the sites and, if it isn't compressed, where each
+# site's rows start; the readings of a site are only read when it is first shown.
+class SeriesPreview(object):
+
+    def __init__(self, csvPath, useNumpy=True):
+        self.csvPath = csvPath
+        self.useNumpy = useNumpy
+        self.compressed = os.path.splitext(csvPath)[1].lower() in FormatStreamData.compressionSuffixes.values()
+        with FormatStreamData.openOutputForReading(csvPath) as csvfile:
+            self.layout = ResampleStreamData.matchLayout(next(csv.reader(csvfile), []))
+        if self.layout is None:
+            raise ValueError('%s is not a TemperatureData.CSV or StreamData.CSV file' % csvPath)
+        self.parameters = sorted(self.layout['parameters'], key=self.layout['parameters'].get)
+        self.siteOffsets = self.indexSites()
+        self.sites = sorted(self.siteOffsets)
+        self.site = None        # the site whose readings are loaded
+        self.series = {}        # its readings - parameter -> (times, values) arrays in time order
+
+    # Where each site's rows start: site -> list of file offsets, one per run of rows for the
+    # site (a sorted output has one run per site).  The offsets are empty for a compressed file,
+    # which can't be read from the middle.
+    def indexSites(self):
+        siteOffsets = {}
+        if self.compressed:
+            with FormatStreamData.openOutputForReading(self.csvPath) as csvfile:
+                csvfile.readline()
+                for line in csvfile:
+                    site = line.split(',', 1)[0]
+                    # StreamData.CSV has a blank line and then the MEDIAN VALUES section after the data rows
+                    if site.strip() == '':
+                        break
+                    siteOffsets.setdefault(site, [])
+            return siteOffsets
+
+        encoding = locale.getpreferredencoding(False)   # as the outputs were written
+        with open(self.csvPath, 'rb') as rawfile:
+            offset = len(rawfile.readline())
+            previousSite = None
+            for line in rawfile:
+                site = line.split(b',', 1)[0]
+                if site.strip() == b'':
+                    break
+                if site != previousSite:
+                    siteOffsets.setdefault(site.decode(encoding), []).append(offset)
+                    previousSite = site
+                offset += len(line)
+        return siteOffsets
+
+    # The (site, parameter, seconds, value) readings of a site, as ResampleStreamData.readNormalizedRows
+    def siteReadings(self, site):
+        if self.compressed:
+            with FormatStreamData.openOutputForReading(self.csvPath) as csvfile:
+                datarows = csv.reader(csvfile)
+                next(datarows, None)
+                for reading in ResampleStreamData.parseNormalizedRows(datarows, self.layout):
+                    if reading[0] == site:
+                        yield reading
+            return
+
+        for offset in self.siteOffsets.get(site, []):
+            rawfile = open(self.csvPath, 'rb')
+            rawfile.seek(offset)
+            with io.TextIOWrapper(rawfile, newline='') as csvfile:
+                for reading in ResampleStreamData.parseNormalizedRows(csv.reader(csvfile), self.layout):
+                    if reading[0] != site:
+                        break
+                    yield reading
+
+    # Read a site's readings, unless they are the ones already loaded
+    def loadSite(self, site):
+        if site == self.site:
+            return
+        series = {}
+        for _, parameter, seconds, value in self.siteReadings(site):
+            if parameter not in series:
+                series[parameter] = (array('d'), array('d'))
+            times, values = series[parameter]
+            times.append(seconds)
+            values.append(value)
+        # Sorted outputs are in time order within a site, but outputs from older versions may not be
+        for parameter, (times, values) in series.items():
+            if any(later < earlier for earlier, later in zip(times, itertools.islice(times, 1, None))):
+                order = sorted(range(len(times)), key=times.__getitem__)
+                series[parameter] = (array('d', [times[i] for i in order]), array('d', [values[i] for i in order]))
+        self.site = site
+        self.series = series
+
+    # The readings of site's parameter from start to end (seconds since bucketOrigin, None for the
+    # start or end of the series), downsampled to at most nPoints.  Returns the times and values
+    # of the points to draw, and the number of readings from start to end.
+    def window(self, site, parameter, start=None, end=None, nPoints=defaultPreviewPoints):
+        self.loadSite(site)
+        times, values = self.series.get(parameter, (array('d'), array('d')))
+        first = 0 if start is None else bisect.bisect_left(times, start)
+        last = len(times) if end is None else bisect.bisect_right(times, end)
+        times = times[first:last]
+        values = values[first:last]
+        kept = downsampleLTTB(times, values, nPoints, self.useNumpy)
+        return [times[i] for i in kept], [values[i] for i in kept], last - first
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Resample the normalized logger series written by FormatStreamData
+(TemperatureData.CSV for HOBO data, StreamData.CSV for HI-9829 data) into
+fixed time buckets, e.g. aligned 15-minute or hourly series.
+
+Rows are read and resampled a chunk at a time, so a multi-year series never
+has to be held in memory all at once.  NumPy is used for the group-by when it
+is installed; otherwise a pure Python group-by gives the same results.
+
+"""
+import os
+import sys
+import csv
+import getopt
+import datetime
+import itertools
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import FormatStreamData
+
+# Aggregations supported per bucket, in the order they are written to the output
+supportedAggregations = [ 'mean', 'min', 'max', 'last' ]
+
+# Number of readings per series buffered before a chunk is resampled
+defaultChunkSize = 65536
+
+# Buckets are aligned to this origin, so hourly buckets start on the hour, 15 minute
+# buckets on :00, :15, :30 and :45 etc.
+bucketOrigin = datetime.datetime(1970, 1, 1)
+
+# Layouts of the normalized CSVs we know how to read.  Each has the column holding the
+# site, date and time, the date format used in the file and the measurement columns to resample.
+# The header is matched on its first few columns.
+TemperatureLayout = {
+    'signature' : ['Site', 'Date', 'Time (GMT-07:00)'],
+    'site' : 0, 'date' : 1, 'time' : 2,
+    'dateFormat' : '%m-%d-%Y',
+    'parameters' : { 'DO conc (mg/L)' : 3, 'Temp (DegF)' : 4, 'Temp (DegC)' : 6, 'DO sat (%)' : 7 }
+}
+
+LoggerLayout = {
+    'signature' : ['Site', 'RawDataFile', 'Date'],
+    'site' : 0, 'date' : 2, 'time' : 3,
+    'dateFormat' : '%Y-%m-%d',
+    # Measurement columns are those FormatStreamData calculates medians for, and the derived
+    # columns after them - offset by 2 since the site and raw data file columns come first
+    'parameters' : dict([(name, index + 2) for index, name in enumerate(FormatStreamData.columnHeaders)
+                         if FormatStreamData.calculateMedians[index]] +
+                        [(name, index + 2 + len(FormatStreamData.columnHeaders))
+                         for index, name in enumerate(FormatStreamData.derivedLogHeaders)])
+}
+
+knownLayouts = [ TemperatureLayout, LoggerLayout ]
+
+
+# Figure out which of the known layouts a header row matches - None if it doesn't match any
+def matchLayout(headerRow):
+    header = [column.strip() for column in headerRow]
+    for layout in knownLayouts:
+        if header[:len(layout['signature'])] == layout['signature']:
+            return layout
+    return None
+
+
+# Read normalized readings from a FormatStreamData output CSV, one
+# (site, parameter, seconds since bucketOrigin, value) tuple per site/parameter/timestamp
+# that has a numeric value.  Blank and non-numeric values (e.g. '-----') are skipped.
+# This is a generator so the file is streamed.  Compressed outputs (.gz etc.) are read as they are.
+def readNormalizedRows(csvPath):
+    with FormatStreamData.openOutputForReading(csvPath) as csvfile:
+        datarows = csv.reader(csvfile)
+        layout = matchLayout(next(datarows, []))
+        if layout is None:
+            raise ValueError('%s is not a TemperatureData.CSV or StreamData.CSV file' % csvPath)
+        for reading in parseNormalizedRows(datarows, layout):
+            yield reading
+
+
+# The readings in rows (lists of cells from a csv reader) of an output CSV with the given layout,
+# as for readNormalizedRows
+def parseNormalizedRows(datarows, layout):
+    siteCol, dateCol, timeCol = layout['site'], layout['date'], layout['time']
+    parameters = sorted(layout['parameters'].items(), key=lambda item: item[1])
+    dateFormat = layout['dateFormat']
+    # Parsing dates is the expensive part of reading - there are only a few distinct
+    # dates per file so remember the ones we've seen
+    dateSeconds = {}
+
+    for row in datarows:
+        # StreamData.CSV has a blank line and then the MEDIAN VALUES section after the data rows
+        if len(row) == 0 or row[0].strip() == '':
+            break
+        if len(row) <= timeCol:
+            continue
+        strDate = row[dateCol].strip()
+        if strDate not in dateSeconds:
+            try:
+                dateSeconds[strDate] = (datetime.datetime.strptime(strDate, dateFormat) - bucketOrigin).total_seconds()
+            except ValueError:
+                dateSeconds[strDate] = None
+        seconds = dateSeconds[strDate]
+        if seconds is None:
+            continue
+        try:
+            hour, minute, second = row[timeCol].strip().split(':')
+            seconds += int(hour) * 3600 + int(minute) * 60 + int(second)
+        except ValueError:
+            continue
+        site = row[siteCol]
+        for parameter, column in parameters:
+            if column < len(row):
+                try:
+                    value = float(row[column])
+                except ValueError:
+                    continue
+                yield (site, parameter, seconds, value)
+
+
+# Resamples a stream of readings into fixed interval buckets.
+#
+# Readings are buffered per series (site + parameter); when a series has collected a
+# chunk's worth of readings, the chunk is grouped by bucket and every bucket except the
+# last one (which may continue in the next chunk) is emitted.  If a chunk is all one bucket
+# (a long interval, e.g. a year), nothing is emitted and the series then waits for twice as
+# many readings before trying again, so a bucket of n readings is sorted O(log n) times
+# rather than once per reading after the first chunk.  Readings within a series
+# are expected to be in time order - FormatStreamData writes each raw data file in order,
+# and small disorder within a chunk is sorted out.  If a reading belongs to a bucket that
+# was already emitted (e.g. two overlapping logger files for a site) the series is closed
+# out and bucketing restarts, so that bucket then appears more than once in the output.
+class TimeBucketResampler(object):
+
+    def __init__(self, intervalMinutes, aggregations=None, chunkSize=defaultChunkSize, useNumpy=True):
+        if intervalMinutes <= 0:
+            raise ValueError('Resampling interval must be a positive number of minutes')
+        if aggregations is None:
+            aggregations = supportedAggregations
+        for aggregation in aggregations:
+            if aggregation not in supportedAggregations:
+                raise ValueError('Unknown aggregation "%s" - use one of %s' % (aggregation, ', '.join(supportedAggregations)))
+        self.interval = intervalMinutes * 60
+        self.aggregations = list(aggregations)
+        self.chunkSize = chunkSize
+        self.useNumpy = useNumpy and numpy is not None
+        self.times = {}             # per series: array of timestamps waiting to be bucketed
+        self.values = {}            # per series: array of values, 1:1 with times
+        self.lastEmitted = {}       # per series: start (in seconds) of the last bucket emitted
+        self.flushAt = {}           # per series: number of readings buffered at which to flush next
+
+    # Resample the readings, yielding one tuple per bucket:
+    # (site, parameter, bucket start datetime, count, <one value per aggregation>)
+    # Readings are (site, parameter, seconds since bucketOrigin, value) tuples.
+    def resample(self, readings):
+        for site, parameter, seconds, value in readings:
+            key = (site, parameter)
+            times = self.times.get(key)
+            if times is None:
+                times = self.times[key] = array('d')
+                self.values[key] = array('d')
+            elif key in self.lastEmitted and seconds < self.lastEmitted[key] + self.interval:
+                # Series went back in time to a bucket we already emitted - close out what we have
+                for bucket in self.flushSeries(key, final=True):
+                    yield bucket
+                del self.lastEmitted[key]
+                times = self.times[key]
+            times.append(seconds)
+            self.values[key].append(value)
+            if len(times) >= self.flushAt.get(key, self.chunkSize):
+                for bucket in self.flushSeries(key, final=False):
+                    yield bucket
+
+        # End of the input - every bucket is complete now
+        for key in sorted(self.times.keys()):
+            for bucket in self.flushSeries(key, final=True):
+                yield bucket
+
+    # Bucket the buffered readings for one series.  Unless final, the last bucket is
+    # kept back since more readings for it may still arrive, and the next flush waits
+    # for another chunk - or for twice as many readings if this one emitted nothing.
+    def flushSeries(self, key, final):
+        nBuffered = len(self.times[key])
+        self.flushAt.pop(key, None)
+        if nBuffered == 0:
+            return []
+        if self.useNumpy:
+            buckets, self.times[key], self.values[key] = self.groupNumpy(self.times[key], self.values[key], final)
+        else:
+            buckets, self.times[key], self.values[key] = self.groupPython(self.times[key], self.values[key], final)
+        if len(buckets) > 0:
+            self.lastEmitted[key] = buckets[-1][0]
+        if not final:
+            self.flushAt[key] = len(self.times[key]) + self.chunkSize if len(buckets) > 0 else 2 * nBuffered
+
+        site, parameter = key
+        return [(site, parameter, bucketOrigin + datetime.timedelta(seconds=start)) + tuple(aggregates)
+                for start, aggregates in buckets]
+
+    # Array-backed group by - returns a list of (bucket start seconds, [count, aggregations...])
+    # and the times and values of the readings held back for the next chunk
+    def groupNumpy(self, times, values, final):
+        times = numpy.frombuffer(times, dtype=numpy.float64)
+        values = numpy.frombuffer(values, dtype=numpy.float64)
+        order = numpy.argsort(times, kind='stable')
+        times = times[order]
+        values = values[order]
+        bucketIds = numpy.floor_divide(times, self.interval).astype(numpy.int64)
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(bucketIds)) + 1))
+        ends = numpy.append(starts[1:], len(bucketIds))
+        nBuckets = len(starts) if final else len(starts) - 1
+
+        columns = [ends - starts]
+        for aggregation in self.aggregations:
+            if aggregation == 'mean':
+                columns.append(numpy.add.reduceat(values, starts) / columns[0])
+            elif aggregation == 'min':
+                columns.append(numpy.minimum.reduceat(values, starts))
+            elif aggregation == 'max':
+                columns.append(numpy.maximum.reduceat(values, starts))
+            elif aggregation == 'last':
+                columns.append(values[ends - 1])
+
+        buckets = []
+        for index in range(nBuckets):
+            buckets.append((int(bucketIds[starts[index]]) * self.interval,
+                            [int(columns[0][index])] + [float(column[index]) for column in columns[1:]]))
+        carry = len(times) if final else int(starts[-1])
+        return buckets, array('d', times[carry:].tobytes()), array('d', values[carry:].tobytes())
+
+    # Pure Python group by with the same results as groupNumpy
+    def groupPython(self, times, values, final):
+        readings = sorted(zip(times, values), key=lambda reading: reading[0])
+        groups = [(bucketId, [value for _, value in group])
+                  for bucketId, group in itertools.groupby(readings, key=lambda reading: reading[0] // self.interval)]
+        if not final:
+            groups = groups[:-1]
+
+        buckets = []
+        carry = 0
+        for bucketId, bucketValues in groups:
+            carry += len(bucketValues)
+            aggregates = [len(bucketValues)]
+            for aggregation in self.aggregations:
+                if aggregation == 'mean':
+                    aggregates.append(sum(bucketValues) / len(bucketValues))
+                elif aggregation == 'min':
+                    aggregates.append(min(bucketValues))
+                elif aggregation == 'max':
+                    aggregates.append(max(bucketValues))
+                elif aggregation == 'last':
+                    aggregates.append(bucketValues[-1])
+            buckets.append((int(bucketId) * self.interval, aggregates))
+        return (buckets, array('d', [reading[0] for reading in readings[carry:]]),
+                array('d', [reading[1] for reading in readings[carry:]]))
+
+
+# Resample csvPath into outputPath, writing each bucket as soon as it is complete
+def resampleFile(csvPath, outputPath, intervalMinutes, aggregations=None, chunkSize=defaultChunkSize):
+    resampler = TimeBucketResampler(intervalMinutes, aggregations, chunkSize)
+    nBuckets = 0
+    with open(outputPath, 'w', newline='') as outputFile:
+        writer = csv.writer(outputFile, lineterminator='\n')
+        writer.writerow(['Site', 'Parameter', 'Date', 'Time', 'Count'] + resampler.aggregations)
+        for bucket in resampler.resample(readNormalizedRows(csvPath)):
+            site, parameter, start, count = bucket[:4]
+            writer.writerow([site, parameter, start.strftime('%Y-%m-%d'), start.strftime('%H:%M:%S'), count] +
+                            ['%f' % value for value in bucket[4:]])
+            nBuckets += 1
+    return nBuckets
+
+
+def helpMessage():
+    print('Usage:')
+    print('ResampleStreamData.py [-h] [-p <minutes>] [-a <aggregations>] [-o <outputFile>] -i <inputFile>')
+    print('Resamples TemperatureData.CSV or StreamData.CSV (from FormatStreamData.py) into fixed time buckets')
+    print('Output goes to the specified output file, default is <inputFile> with _Resampled<minutes> added')
+    print('Optional parameters:')
+    print('    -p   - bucket size in minutes, default is 60')
+    print('    -a   - comma separated aggregations per bucket from %s - default is all of them' % ','.join(supportedAggregations))
+    print('    -h   - print this help message')
+    sys.exit(2)
+
+
+def main(argv):
+    inputFile = None
+    outputFile = None
+    intervalMinutes = 60
+    aggregations = supportedAggregations
+
+    try:
+        opts, args = getopt.getopt(argv, "hi:o:p:a:", ["help", "input=", "output=", "period=", "aggregations="])
+    except getopt.GetoptError:
+        helpMessage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            helpMessage()
+        elif opt in ("-i", "--input"):
+            inputFile = arg
+        elif opt in ("-o", "--output"):
+            outputFile = arg
+        elif opt in ("-p", "--period"):
+            try:
+                intervalMinutes = float(arg)
+            except ValueError:
+                helpMessage()
+        elif opt in ("-a", "--aggregations"):
+            aggregations = [aggregation.strip() for aggregation in arg.split(',') if aggregation.strip()]
+
+    if inputFile is None or not os.path.isfile(inputFile):
+        helpMessage()
+    if outputFile is None:
+        root, ext = os.path.splitext(inputFile)
+        if ext.lower() in FormatStreamData.compressionSuffixes.values():
+            root, ext = os.path.splitext(root)
+        outputFile = '%s_Resampled%g%s' % (root, intervalMinutes, ext)
+
+    try:
+        nBuckets = resampleFile(inputFile, outputFile, intervalMinutes, aggregations)
+    except ValueError as e:
+        print(str(e))
+        sys.exit(1)
+    print('%d buckets written to %s' % (nBuckets, outputFile))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
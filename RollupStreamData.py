@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Reports from the rollup tables FormatStreamData writes next to its outputs
+(Rollups.CSV) - the count, mean, minimum, maximum, median and any other
+quantiles of each site's parameters by day, month, season or year, or over
+any run of days such as a quarter or a water year.
+
+A report for a run of days is put together from the fewest rollup rows that
+cover it - whole years, then whole months, then days - so it never has to go
+back to the readings themselves.  The rounded readings of the years and months
+are merged for its median and quantiles; the day rows don't keep theirs, so a
+run that starts or ends part way through a month has its count, mean, minimum
+and maximum but no median or quantiles.  Runs made with --sketch keep KLL
+sketches of the readings instead, which merge the same way; their medians and
+quantiles are then approximate.
+
+"""
+import os
+import sys
+import csv
+import math
+import getopt
+import datetime
+from collections import namedtuple
+
+import FormatStreamData
+
+# One row of a rollup table, with its readings as a FormatStreamData.RollupCell and its Median column
+# (None for a range)
+Rollup = namedtuple('Rollup', 'site, level, period, start, end, parameter, cell, median')
+
+reportHeaders = ['Site', 'Parameter', 'Period', 'Start', 'End', 'Count', 'Mean', 'Min', 'Max', 'Median']
+
+
+# The rollup table of a run in outputFolder, compressed or not - None if there isn't one
+def findRollupFile(outputFolder):
+    return FormatStreamData.existingOutputPath(os.path.join(outputFolder, FormatStreamData.rollupFileName))
+
+# A RollupCell from the Count, Sum, Min, Max and Values of a rollup row - with values None if the row
+# has no rounded readings, as day rows don't
+def parseRollupCell(count, total, minimum, maximum, valuesText):
+    cell = FormatStreamData.RollupCell()
+    cell.count = int(count)
+    cell.total = float(total)
+    cell.minimum = float(minimum)
+    cell.maximum = float(maximum)
+    if valuesText == '':
+        cell.values = None
+        return cell
+    if valuesText.startswith('kll'):
+        cell.values = FormatStreamData.parseKLLSketch(valuesText)
+        return cell
+    for item in valuesText.split():
+        value, valueCount = item.rsplit(':', 1)
+        cell.values[float(value)] = int(valueCount)
+    return cell
+
+# The rows of a rollup table as Rollups, leaving out those not for one of sites, parameters or levels
+# (None for all of them) or not wholly between first and last day (datetime.dates, None for no limit)
+def readRollups(path, sites=None, parameters=None, levels=None, firstDay=None, lastDay=None):
+    with FormatStreamData.openOutputForReading(path) as rollupFile:
+        rows = csv.reader(rollupFile)
+        if next(rows, None) != FormatStreamData.rollupHeaders:
+            raise ValueError('%s is not a rollup table' % path)
+        for site, level, period, start, end, parameter, count, total, minimum, maximum, _, median, valuesText in rows:
+            if ((sites is not None and site not in sites) or (parameters is not None and parameter not in parameters) or
+                    (levels is not None and level not in levels)):
+                continue
+            start = datetime.date.fromisoformat(start)
+            end = datetime.date.fromisoformat(end)
+            if (firstDay is not None and start < firstDay) or (lastDay is not None and end > lastDay):
+                continue
+            yield Rollup(site, level, period, start, end, parameter, parseRollupCell(count, total, minimum, maximum, valuesText),
+                         float(median))
+
+# Roll up the readings of each site and parameter from first day to last day from the year, month and
+# day rollups wholly in that range: a month is only used if its year isn't, and a day if neither its
+# month nor its year is.  If any days are used, the range has no rounded readings to give its median
+# and quantiles from.  Returns [Rollup] sorted by site and parameter.
+def rollupRange(rollups, firstDay, lastDay):
+    chosen = {}     # (site, parameter) -> {(level, start): cell}
+    for rollup in rollups:
+        if rollup.level in ('Year', 'Month', 'Day'):
+            chosen.setdefault((rollup.site, rollup.parameter), {})[(rollup.level, rollup.start)] = rollup.cell
+
+    period = '%s to %s' % (firstDay.isoformat() if firstDay else '', lastDay.isoformat() if lastDay else '')
+    combined = []
+    for (site, parameter), cells in sorted(chosen.items()):
+        years = set(start.year for level, start in cells if level == 'Year')
+        months = set((start.year, start.month) for level, start in cells if level == 'Month')
+        cell = FormatStreamData.RollupCell()
+        for (level, start), levelCell in cells.items():
+            if ((level == 'Year') or (level == 'Month' and start.year not in years) or
+                    (level == 'Day' and start.year not in years and (start.year, start.month) not in months)):
+                cell.add(levelCell)
+        combined.append(Rollup(site, 'Range', period, firstDay, lastDay, parameter, cell, None))
+    return combined
+
+# A median or quantile for a report - blank if there are no rounded readings to give it
+def quantileText(value):
+    return '' if value is None or math.isnan(value) else '%.4f' % value
+
+# Write a report of rollups to reportPath, with a column for each of quantiles (0 to 1) after the
+# median.  A day's median is the one in its rollup row; it has no other quantiles.  Returns the
+# number of rows written.
+def writeReport(rollups, reportPath, quantiles=()):
+    nRows = 0
+    with open(reportPath, 'w', newline='') as reportFile:
+        writer = csv.writer(reportFile, lineterminator='\n')
+        writer.writerow(reportHeaders + ['P%g' % (q * 100) for q in quantiles])
+        for rollup in rollups:
+            cell = rollup.cell
+            values = cell.quantiles([0.5] + list(quantiles))
+            if cell.values is None:
+                values[0] = rollup.median
+            writer.writerow([rollup.site, rollup.parameter, rollup.period,
+                             rollup.start.isoformat() if rollup.start else '', rollup.end.isoformat() if rollup.end else '',
+                             cell.count, '%.4f' % cell.mean(), repr(cell.minimum), repr(cell.maximum)] +
+                            [quantileText(value) for value in values])
+            nRows += 1
+    return nRows
+
+# Parse a date given on the command line - None if it isn't YYYY-MM-DD
+def parseDay(text):
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        return None
+
+
+def helpMessage():
+    print('Usage:')
+    print('RollupStreamData.py [-h] [-l <level>] [-f <first day>] [-t <last day>] [-s <site>]... [-p <parameter>]... [-q <quantiles>] [-o <report.csv>] <output folder>')
+    print('Reports on the rollup tables (%s) in the output folder of a FormatStreamData.py run' % FormatStreamData.rollupFileName)
+    print('Without -l, gives one row per site and parameter for the days from -f to -t, e.g. a quarter or a water year')
+    print('The median and quantiles of a range are only given when it is whole months - days keep no rounded readings')
+    print('Optional parameters:')
+    print('    -l   - list the rollups of one level: %s' % ', '.join(level.lower() for level in FormatStreamData.rollupLevels))
+    print('    -f, -t - first and last day (YYYY-MM-DD) - with -l, only periods wholly in these days are listed')
+    print('    -s   - only this site, may be given several times')
+    print('    -p   - only this parameter, as named in the rollup table, may be given several times')
+    print('    -q   - comma separated quantiles to add after the median, e.g. 0.1,0.9')
+    print('    -o   - report CSV (default RollupReport.csv)')
+    print('    -h   - print this help message')
+    sys.exit(2)
+
+
+def main(argv):
+    level = None
+    firstDay = None
+    lastDay = None
+    sites = None
+    parameters = None
+    quantiles = []
+    reportPath = 'RollupReport.csv'
+
+    try:
+        opts, args = getopt.getopt(argv, "hl:f:t:s:p:q:o:", ["help", "level=", "from=", "to=", "site=", "parameter=",
+                                                            "quantiles=", "output="])
+    except getopt.GetoptError:
+        helpMessage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            helpMessage()
+        elif opt in ("-l", "--level"):
+            level = arg.capitalize()
+            if level not in FormatStreamData.rollupLevels:
+                helpMessage()
+        elif opt in ("-f", "--from"):
+            firstDay = parseDay(arg)
+            if firstDay is None:
+                helpMessage()
+        elif opt in ("-t", "--to"):
+            lastDay = parseDay(arg)
+            if lastDay is None:
+                helpMessage()
+        elif opt in ("-s", "--site"):
+            sites = (sites or set()) | set([arg])
+        elif opt in ("-p", "--parameter"):
+            parameters = (parameters or set()) | set([arg])
+        elif opt in ("-q", "--quantiles"):
+            try:
+                quantiles = [float(q) for q in arg.split(',') if q.strip()]
+            except ValueError:
+                helpMessage()
+            if any(q < 0 or q > 1 for q in quantiles):
+                helpMessage()
+        elif opt in ("-o", "--output"):
+            reportPath = arg
+
+    if len(args) != 1:
+        helpMessage()
+    rollupPath = findRollupFile(args[0]) if os.path.isdir(args[0]) else args[0]
+    if rollupPath is None or not os.path.isfile(rollupPath):
+        print('No %s in %s - run FormatStreamData.py to make it' % (FormatStreamData.rollupFileName, args[0]))
+        sys.exit(1)
+
+    try:
+        if level is not None:
+            rollups = readRollups(rollupPath, sites, parameters, [level], firstDay, lastDay)
+        else:
+            rollups = rollupRange(readRollups(rollupPath, sites, parameters, ['Year', 'Month', 'Day'], firstDay, lastDay),
+                                  firstDay, lastDay)
+        nRows = writeReport(rollups, reportPath, quantiles)
+    except (ValueError, IOError) as e:
+        print(str(e))
+        sys.exit(1)
+    print('%d rows written to %s' % (nRows, reportPath))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Service mode - a small HTTP server on this machine that runs FormatStreamData for several
+people at once, so the same data isn't parsed again on every laptop.  A job is a folder of
+data files, or an uploaded data file or zip of them.  Jobs run in a pool of worker processes
+and are known by a hash of their data files' contents and options, so a job that has been run
+before is answered from its outputs straight away.  What was read from each data file is kept
+too, by its content, so a job over a folder that has had files added or changed only reads
+those files, and reuses what the other jobs read from the rest.
+
+    POST /jobs?mode=logger&eim=1&name=Trip1.zip     body is a data file or a zip of data files
+    POST /jobs      JSON body {"folder": "...", "mode": "temperature", "eim": true}
+    GET  /jobs                  all the jobs
+    GET  /jobs/<id>             a job's status and output files
+    GET  /jobs/<id>/<file>      one of the job's output files
+
+mode is logger (the default) or temperature.  The server only listens on localhost.
+
+"""
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import FormatStreamData
+import BatchStreamData
+
+defaultPort = 8529
+
+# Jobs, their inputs and outputs are kept under this folder
+defaultServiceFolder = 'StreamDataService'
+
+# A finished job's summary (as BatchStreamData.runJob returns it) is kept in this file in its
+# folder, so it is still answered from the cache after the server restarts.  Jobs that didn't
+# run (e.g. the folder had gone) aren't kept, so they are tried again.
+jobSummaryFileName = 'Job.json'
+cachedStatuses = ('OK', 'Errors')
+
+# What the jobs read from each data file is kept in this folder under the service folder (see
+# FormatStreamData.parseCacheVersion), so a job only reads the data files no job has read before
+parseCacheFolderName = 'parsed'
+
+# Uploads are read and hashed in chunks of this many bytes
+uploadChunkBytes = 1 << 20
+
+contentTypes = {'.csv': 'text/csv', '.txt': 'text/plain', '.json': 'application/json',
+                '.gz': 'application/gzip', '.zst': 'application/zstd', '.lz4': 'application/octet-stream'}
+
+# One job of the service
+class ServiceJob(object):
+    def __init__(self, jobId, source, mode, DoEOutputOption, jobFolder):
+        self.jobId = jobId
+        self.source = source            # the folder, or the name of the upload
+        self.mode = mode
+        self.DoEOutputOption = DoEOutputOption
+        self.jobFolder = jobFolder
+        self.outputFolder = os.path.join(jobFolder, 'output')
+        self.summary = None             # set once the job has finished
+        self.submitTime = time.time()
+
+    def isFinished(self):
+        return self.summary is not None
+
+    def outputFiles(self):
+        if not self.isFinished() or not os.path.isdir(self.outputFolder):
+            return []
+        return sorted(name for name in os.listdir(self.outputFolder) if os.path.isfile(os.path.join(self.outputFolder, name)))
+
+    def describe(self):
+        return {'id': self.jobId, 'source': self.source, 'mode': self.mode, 'eim': self.DoEOutputOption,
+                'status': self.summary['Status'] if self.isFinished() else 'Running',
+                'summary': self.summary, 'files': self.outputFiles()}
+
+# The jobs and the worker pool.  Job ids are hashes of the content, so the same data files with
+# the same options give the same job, which is only run once.
+class StreamDataService(object):
+
+    def __init__(self, serviceFolder, nWorkers=BatchStreamData.defaultWorkers, **options):
+        self.serviceFolder = serviceFolder
+        self.options = options
+        self.pool = ProcessPoolExecutor(max_workers=max(1, nWorkers), mp_context=FormatStreamData.workerContext)
+        self.jobs = {}          # indexed by job id
+        self.digests = {}       # digest of each data file read, indexed by path: (signature, digest)
+        self.lock = threading.Lock()
+        for folder in ('jobs', 'uploads'):
+            os.makedirs(os.path.join(serviceFolder, folder), exist_ok=True)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    # Start hashing a job - the mode and options, then the job's own content is added
+    def jobHash(self, kind, source, mode, DoEOutputOption):
+        jobHash = hashlib.sha256()
+        jobHash.update(json.dumps([kind, source, mode, DoEOutputOption, sorted(self.options.items())]).encode('utf-8'))
+        return jobHash
+
+    # Digest of one data file's content.  Digests are kept by path and the file's size and
+    # modification time, so an unchanged file isn't read again.
+    def fileDigest(self, path):
+        signature = FormatStreamData.fileSignature(path)
+        with self.lock:
+            cached = self.digests.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        digest = FormatStreamData.dataFileDigest(path)
+        with self.lock:
+            self.digests[path] = (signature, digest)
+        return digest
+
+    # Submit a job for the data files in a folder on this machine
+    def submitFolder(self, folder, mode, DoEOutputOption):
+        folder = os.path.abspath(folder)
+        jobHash = self.jobHash('folder', folder, mode, DoEOutputOption)
+        for path in FormatStreamData.FolderScanner(folder, BatchStreamData.jobModes[mode]).scan():
+            jobHash.update(os.path.relpath(path, folder).encode('utf-8'))
+            jobHash.update(self.fileDigest(path).encode('ascii'))
+        jobId = jobHash.hexdigest()[:32]
+        return self.submit(jobId, folder, folder, mode, DoEOutputOption)
+
+    # Submit a job for an uploaded data file or zip archive - stream is read to the end, length bytes
+    def submitUpload(self, name, stream, length, mode, DoEOutputOption):
+        jobHash = self.jobHash('upload', name, mode, DoEOutputOption)
+        uploadFile = tempfile.NamedTemporaryFile(dir=os.path.join(self.serviceFolder, 'uploads'), delete=False)
+        try:
+            with uploadFile:
+                remaining = length
+                while remaining > 0:
+                    chunk = stream.read(min(uploadChunkBytes, remaining))
+                    if not chunk:
+                        raise ValueError('upload ended after %d of %d bytes' % (length - remaining, length))
+                    jobHash.update(chunk)
+                    uploadFile.write(chunk)
+                    remaining -= len(chunk)
+            jobId = jobHash.hexdigest()[:32]
+            inputFolder = os.path.join(self.serviceFolder, 'jobs', jobId, 'input')
+            with self.lock:
+                if not os.path.isfile(os.path.join(inputFolder, name)):
+                    os.makedirs(inputFolder, exist_ok=True)
+                    os.replace(uploadFile.name, os.path.join(inputFolder, name))
+        finally:
+            if os.path.exists(uploadFile.name):
+                os.remove(uploadFile.name)
+        return self.submit(jobId, inputFolder, name, mode, DoEOutputOption)
+
+    # Returns (job, True if it was already known).  A job that finished before, in this or an
+    # earlier run of the server, isn't run again.
+    def submit(self, jobId, inputFolder, source, mode, DoEOutputOption):
+        with self.lock:
+            job = self.jobs.get(jobId)
+            if job is not None and (not job.isFinished() or job.summary['Status'] in cachedStatuses):
+                return job, True
+            job = self.loadJob(jobId)
+            if job is not None:
+                self.jobs[jobId] = job
+                return job, True
+
+            job = self.jobs[jobId] = ServiceJob(jobId, source, mode, DoEOutputOption, os.path.join(self.serviceFolder, 'jobs', jobId))
+            batchJob = BatchStreamData.BatchJob(inputFolder, job.outputFolder, mode, DoEOutputOption)
+            options = dict(self.options, parseCacheFolder=os.path.join(self.serviceFolder, parseCacheFolderName))
+            future = self.pool.submit(BatchStreamData.runJob, batchJob, options)
+        future.add_done_callback(lambda future: self.finishJob(job, future))
+        return job, False
+
+    def finishJob(self, job, future):
+        try:
+            summary = future.result()
+        except BaseException as e:      # the worker process died
+            summary = {'Status': 'Error - %s' % str(e)}
+        if summary['Status'] in cachedStatuses:
+            summaryPath = os.path.join(job.jobFolder, jobSummaryFileName)
+            with open(summaryPath + '.tmp', 'w') as summaryFile:
+                json.dump({'source': job.source, 'mode': job.mode, 'eim': job.DoEOutputOption, 'summary': summary},
+                          summaryFile, indent=1, sort_keys=True)
+            os.replace(summaryPath + '.tmp', summaryPath)
+        with self.lock:
+            job.summary = summary
+
+    # A job finished by an earlier run of the server, None if there isn't one
+    def loadJob(self, jobId):
+        jobFolder = os.path.join(self.serviceFolder, 'jobs', jobId)
+        try:
+            with open(os.path.join(jobFolder, jobSummaryFileName)) as summaryFile:
+                saved = json.load(summaryFile)
+        except (IOError, ValueError):
+            return None
+        job = ServiceJob(jobId, saved['source'], saved['mode'], saved['eim'], jobFolder)
+        job.summary = saved['summary']
+        return job
+
+    def findJob(self, jobId):
+        with self.lock:
+            job = self.jobs.get(jobId)
+            if job is None:
+                job = self.loadJob(jobId)
+                if job is not None:
+                    self.jobs[jobId] = job
+            return job
+
+    def listJobs(self):
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda job: job.submitTime)
+            return [job.describe() for job in jobs]
+
+class StreamDataRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def sendJSON(self, status, body):
+        text = json.dumps(body, indent=1, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def sendError(self, status, message):
+        self.sendJSON(status, {'error': message})
+
+    def pathParts(self):
+        return [unquote(part) for part in urlsplit(self.path).path.split('/') if part != '']
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self.pathParts()
+        if parts == ['jobs']:
+            self.sendJSON(200, service.listJobs())
+            return
+        if len(parts) < 2 or len(parts) > 3 or parts[0] != 'jobs':
+            self.sendError(404, 'no such resource')
+            return
+        job = service.findJob(parts[1])
+        if job is None:
+            self.sendError(404, 'no such job')
+        elif len(parts) == 2:
+            self.sendJSON(200, job.describe())
+        elif parts[2] not in job.outputFiles():     # also keeps requests inside the output folder
+            self.sendError(404, 'no such file')
+        else:
+            self.sendFile(os.path.join(job.outputFolder, parts[2]))
+
+    def sendFile(self, path):
+        self.send_response(200)
+        self.send_header('Content-Type', contentTypes.get(os.path.splitext(path)[1].lower(), 'application/octet-stream'))
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as outputFile:
+            shutil.copyfileobj(outputFile, self.wfile)
+
+    def do_POST(self):
+        service = self.server.service
+        if self.pathParts() != ['jobs']:
+            self.sendError(404, 'no such resource')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self.sendError(411, 'Content-Length is needed')
+            return
+        query = parse_qs(urlsplit(self.path).query)
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('expected a JSON object')
+                mode = request.get('mode', 'logger')
+                DoEOutputOption = bool(request.get('eim', False))
+                folder = request.get('folder', '')
+                checkMode(mode)
+                if not isinstance(folder, str) or not os.path.isdir(folder):
+                    raise ValueError('folder is not a folder on this machine: %s' % folder)
+                job, known = service.submitFolder(folder, mode, DoEOutputOption)
+            else:
+                mode = query.get('mode', ['logger'])[0]
+                DoEOutputOption = query.get('eim', ['0'])[0].lower() in ('1', 'true', 'yes')
+                name = os.path.basename(query.get('name', [''])[0].replace('\\', '/'))
+                checkMode(mode)
+                if not (FormatStreamData.isArchiveName(name) or
+                        FormatStreamData.logFilePatternFor(BatchStreamData.jobModes[mode]).match(name)):
+                    raise ValueError('name must be a %s data file or a .zip: %s' % (mode, name))
+                job, known = service.submitUpload(name, self.rfile, length, mode, DoEOutputOption)
+        except ValueError as e:
+            self.sendError(400, str(e))
+            return
+        self.sendJSON(200 if known else 202, job.describe())
+
+def checkMode(mode):
+    if mode not in BatchStreamData.jobModes:
+        raise ValueError('mode must be logger or temperature: %s' % mode)
+
+# Build the server for a service - only listens on localhost
+def makeServer(service, port=defaultPort, verbose=False):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StreamDataRequestHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def helpMessage():
+    print('Usage:')
+    print('ServeStreamData.py [-h] [-v] [-p <port>] [-d <serviceFolder>] [-j <workers>]')
+    print('Runs FormatStreamData jobs for HTTP requests on localhost - see the top of ServeStreamData.py')
+    print('Optional parameters:')
+    print('    -p   - port to listen on (default %d)' % defaultPort)
+    print('    -d   - folder for the jobs, their inputs and outputs (default %s)' % defaultServiceFolder)
+    print('    -j   - number of jobs to run at the same time (default %d), each in a worker process of its own that' % BatchStreamData.defaultWorkers)
+    print('           also reads its data files - so the service runs at most j worker processes')
+    print('    -k   - QC threshold, as for FormatStreamData.py')
+    print('    --eim-max-rows=<n>, --eim-max-bytes=<n> - split EIM files into parts, as for FormatStreamData.py')
+    print('    -z, --compress=<type> - compress the output CSVs, as for FormatStreamData.py')
+    print('    -v   - log each request')
+    print('    -h   - print this help message')
+    sys.exit(2)
+
+def main(argv):
+    port = defaultPort
+    serviceFolder = defaultServiceFolder
+    nWorkers = BatchStreamData.defaultWorkers
+    verbose = False
+    options = {}
+
+    try:
+        opts, args = getopt.getopt(argv, "hvp:d:j:k:z", ["help", "verbose", "port=", "folder=", "workers=", "qc-threshold=",
+                                                        "eim-max-rows=", "eim-max-bytes=", "compress="])
+    except getopt.GetoptError:
+        helpMessage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            helpMessage()
+        elif opt in ("-v", "--verbose"):
+            verbose = True
+        elif opt in ("-p", "--port"):
+            try:
+                port = int(arg)
+            except ValueError:
+                helpMessage()
+        elif opt in ("-d", "--folder"):
+            serviceFolder = arg
+        elif opt in ("-j", "--workers"):
+            try:
+                nWorkers = int(arg)
+            except ValueError:
+                helpMessage()
+            if nWorkers < 1:
+                helpMessage()
+        elif opt in ("-k", "--qc-threshold"):
+            try:
+                options['qcThreshold'] = float(arg)
+            except ValueError:
+                helpMessage()
+        elif opt == "--eim-max-rows":
+            try:
+                options['eimMaxRows'] = int(arg)
+            except ValueError:
+                helpMessage()
+            if options['eimMaxRows'] < 0:
+                helpMessage()
+        elif opt == "--eim-max-bytes":
+            options['eimMaxBytes'] = FormatStreamData.parseByteCount(arg)
+            if options['eimMaxBytes'] is None:
+                helpMessage()
+        elif opt == "-z":
+            options['compression'] = 'gzip'
+        elif opt == "--compress":
+            if arg not in FormatStreamData.availableCompressions():
+                print('--compress must be one of: %s' % ', '.join(FormatStreamData.availableCompressions()))
+                sys.exit(2)
+            options['compression'] = arg
+
+    service = StreamDataService(serviceFolder, nWorkers, **options)
+    server = makeServer(service, port, verbose)
+    print('Serving on http://127.0.0.1:%d/jobs - Ctrl-C to stop' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -9,8 +9,9 @@ import cx_Freeze
 import sys
 import os
 
-os.environ['TCL_LIBRARY'] = r'C:\Users\Evan Romasco-Kelly\Anaconda3\tcl\tcl8.6'
-os.environ['TK_LIBRARY'] = r'C:\Users\Evan Romasco-Kelly\Anaconda3\tcl\tk8.6'
+# Tcl/Tk of the Python doing the build
+os.environ['TCL_LIBRARY'] = os.path.join(sys.base_prefix, 'tcl', 'tcl8.6')
+os.environ['TK_LIBRARY'] = os.path.join(sys.base_prefix, 'tcl', 'tk8.6')
 
 base = None
 
@@ -24,8 +25,10 @@ cx_Freeze.setup(
         name = "KCStreamDataTool_GUI_V2",
         options = {"build_exe":{"packages":["tkinter",
                                             "xlrd",
+                                            "openpyxl",
                                             "subprocess",
                                             "threading",
+                                            "multiprocessing",
                                             "queue",
                                             "time",
                                             "os",
@@ -39,7 +42,7 @@ cx_Freeze.setup(
                                             "platform",
                                             "csv",
                                             "collections"],
-                    "include_files":["FormatStreamData.py","KC_GUI.ico", "GUI_Welcome_Message.txt"]}},
+                    "include_files":["FormatStreamData.py","PreviewStreamData.py","ResampleStreamData.py","InstrumentLayouts.json","KC_GUI.ico", "GUI_Welcome_Message.txt"]}},
         version = "1.1",
         description = "Data formatting tool for water quality data collected by Kooskooskie Commons",
         executables = executables
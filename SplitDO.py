@@ -40,7 +40,7 @@ def collectFiles(inputFolder, outputFolder=None):
         print(filesToRead)                
     return filesToRead
 
-def SplitDO(file):
+def SplitDO(file, outputFolder):
     if verbose:
         print("in SplitDO")
     datafile = open(file, 'r')
@@ -49,8 +49,8 @@ def SplitDO(file):
     DO_outputFileName = "DO_"+str(ntpath.basename(file))
     print("Writing file,", str(ntpath.basename(file))+"...")
     
-    T_outputPath = os.path.join("C:\\Users\\Evan Romasco-Kelly\\OneDrive\\Documents\\Kooskooskie Commons\\WADOE Reporting\\EIM\\DO and Temp Files", T_outputFileName)
-    DO_outputPath = os.path.join("C:\\Users\\Evan Romasco-Kelly\\OneDrive\\Documents\\Kooskooskie Commons\\WADOE Reporting\\EIM\\DO and Temp Files", DO_outputFileName)
+    T_outputPath = os.path.join(outputFolder, T_outputFileName)
+    DO_outputPath = os.path.join(outputFolder, DO_outputFileName)
     T_outfile = open(T_outputPath, 'w')
     DO_outfile = open(DO_outputPath, 'w')
     T_writer = csv.writer(T_outfile, lineterminator='\n')
@@ -78,9 +78,10 @@ def SplitDO(file):
 
 def main():
     inputFolder1 = input("Input Folder Path:\n")
+    outputFolder1 = input("Output Folder Path:\n")
     
     filesToProcess = collectFiles(inputFolder1)
     for afile in filesToProcess:
-        SplitDO(afile)
+        SplitDO(afile, outputFolder1)
 
 main()
\ No newline at end of file